@@ -0,0 +1 @@
+VERSION = "3.4.0"
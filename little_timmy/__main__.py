@@ -1,27 +1,65 @@
 import argparse
-import logging
 import json
+import logging
 import os
 import sys
 
-from ansible.plugins.loader import init_plugin_loader
-
-from .config_loader import setup_run
-from .duplicated_var_finder import find_duplicated_vars
-from .unused_var_finder import find_unused_vars
+from . import VERSION
+from .client import forward_run
+from .config_loader import find_and_load_config
+from .prefetch import DEFAULT_PREFETCH_THREADS
+from .streaming import OUTPUT_FORMATS, create_writer
 
-VERSION = "3.4.0"
 LOGGER = logging.getLogger("little-timmy")
 
-# must be run only once
-init_plugin_loader()
-
-
-def main():
-    parser = argparse.ArgumentParser(description="Process a directory path")
-    parser.add_argument("directory", nargs="?", default=".",
-                        type=str, help="The directory to process")
 
+SUBCOMMANDS = ["serve", "merge", "batch", "query"]
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """`i/N` where i is from 1 to N."""
+    try:
+        index, count = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not in the form i/N")
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"{value} must have 1 <= i <= N")
+    return index, count
+
+
+def get_parser(command: str = None) -> argparse.ArgumentParser:
+    """command is None for a normal run, or one of SUBCOMMANDS."""
+    parser = argparse.ArgumentParser(prog=f"little-timmy {command}" if command else None,
+                                     description="Process a directory path")
+    if command == "merge":
+        parser.add_argument("partials", nargs="+",
+                            type=str, help="The partial results of every shard")
+        parser.add_argument("--directory", default=".", type=str,
+                            help="The directory the shards processed, as checked out here (default: .).")
+    elif command == "query":
+        parser.add_argument("names", nargs="*",
+                            type=str, help="The variables to look up")
+        parser.add_argument("--directory", default=".", type=str,
+                            help="The directory that was processed (default: .).")
+        parser.add_argument("--file", action="append", type=str,
+                            help="Also look up the variables this file declares and references. Can be repeated.")
+    elif command == "batch":
+        parser.add_argument("directories", nargs="*",
+                            type=str, help="The directories to process")
+        parser.add_argument("--manifest", type=str,
+                            help="File with a directory to process on each line, relative to the file.")
+    else:
+        parser.add_argument("directory", nargs="?", default=".",
+                            type=str, help="The directory to process")
+
+    parser.add_argument("--cache", default=True, action=argparse.BooleanOptionalAction,
+                        help="Cache per file results in .little-timmy-cache in the directory being processed.")
+    parser.add_argument("--clear-cache", default=False, action=argparse.BooleanOptionalAction,
+                        help="Remove the cache before running.")
+    parser.add_argument("--changed-file", action="append", type=str,
+                        help="Only report findings involving this file, reusing the results of the last run for everything else. Can be repeated.")
+    parser.add_argument("--changed-since", type=str,
+                        help="Only report findings involving files changed since this git ref, reusing the results of the last run for everything else.")
     parser.add_argument(
         "-c", "--config-file", type=str, help="Config file to use. By default it will search all dirs to `/` for .little-timmy")
     parser.add_argument("-d", "--dave-mode", default=False, action=argparse.BooleanOptionalAction,
@@ -34,13 +72,55 @@ def main():
                         help="Output results for github actions.")
     parser.add_argument("-j", "--json-output", default=False, action=argparse.BooleanOptionalAction,
                         help="Output results as json to stdout. Disables the stderr logger.")
+    if command == "batch":
+        parser.add_argument("--jobs", default=1, type=int,
+                            help="Number of processes analysing directories at once. 0 uses all CPUs (default: 1).")
+    else:
+        parser.add_argument("--jobs", default=1, type=int,
+                            help="Number of processes used to parse files and check inventories for duplicates. 0 uses all CPUs (default: 1).")
+    parser.add_argument("--max-memory", type=int,
+                        help="Keep parsed files and inventories within about this many MiB, spilling parsed files to disk. The findings are the same, it is slower when the limit is hit.")
+    parser.add_argument("--output-file", type=str,
+                        help="Write the results to this file instead of stdout.")
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, type=str,
+                        help="Write each finding as soon as it is final, as newline delimited json or SARIF. Disables the stderr logger.")
     parser.add_argument("-l", "--log-level", default="INFO", type=str,
                         help="set the logging level (default: INFO).")
+    parser.add_argument("--prefetch-threads", default=DEFAULT_PREFETCH_THREADS, type=int,
+                        help=f"Threads reading files ahead of them being parsed, when using one process. 0 disables it (default: {DEFAULT_PREFETCH_THREADS}).")
+    parser.add_argument("-p", "--profile", default=False, action=argparse.BooleanOptionalAction,
+                        help="Output the time spent in each phase, counters and the slowest files. Added to the json output with the type PROFILE when using --json-output.")
+    parser.add_argument("--profile-top", default=10, type=int,
+                        help="Number of the slowest files in the profile (default: 10).")
+    if command is None:
+        parser.add_argument("--shard", type=parse_shard,
+                            help="Only analyse shard i of N, given as i/N, and output a partial result for little-timmy merge.")
     parser.add_argument("-u", "--unused-vars", default=True, action=argparse.BooleanOptionalAction,
                         help="Find unused variables.")
+    parser.add_argument("-w", "--watch", default=False, action=argparse.BooleanOptionalAction,
+                        help="Keep running, re-analyse files as they change and output how the findings change.")
+    if command == "serve":
+        parser.add_argument("--socket", required=True, type=str,
+                            help="Unix socket to listen on.")
+    else:
+        parser.add_argument("--socket", default=os.environ.get("LITTLE_TIMMY_SOCKET"), type=str,
+                            help="Forward the run to a little-timmy server listening on this unix socket, if there is one (default: $LITTLE_TIMMY_SOCKET).")
     parser.add_argument("-v", "--version", default=False, action=argparse.BooleanOptionalAction,
                         help="Output the version.")
-    args = parser.parse_args()
+    return parser
+
+
+def main():
+    argv = sys.argv[1:]
+    command = argv[0] if argv[:1] and argv[0] in SUBCOMMANDS else None
+    if command:
+        argv = argv[1:]
+    serve = command == "serve"
+    merge = command == "merge"
+    batch = command == "batch"
+    parser = get_parser(command)
+    args = parser.parse_args(argv)
+    shard = getattr(args, "shard", None)
 
     log_level = getattr(logging, args.log_level.upper(), None)
     if not isinstance(log_level, int):
@@ -51,7 +131,7 @@ def main():
         stderr_log_handler.setFormatter(logging.Formatter("%(message)s"))
         LOGGER.addHandler(stderr_log_handler)
     logging.basicConfig(level=log_level, format="%(message)s")
-    if args.json_output:
+    if args.json_output or args.output_format:
         LOGGER.disabled = True
 
     if args.version:
@@ -60,6 +140,39 @@ def main():
 
     LOGGER.debug("starting")
 
+    if command == "query":
+        from .query import run_query
+        directory = os.getcwd() if args.directory == "." else args.directory.rstrip("/")
+        if not args.names and not args.file:
+            parser.error("query needs variable names or --file")
+        try:
+            exit_code = run_query(args, directory, sys.stdout)
+        except ValueError as err:
+            parser.error(str(err))
+        LOGGER.debug("finished")
+        sys.exit(exit_code)
+
+    if batch:
+        if args.watch or args.changed_since or args.changed_file or args.output_format:
+            parser.error(
+                "--watch, --changed-since, --changed-file and --output-format can not be used with batch")
+        directories = list(args.directories)
+        if args.manifest:
+            from .batch import read_manifest
+            try:
+                directories += read_manifest(args.manifest)
+            except OSError as err:
+                parser.error(str(err))
+        if not directories:
+            parser.error("batch needs directories or --manifest")
+        from .batch import run_batch
+        output = open(args.output_file, "w") if args.output_file else sys.stdout
+        exit_code = run_batch(args, directories, output, sys.stderr)
+        if args.output_file:
+            output.close()
+        LOGGER.debug("finished")
+        sys.exit(exit_code)
+
     if args.directory == ".":
         directory = os.getcwd()
     else:
@@ -68,50 +181,71 @@ def main():
     if directory.endswith("/"):
         directory = directory[:-1]
 
-    context = setup_run(directory, args.config_file)
-    if args.unused_vars:
-        find_unused_vars(context)
-    if args.duplicated_vars:
-        find_duplicated_vars(context)
-
-    if args.json_output:
-        output = json.dumps(
-            [{"name": k, "type": "UNUSED", "locations": list(v)}
-             for k, v in context.all_unused_vars.items()]
-            +
-            [{"name": k, "type": "DUPLICATED", "locations": list(v.locations), "original": v.original}
-             for k, v in context.all_duplicated_vars.items()], indent=4)
-        print(output, file=sys.stdout)
-    else:
-        LOGGER.info("\n**unused vars**\n")
-        for var_name, var_locations in context.all_unused_vars.items():
-            print(f"""{var_name} at {[os.path.relpath(
-                x, directory) for x in var_locations]}\n""", file=sys.stdout)
-        LOGGER.info("\n**duplicated vars**\n")
-        for var_name, var_details in context.all_duplicated_vars.items():
-            print(f"""{var_name}""", file=sys.stdout)
-            print(f"""at {[os.path.relpath(
-                x, directory) for x in var_details.locations]}""", file=sys.stdout)
-            print(
-                f"""original {os.path.relpath(var_details.original, directory)}\n""", file=sys.stdout)
-
-    if args.github_action:
-        level = "warning" if args.exit_success else "error"
-        for var_name, var_locations in context.all_unused_vars.items():
-            for loc in var_locations:
-                msg = f"::{level} file={loc}::{var_name} is unused"
-                print(msg, file=sys.stderr)
-        for var_name, var_details in context.all_duplicated_vars.items():
-            for loc in var_details.locations:
-                msg = f"::{level} file={loc}::{var_name} is duplicated"
-                print(msg, file=sys.stderr)
-
-    exit_code = 1
-    if args.exit_success:
-        exit_code = 0
-    if not context.all_unused_vars and not context.all_duplicated_vars:
-        exit_code = 0
-        LOGGER.debug("no unused vars")
+    if (args.changed_since or args.changed_file) and (not args.cache or not args.unused_vars):
+        parser.error("--changed-since and --changed-file need --cache and --unused-vars")
+    if (args.changed_since or args.changed_file) and (args.watch or serve):
+        parser.error("--changed-since and --changed-file can not be used with --watch or serve")
+    if serve and args.watch:
+        parser.error("--watch can not be used with serve")
+    if args.output_format and args.json_output:
+        parser.error("--output-format can not be used with --json-output")
+    if (args.output_format or args.output_file) and (args.watch or serve):
+        parser.error("--output-format and --output-file can not be used with --watch or serve")
+    if shard and (args.watch or args.changed_since or args.changed_file or args.json_output or args.output_format):
+        parser.error(
+            "--shard can not be used with --watch, --changed-since, --changed-file, --json-output or --output-format")
+    if merge and args.watch:
+        parser.error("--watch can not be used with merge")
+
+    if args.socket and not serve and not merge and not shard and not args.watch:
+        exit_code = forward_run(args.socket, sys.argv[1:], os.getcwd())
+        if exit_code is not None:
+            LOGGER.debug("finished")
+            sys.exit(exit_code)
+
+    # fail on a bad config before paying for importing ansible
+    find_and_load_config(directory, args.config_file)
+    from .runner import analyse, get_jobs, output_results
+    output = open(args.output_file, "w") if args.output_file else sys.stdout
+    if shard:
+        from .shard import analyse_shard
+        json.dump(analyse_shard(args, directory), output)
+        output.write("\n")
+        if args.output_file:
+            output.close()
+        LOGGER.debug("finished")
+        sys.exit(0)
+    if merge:
+        from .shard import merge as merge_partials
+        try:
+            context = merge_partials(args.partials, directory, args.config_file)
+        except (OSError, ValueError) as err:
+            parser.error(str(err))
+        exit_code = output_results(context, args, directory, output)
+        if args.output_file:
+            output.close()
+        LOGGER.debug("finished")
+        sys.exit(exit_code)
+    writer = None
+    if args.output_format:
+        writer = create_writer(args.output_format, output,
+                               directory, args.exit_success)
+    context = analyse(args, directory, writer, keep_file_analyses=serve)
+
+    if serve:
+        from .server import serve as serve_socket
+        serve_socket(context, args, get_parser())
+        sys.exit(0)
+    if args.watch:
+        from .watch import watch
+        watch(context, args.unused_vars, args.duplicated_vars,
+              args.json_output, get_jobs(args))
+        sys.exit(0)
+
+    exit_code = output_results(
+        context, args, directory, output, writer=writer)
+    if args.output_file:
+        output.close()
     LOGGER.debug("finished")
     sys.exit(exit_code)
 
@@ -0,0 +1,246 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from . import VERSION
+from .config_loader import Config, FileAnalysis
+from .file_manifest import FileManifest
+
+LOGGER = logging.getLogger("little-timmy")
+
+CACHE_DIR_NAME = ".little-timmy-cache"
+CACHE_FILE_NAME = "analysis.sqlite"
+DEFAULT_CACHE_MAX_ENTRIES = 100000
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_analysis (
+    path TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    declared TEXT NOT NULL,
+    referenced TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS file_index (
+    path TEXT PRIMARY KEY,
+    declared TEXT NOT NULL,
+    referenced TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS index_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS var_index (
+    name TEXT NOT NULL,
+    file_id INTEGER NOT NULL,
+    declared INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS var_index_name ON var_index (name);
+"""
+
+
+def get_cache_path(root_dir: str) -> str:
+    return os.path.join(root_dir, CACHE_DIR_NAME, CACHE_FILE_NAME)
+
+
+def clear_cache(root_dir: str):
+    path = get_cache_path(root_dir)
+    if os.path.isfile(path):
+        LOGGER.debug(f"removing cache {path}")
+        try:
+            os.remove(path)
+        except OSError as err:
+            LOGGER.warning(f"unable to clear the cache {path}: {err}")
+
+
+def file_digest(path: str, categories: list[str], data: bytes = None) -> str:
+    """The categories change how a file is parsed so are part of the digest."""
+    digest = hashlib.sha256(",".join(categories).encode())
+    if data is None:
+        with open(path, "rb") as f:
+            data = f.read()
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def file_stat(path: str) -> list[int]:
+    """The mtime in nanoseconds and size of a file, or None if it is gone."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def config_fingerprint(root_dir: str, config: Config) -> str:
+    """
+    Anything that changes what a file declares or references must be in
+    here, otherwise stale results would be returned. root_dir is None to
+    compare results from checkouts in different places.
+    """
+    # only imported here so reading the index does not import ansible
+    from ansible.release import __version__ as ANSIBLE_VERSION
+    relevant = {
+        "little_timmy": VERSION,
+        "ansible": ANSIBLE_VERSION,
+        "root_dir": os.path.abspath(root_dir) if root_dir is not None else None,
+        "skip_vars": config.skip_vars,
+        "magic_vars": config.magic_vars,
+        "jinja_context_keys": config.jinja_context_keys,
+        "dirs_not_to_delcare_vars_from": config.dirs_not_to_delcare_vars_from,
+        "fast_yaml_loader": config.fast_yaml_loader,
+        "template_max_bytes": config.template_max_bytes,
+        "dir_matching": config.dir_matching,
+    }
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True).encode()).hexdigest()
+
+
+class AnalysisCache():
+    """
+    Per file declared and referenced variables from previous runs, keyed by
+    path, file content and config fingerprint. The least recently used
+    entries are evicted when the cache grows beyond max_entries.
+
+    It also holds an index of the last complete run: the file manifest and
+    the analysis of every file in it, so a run can start from there and
+    only look at the files that have changed since.
+    """
+    hits: int
+    misses: int
+
+    def __init__(self, path: str, fingerprint: str, max_entries: int = DEFAULT_CACHE_MAX_ENTRIES):
+        cache_dir = os.path.dirname(path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+            # keep the cache out of version control
+            with open(os.path.join(cache_dir, ".gitignore"), "w") as f:
+                f.write("*\n")
+        self.path = path
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.used: list[str] = []
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(CACHE_SCHEMA)
+
+    def get(self, path: str, digest: str):
+        row = self.connection.execute(
+            "SELECT declared, referenced FROM file_analysis WHERE path = ? AND digest = ? AND fingerprint = ?",
+            (path, digest, self.fingerprint)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used.append(path)
+        return FileAnalysis(set(json.loads(row[0])), set(json.loads(row[1])))
+
+    def put(self, path: str, digest: str, analysis: FileAnalysis):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO file_analysis VALUES (?, ?, ?, ?, ?, ?)",
+            (path, digest, self.fingerprint, json.dumps(sorted(analysis.declared)), json.dumps(sorted(analysis.referenced)), time.time()))
+
+    def save_index(self, manifest: FileManifest, file_analyses: dict[str, FileAnalysis]):
+        """var_index is the reverse of file_index, for VarIndex to look variables up by name."""
+        self.connection.execute("DELETE FROM file_index")
+        self.connection.execute("DELETE FROM var_index")
+        self.connection.executemany(
+            "INSERT INTO file_index (rowid, path, declared, referenced) VALUES (?, ?, ?, ?)",
+            ((i, path, json.dumps(sorted(x.declared)), json.dumps(sorted(x.referenced)))
+             for i, (path, x) in enumerate(file_analyses.items(), 1)))
+        self.connection.executemany(
+            "INSERT INTO var_index VALUES (?, ?, ?)",
+            ((name, i, declared) for i, x in enumerate(file_analyses.values(), 1)
+             for declared, names in [(1, x.declared), (0, x.referenced)] for name in names))
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO index_meta VALUES (?, ?)",
+            [("fingerprint", self.fingerprint), ("root_dir", manifest.root_dir), ("manifest", json.dumps(manifest.categories)),
+             ("file_stats", json.dumps({x: file_stat(x) for x in file_analyses})), ("saved_at", str(time.time()))])
+        LOGGER.debug(f"saved index of {len(file_analyses)} files")
+
+    def load_index(self):
+        """
+        Returns (manifest, file_analyses, file_stats) or None if there isn't
+        a usable index. file_stats is the file_stat of each file when the
+        index was saved, to find the files changed since.
+        """
+        meta = dict(self.connection.execute("SELECT key, value FROM index_meta").fetchall())
+        # older versions did not save file_stats
+        if meta.get("fingerprint") != self.fingerprint or "manifest" not in meta or "file_stats" not in meta:
+            LOGGER.debug("no index matching the current config")
+            return None
+        manifest = FileManifest(meta["root_dir"], json.loads(meta["manifest"]))
+        file_analyses = {
+            path: FileAnalysis(set(json.loads(declared)), set(json.loads(referenced)))
+            for path, declared, referenced in self.connection.execute("SELECT path, declared, referenced FROM file_index")}
+        LOGGER.debug(f"loaded index of {len(file_analyses)} files")
+        return manifest, file_analyses, json.loads(meta["file_stats"])
+
+    def close(self):
+        now = time.time()
+        self.connection.executemany(
+            "UPDATE file_analysis SET last_used = ? WHERE path = ?", ((now, x) for x in self.used))
+        self.connection.execute(
+            "DELETE FROM file_analysis WHERE path IN "
+            "(SELECT path FROM file_analysis ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+        self.connection.commit()
+        self.connection.close()
+        LOGGER.debug(f"analysis cache hits {self.hits} misses {self.misses}")
+
+
+class VarIndex():
+    """
+    Read only lookups in the index of the last complete run with the cache,
+    without analysing anything.
+    """
+
+    def __init__(self, root_dir: str):
+        path = get_cache_path(root_dir)
+        if not os.path.isfile(path):
+            raise ValueError(f"no index in {root_dir}, run little-timmy with --cache first")
+        self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        meta = dict(self.connection.execute(
+            "SELECT key, value FROM index_meta").fetchall())
+        # older versions did not save var_index
+        if "saved_at" not in meta:
+            self.connection.close()
+            raise ValueError(f"no index in {root_dir}, run little-timmy with --cache first")
+        self.root_dir = meta["root_dir"]
+        self.saved_at = float(meta["saved_at"])
+
+    def locations(self, name: str) -> dict[str, list[str]]:
+        """The files declaring and referencing a variable."""
+        locations = {"declared": [], "referenced": []}
+        for path, declared in self.connection.execute(
+                "SELECT file_index.path, var_index.declared FROM var_index "
+                "JOIN file_index ON file_index.rowid = var_index.file_id WHERE var_index.name = ? "
+                "ORDER BY file_index.path", (name,)):
+            locations["declared" if declared else "referenced"].append(path)
+        return locations
+
+    def file_vars(self, path: str) -> dict[str, list[str]]:
+        """The variables a file declares and references, or None if it is not in the index."""
+        row = self.connection.execute(
+            "SELECT declared, referenced FROM file_index WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        return {"declared": json.loads(row[0]), "referenced": json.loads(row[1])}
+
+    def close(self):
+        self.connection.close()
+
+
+def open_analysis_cache(root_dir: str, config: Config) -> AnalysisCache:
+    """None, with a warning, when the cache can not be written, such as in a read only checkout."""
+    path = get_cache_path(root_dir)
+    writable = os.path.dirname(path) if os.path.isdir(os.path.dirname(path)) else root_dir
+    try:
+        if not os.access(writable, os.W_OK) or (os.path.exists(path) and not os.access(path, os.W_OK)):
+            raise PermissionError(f"{writable} is not writable")
+        return AnalysisCache(path, config_fingerprint(root_dir, config))
+    except (OSError, sqlite3.Error) as err:
+        LOGGER.warning(f"unable to use the cache in {root_dir}, running without it: {err}")
+        return None
@@ -0,0 +1,88 @@
+import argparse
+import io
+import json
+import logging
+import os
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+
+from .runner import analyse, get_jobs, output_results
+from .utils import loader_cache
+
+LOGGER = logging.getLogger("little-timmy")
+
+ERROR_EXIT_CODE = 2
+
+
+def read_manifest(path: str) -> list[str]:
+    """One directory per line, relative to the manifest. Blank lines and lines starting with # are ignored."""
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path) as f:
+        lines = [x.strip() for x in f]
+    return [os.path.normpath(os.path.join(base, x)) for x in lines if x and not x.startswith("#")]
+
+
+def analyse_repo(args: argparse.Namespace, directory: str) -> dict:
+    """
+    A normal run over one directory, reusing what the process has already
+    set up. Anything wrong with one directory is reported for it rather
+    than stopping the batch.
+    """
+    # each directory is analysed in one process, the batch is what is parallel
+    args = argparse.Namespace(**{**vars(args), "jobs": 1})
+    directory = directory.rstrip("/") or "/"
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    try:
+        context = analyse(args, directory)
+        exit_code = output_results(context, args, directory, stdout, stderr)
+    except (OSError, ValueError) as err:
+        LOGGER.debug(f"batch run for {directory} failed", exc_info=True)
+        return {"directory": directory, "exit_code": ERROR_EXIT_CODE, "error": str(err)}
+    finally:
+        # file paths are unique to a directory so nothing here would be used again
+        loader_cache.clear()
+    return {"directory": directory, "exit_code": exit_code,
+            "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+
+
+def analyse_repos(args: argparse.Namespace, directories: list[str]) -> Iterator[dict]:
+    """
+    In the order given, as each one is done. With more than one job each
+    worker process stays warm between directories.
+    """
+    jobs = min(get_jobs(args), len(directories))
+    if jobs <= 1:
+        for directory in directories:
+            yield analyse_repo(args, directory)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(analyse_repo, [args] * len(directories), directories)
+
+
+def run_batch(args: argparse.Namespace, directories: list[str], stdout, stderr) -> int:
+    """
+    Output one report with the findings of each directory and return the
+    worst exit code. The text report is written as each directory is done.
+    """
+    report = {}
+    exit_code = 0
+    for result in analyse_repos(args, directories):
+        exit_code = max(exit_code, result["exit_code"])
+        if args.json_output:
+            report[result["directory"]] = {"exit_code": result["exit_code"]}
+            if "error" in result:
+                report[result["directory"]]["error"] = result["error"]
+            else:
+                report[result["directory"]]["findings"] = json.loads(result["stdout"])
+        else:
+            print(f"### {result['directory']}\n", file=stdout)
+            if "error" in result:
+                LOGGER.error(f"{result['directory']}: {result['error']}")
+            else:
+                stdout.write(result["stdout"])
+            stdout.flush()
+        stderr.write(result.get("stderr", ""))
+    if args.json_output:
+        print(json.dumps(report, indent=4), file=stdout)
+    return exit_code
@@ -0,0 +1,358 @@
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from ansible.parsing.vault import VaultLib, VaultSecret
+from ansible.release import __version__ as ANSIBLE_VERSION
+
+from . import VERSION
+from .config_loader import Context, find_and_load_config, setup_run
+from .duplicated_var_finder import find_duplicated_vars
+from .fast_yaml import fast_load, needs_data_loader
+from .file_manifest import INVENTORIES, TEMPLATES, build_file_manifest, get_file_categories
+from .runner import output_results
+from .unused_var_finder import CATEGORY_PARSERS, find_unused_vars
+from .utils import load_data_from_file, load_inventory, loader_cache, vault_plaintexts
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+LOGGER = logging.getLogger("little-timmy")
+
+# every nth role default is never referenced
+UNUSED_EVERY = 10
+TASKS_PER_FILE = 10
+# for `little-timmy --version`, which does not import ansible
+STARTUP_BUDGET_SECONDS = 0.3
+
+
+def write_file(path: str, lines: list[str], vault: VaultLib = None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    content = "\n".join(lines) + "\n"
+    if vault is not None:
+        content = vault.encrypt(content).decode()
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def vault_lines(var_name: str, value: str, vault: VaultLib) -> list[str]:
+    encrypted = vault.encrypt(value).decode()
+    return [f"{var_name}: !vault |"] + [f"  {x}" for x in encrypted.splitlines()]
+
+
+def generate_role(root_dir: str, role: int, tasks: int, role_vars: int, templates: int, rng: random.Random):
+    """Returns the role defaults that are never referenced."""
+    role_dir = os.path.join(root_dir, "roles", f"role{role}")
+    defaults = [f"role{role}_default_{x}" for x in range(role_vars)]
+    variables = [f"role{role}_var_{x}" for x in range(max(1, role_vars // 2))]
+    unused = [x for i, x in enumerate(defaults) if i % UNUSED_EVERY == UNUSED_EVERY - 1]
+    used = [x for x in defaults if x not in unused] + variables
+
+    write_file(os.path.join(role_dir, "defaults", "main.yml"),
+               [f"{x}: {rng.randint(0, 1000)}" for x in defaults])
+    write_file(os.path.join(role_dir, "vars", "main.yml"),
+               [f"{x}:\n  - {rng.randint(0, 1000)}\n  - \"{{{{ common_{rng.randint(0, 9)} }}}}\"" for x in variables])
+
+    task_lines = [[] for _ in range(max(1, -(-tasks // TASKS_PER_FILE)))]
+    task_lines[0].append("- name: reference everything used")
+    task_lines[0].append(f"  debug:\n    msg: \"{' '.join(f'{{{{ {x} }}}}' for x in used)}\"")
+    for task in range(tasks):
+        lines = task_lines[task // TASKS_PER_FILE]
+        var_name = rng.choice(used)
+        kind = task % 5
+        if kind == 0:
+            lines += [f"- name: debug {task}", f"  debug:\n    msg: \"{{{{ {var_name} | default('x') }}}}\""]
+        elif kind == 1:
+            lines += [f"- name: command {task}", f"  command: echo {{{{ {var_name} }}}}",
+                      f"  register: role{role}_result_{task}",
+                      f"- name: check {task}", "  debug:\n    msg: changed",
+                      f"  when: role{role}_result_{task} is changed"]
+        elif kind == 2:
+            lines += [f"- name: set fact {task}", "  set_fact:",
+                      f"    role{role}_fact_{task}: \"{{{{ {var_name} }}}}-{task}\"",
+                      f"- name: use fact {task}", f"  debug:\n    var: role{role}_fact_{task}"]
+        elif kind == 3:
+            lines += [f"- name: loop {task}", f"  debug:\n    msg: \"{{{{ role{role}_item }}}}\"",
+                      f"  loop: \"{{{{ role{role}_var_0 }}}}\"",
+                      f"  loop_control:\n    loop_var: role{role}_item"]
+        else:
+            lines += [f"- name: template {task}",
+                      f"  template:\n    src: template{task % max(1, templates)}.j2\n    dest: /tmp/role{role}_{task}",
+                      f"  notify: restart role{role}"]
+    task_lines[0] += [f"- import_tasks: part{x}.yml" for x in range(1, len(task_lines))]
+    for i, lines in enumerate(task_lines):
+        write_file(os.path.join(role_dir, "tasks", "main.yml" if i == 0 else f"part{i}.yml"), lines)
+
+    write_file(os.path.join(role_dir, "handlers", "main.yml"),
+               [f"- name: restart role{role}", f"  service:\n    name: \"{{{{ {variables[0]} | first }}}}\"\n    state: restarted"])
+    for template in range(templates):
+        sample = rng.sample(used, min(len(used), 5))
+        write_file(os.path.join(role_dir, "templates", f"template{template}.j2"),
+                   [f"# generated {template}"]
+                   + [f"{x} = {{{{ {x} }}}}" for x in sample]
+                   + [f"{{% for value in {variables[0]} %}}", "value = {{ value }}", "{% endfor %}",
+                      f"{{# {rng.random()} #}}"])
+    return unused
+
+
+def generate_repo(root_dir: str, roles: int = 50, tasks_per_role: int = 20, vars_per_role: int = 20, hosts: int = 200,
+                  groups: int = 20, templates_per_role: int = 2, vaulted: int = 0, galaxy_roles: int = 10,
+                  vault_password: str = None, seed: int = 0, vaulted_files: int = 0) -> dict:
+    """
+    Write a synthetic ansible repo to root_dir. Returns the unused
+    variables that were planted in it.
+    """
+    if (vaulted or vaulted_files) and not vault_password:
+        raise ValueError("a vault password is needed to generate vaulted values")
+    vault = VaultLib([("default", VaultSecret(vault_password.encode()))]) if vault_password else None
+    rng = random.Random(seed)
+    unused: list[str] = []
+    for role in range(roles):
+        unused += generate_role(root_dir, role, tasks_per_role,
+                                vars_per_role, templates_per_role, rng)
+
+    group_names = [f"group{x}" for x in range(groups)]
+    host_names = [f"host{x}" for x in range(hosts)]
+    inventory = []
+    for group, group_name in enumerate(group_names):
+        inventory += [f"[{group_name}]"] + [
+            f"{x} ansible_host=10.0.{i // 250}.{i % 250 + 1}" for i, x in enumerate(host_names)
+            if i % groups == group or i % (groups * 3) == (group + 1) % groups]
+        inventory += [f"[{group_name}:vars]", f"{group_name}_inventory_var={group}", ""]
+    write_file(os.path.join(root_dir, "inventory", "hosts.ini"), inventory)
+
+    all_vars = [f"common_{x}: value{x}" for x in range(10)] + ["common_unused_0: 1", "common_unused_1: 2"]
+    unused += ["common_unused_0", "common_unused_1"]
+    for x in range(vaulted):
+        all_vars += vault_lines(f"vault_secret_{x}", f"secret{x}", vault)
+    write_file(os.path.join(root_dir, "group_vars", "all.yml"), all_vars)
+    for group, group_name in enumerate(group_names):
+        # the same value as in all is a duplicate
+        write_file(os.path.join(root_dir, "group_vars", f"{group_name}.yml"),
+                   [f"{group_name}_setting: {group}", f"common_{group % 10}: value{group % 10}"],
+                   vault if group < vaulted_files else None)
+        write_file(os.path.join(root_dir, "inventory", "group_vars", f"{group_name}.yml"),
+                   [f"{group_name}_setting: {group}"])
+    host_specific = []
+    for i, host_name in enumerate(host_names[::5]):
+        host_specific.append(f"{host_name}_specific")
+        write_file(os.path.join(root_dir, "host_vars", f"{host_name}.yml"),
+                   [f"{host_name}_specific: {i}", "common_1: value1"])
+
+    referenced = ([f"{x}_setting" for x in group_names] + [f"{x}_inventory_var" for x in group_names]
+                  + host_specific + [f"common_{x}" for x in range(10)] + [f"vault_secret_{x}" for x in range(vaulted)])
+    write_file(os.path.join(root_dir, "site-playbook.yml"), [
+        "- hosts: all", "  roles:"] + [f"    - role{x}" for x in range(roles)] + [
+        "  tasks:", "    - debug:", f"        msg: \"{' '.join(f'{{{{ {x} | default(1) }}}}' for x in referenced)}\""])
+
+    # installed roles are walked but never reported on
+    for galaxy_role in range(galaxy_roles):
+        galaxy_dir = os.path.join(root_dir, "galaxy_roles", f"galaxy{galaxy_role}")
+        galaxy_vars = [f"galaxy{galaxy_role}_default_{x}" for x in range(vars_per_role)]
+        write_file(os.path.join(galaxy_dir, "defaults", "main.yml"),
+                   [f"{x}: {rng.randint(0, 1000)}" for x in galaxy_vars])
+        write_file(os.path.join(galaxy_dir, "tasks", "main.yml"),
+                   ["- debug:", f"    msg: \"{' '.join(f'{{{{ {x} }}}}' for x in galaxy_vars)}\""])
+        write_file(os.path.join(galaxy_dir, "README.md"), ["# noise"])
+    return {"unused_vars": sorted(unused)}
+
+
+def get_peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macos, kilobytes everywhere else
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+@contextmanager
+def timed(phases: dict, name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = {"seconds": round(time.perf_counter() - start, 6), "peak_rss_kb": get_peak_rss_kb()}
+
+
+def measure_startup(repeat: int = 5) -> dict:
+    """The median wall time of `little-timmy --version` in a new interpreter."""
+    env = dict(os.environ)
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(x for x in [package_parent, env.get("PYTHONPATH")] if x)
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-m", "little_timmy", "--version"], env=env,
+                       check=True, capture_output=True, stdin=subprocess.DEVNULL)
+        seconds.append(time.perf_counter() - start)
+    version_seconds = round(statistics.median(seconds), 6)
+    return {
+        "version_seconds": version_seconds,
+        "budget_seconds": STARTUP_BUDGET_SECONDS,
+        "within_budget": version_seconds <= STARTUP_BUDGET_SECONDS,
+    }
+
+
+def compare_yaml_loaders(paths: list[str], context: Context) -> dict:
+    """
+    Load every yaml file with the DataLoader and then with the fast loader.
+    Files the fast loader cannot handle are loaded by the DataLoader, as in
+    a real run, and counted as fallbacks.
+    """
+    total_bytes = sum(os.path.getsize(x) for x in paths)
+    results = {}
+
+    context.loader._FILE_CACHE.clear()
+    start = time.perf_counter()
+    for path in paths:
+        context.loader.load_from_file(path)
+    results["data_loader"] = {"seconds": time.perf_counter() - start, "fallbacks": 0}
+
+    context.loader._FILE_CACHE.clear()
+    fallbacks = 0
+    start = time.perf_counter()
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        if needs_data_loader(data):
+            fallbacks += 1
+            context.loader.load_from_file(path)
+        else:
+            fast_load(data)
+    results["fast"] = {"seconds": time.perf_counter() - start, "fallbacks": fallbacks}
+
+    for result in results.values():
+        result["files_per_second"] = round(len(paths) / result["seconds"], 1) if result["seconds"] else None
+        result["mb_per_second"] = round(total_bytes / 1e6 / result["seconds"], 3) if result["seconds"] else None
+        result["seconds"] = round(result["seconds"], 6)
+    return {"files": len(paths), "bytes": total_bytes, **results}
+
+
+def run_benchmark(root_dir: str, jobs: int = 1) -> dict:
+    """
+    Time each phase of a full run without the cache. Loading the yaml is
+    done up front so the unused vars phase is mostly jinja extraction, but
+    with more than one job the workers load the files again themselves.
+    """
+    loader_cache.clear()
+    vault_plaintexts.clear()
+    phases: dict[str, dict] = {}
+    with timed(phases, "config"):
+        config = find_and_load_config(root_dir, "")
+    with timed(phases, "discovery"):
+        manifest = build_file_manifest(root_dir, get_file_categories(
+            config.galaxy_dirs, config.skip_dirs, config.playbook_globs, config.template_globs, config.dir_matching))
+    with timed(phases, "setup_run"):
+        context = setup_run(root_dir, "", manifest)
+    yaml_paths = []
+    with timed(phases, "yaml_load"):
+        for path, categories in manifest.files_by_path(list(CATEGORY_PARSERS.keys())).items():
+            if INVENTORIES in categories and "dynamic" not in os.path.basename(path):
+                load_inventory(path, context)
+            # templates are read as text
+            if set(categories) - {INVENTORIES, TEMPLATES}:
+                yaml_paths.append(path)
+                load_data_from_file(path, context)
+    with timed(phases, "unused_vars"):
+        find_unused_vars(context, jobs)
+    with timed(phases, "duplicated_vars"):
+        find_duplicated_vars(context)
+    with timed(phases, "output"):
+        output_results(context, argparse.Namespace(json_output=True, output_format=None, github_action=False, exit_success=True, profile=False),
+                       root_dir, io.StringIO(), io.StringIO())
+
+    return {
+        "phases": phases,
+        "total_seconds": round(sum(x["seconds"] for x in phases.values()), 6),
+        "peak_rss_kb": get_peak_rss_kb(),
+        "files": {k: len(v) for k, v in manifest.categories.items()},
+        "findings": {"unused": len(context.all_unused_vars), "duplicated": len(context.all_duplicated_vars)},
+        "counters": dict(context.counters),
+        "yaml_loaders": compare_yaml_loaders(yaml_paths, context),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m little_timmy.benchmark",
+        description="Generate a synthetic ansible repo and time each phase of a run over it.")
+    parser.add_argument("--roles", default=50, type=int, help="Number of roles (default: 50).")
+    parser.add_argument("--tasks-per-role", default=20, type=int, help="Tasks in each role (default: 20).")
+    parser.add_argument("--vars-per-role", default=20, type=int, help="Defaults in each role (default: 20).")
+    parser.add_argument("--hosts", default=200, type=int, help="Hosts in the inventory (default: 200).")
+    parser.add_argument("--groups", default=20, type=int, help="Groups in the inventory (default: 20).")
+    parser.add_argument("--templates-per-role", default=2, type=int, help="Templates in each role (default: 2).")
+    parser.add_argument("--vaulted", default=0, type=int,
+                        help="Vaulted values in group_vars/all.yml, encrypted with the password in ANSIBLE_VAULT_PASSWORD_FILE (default: 0).")
+    parser.add_argument("--vaulted-files", default=0, type=int,
+                        help="group_vars files that are encrypted as a whole, with the same password as --vaulted (default: 0).")
+    parser.add_argument("--galaxy-roles", default=10, type=int, help="Roles installed in galaxy_roles (default: 10).")
+    parser.add_argument("--seed", default=0, type=int, help="Random seed (default: 0).")
+    parser.add_argument("--jobs", default=1, type=int, help="Processes used to find unused variables (default: 1).")
+    parser.add_argument("--directory", type=str,
+                        help="Generate the repo here and keep it. By default a temporary directory is used and removed.")
+    parser.add_argument("--output", type=str, help="Write the json results to this file instead of stdout.")
+    parser.add_argument("--check-startup", default=False, action=argparse.BooleanOptionalAction,
+                        help=f"Exit 1 if the startup time is over the budget of {STARTUP_BUDGET_SECONDS}s.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+
+    vault_password = None
+    if args.vaulted or args.vaulted_files:
+        password_file = os.environ.get("ANSIBLE_VAULT_PASSWORD_FILE")
+        if not password_file:
+            parser.error("--vaulted and --vaulted-files need ANSIBLE_VAULT_PASSWORD_FILE to be set")
+        with open(password_file) as f:
+            vault_password = f.read().strip()
+
+    root_dir = args.directory or tempfile.mkdtemp(prefix="little-timmy-benchmark-")
+    parameters = {k: v for k, v in vars(args).items() if k not in ("directory", "output", "check_startup")}
+    startup = measure_startup()
+    try:
+        start = time.perf_counter()
+        generate_repo(root_dir, args.roles, args.tasks_per_role, args.vars_per_role, args.hosts, args.groups,
+                      args.templates_per_role, args.vaulted, args.galaxy_roles, vault_password, args.seed,
+                      args.vaulted_files)
+        generate_seconds = round(time.perf_counter() - start, 6)
+        results = run_benchmark(os.path.abspath(root_dir), args.jobs)
+    finally:
+        if not args.directory:
+            shutil.rmtree(root_dir)
+
+    output = json.dumps({
+        "little_timmy": VERSION,
+        "ansible": ANSIBLE_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": parameters,
+        "startup": startup,
+        "generate_seconds": generate_seconds,
+        **results,
+    }, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output, file=sys.stdout)
+    if args.check_startup and not startup["within_budget"]:
+        LOGGER.error(
+            f"startup took {startup['version_seconds']}s, over the budget of {STARTUP_BUDGET_SECONDS}s")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import logging
+import pickle
+import sqlite3
+from collections import OrderedDict
+
+LOGGER = logging.getLogger("little-timmy")
+
+# parsed yaml takes up roughly this many times the size of the file
+PARSED_SIZE_FACTOR = 10
+
+
+class BoundedCache():
+    """
+    A dict keeping the most recently used entries within max_bytes, going
+    by the size given for each entry. Unbounded when max_bytes is None.
+
+    With spill, entries that are evicted are pickled into a temporary
+    sqlite database, which is on disk and removed when it is closed, and
+    unpickled from there when used again instead of being made again.
+    Entries that can not be pickled, or that are put with spill=False, are
+    dropped.
+    """
+
+    def __init__(self, max_bytes: int = None, spill: bool = False):
+        # key -> (value, size, whether it can be spilled)
+        self.entries: OrderedDict[str, tuple[any, int, bool]] = OrderedDict()
+        self.total_bytes = 0
+        self.spill_db: sqlite3.Connection = None
+        self.spilled: set[str] = set()
+        self.configure(max_bytes, spill)
+
+    def configure(self, max_bytes: int = None, spill: bool = False):
+        self.max_bytes = max_bytes
+        self.spill = spill
+        self.evict()
+
+    def get(self, key: str, default=None):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            return entry[0]
+        if key in self.spilled:
+            row = self.spill_db.execute("SELECT value, size FROM spilled WHERE key = ?", (key,)).fetchone()
+            value = pickle.loads(row[0])
+            # still spilled, so it does not have to be pickled again when evicted
+            self.entries[key] = (value, row[1], True)
+            self.total_bytes += row[1]
+            self.evict()
+            return value
+        return default
+
+    def put(self, key: str, value, size: int, spill: bool = True) -> int:
+        """
+        Returns how many entries were evicted to make room. With spill=False
+        the entry is never written to disk.
+        """
+        self.pop(key)
+        self.entries[key] = (value, size, spill)
+        self.total_bytes += size
+        return self.evict()
+
+    def evict(self) -> int:
+        evicted = 0
+        # always keep the newest entry, it is about to be used
+        while self.max_bytes is not None and self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            key, (value, size, spill) = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            evicted += 1
+            if self.spill and spill and key not in self.spilled:
+                self.spill_entry(key, value, size)
+        return evicted
+
+    def spill_entry(self, key: str, value, size: int):
+        try:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            LOGGER.debug(f"can not spill {key}, dropping it")
+            return
+        if self.spill_db is None:
+            # an empty name is a private temporary database on disk
+            self.spill_db = sqlite3.connect("")
+            self.spill_db.execute(
+                "CREATE TABLE spilled (key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL)")
+        self.spill_db.execute("INSERT OR REPLACE INTO spilled VALUES (?, ?, ?)", (key, data, size))
+        self.spilled.add(key)
+
+    def pop(self, key: str, default=None):
+        """Also forgets anything spilled for the key."""
+        if key in self.spilled:
+            self.spill_db.execute("DELETE FROM spilled WHERE key = ?", (key,))
+            self.spilled.discard(key)
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return default
+        self.total_bytes -= entry[1]
+        return entry[0]
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+        self.spilled.clear()
+        if self.spill_db is not None:
+            self.spill_db.close()
+            self.spill_db = None
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries or key in self.spilled
+
+    def __len__(self) -> int:
+        return len(self.entries)
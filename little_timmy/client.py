@@ -0,0 +1,80 @@
+import json
+import logging
+import socket
+import sys
+
+# Only the standard library is used here so forwarding a run to a server
+# does not pay for importing ansible.
+
+LOGGER = logging.getLogger("little-timmy")
+
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+SERVER_ERROR = -32000
+# the server is for a different directory or config
+WRONG_SERVER = -32001
+
+# how long to wait on the server before running locally instead
+REQUEST_TIMEOUT_SECONDS = 60
+
+
+class ServerError(ValueError):
+    code: int
+
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+
+
+def request(socket_path: str, method: str, params: dict = None, timeout: float = None):
+    """
+    Send one request and return its result, raising ServerError on an error
+    response and socket.timeout if the server takes longer than timeout seconds.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        message = {"jsonrpc": "2.0", "id": 1,
+                   "method": method, "params": params or {}}
+        sock.sendall(json.dumps(message).encode() + b"\n")
+        with sock.makefile("rb") as f:
+            line = f.readline()
+    if not line:
+        raise ServerError(SERVER_ERROR, "server closed the connection")
+    response = json.loads(line)
+    if "error" in response:
+        raise ServerError(response["error"]["code"],
+                          response["error"]["message"])
+    return response["result"]
+
+
+def forward_run(socket_path: str, argv: list[str], cwd: str):
+    """
+    Run on the server if there is one for this directory, returning the
+    exit code, or None to run locally instead.
+    """
+    try:
+        result = request(socket_path, "run", {"argv": argv, "cwd": cwd},
+                         REQUEST_TIMEOUT_SECONDS)
+    except (FileNotFoundError, ConnectionRefusedError):
+        LOGGER.debug(f"no server listening on {socket_path}, running locally")
+        return None
+    except socket.timeout:
+        LOGGER.warning(
+            f"server on {socket_path} did not answer within {REQUEST_TIMEOUT_SECONDS}s, running locally")
+        return None
+    except OSError as err:
+        LOGGER.warning(f"server on {socket_path} failed: {err}, running locally")
+        return None
+    except ServerError as err:
+        if err.code != WRONG_SERVER:
+            LOGGER.warning(f"server on {socket_path} failed: {err}, running locally")
+        else:
+            LOGGER.debug(f"{err}, running locally")
+        return None
+    sys.stdout.write(result["stdout"])
+    sys.stderr.write(result["stderr"])
+    return result["exit_code"]
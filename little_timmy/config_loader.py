@@ -1,29 +1,28 @@
+from __future__ import annotations
+
 import logging
 import os
+import sys
+import time
 import yaml
-from collections import defaultdict
-from dataclasses import dataclass
-
-from jinja2 import Environment
-from jsonschema import validate
-from ansible import cli, constants as C
-from ansible.parsing.dataloader import DataLoader
-from ansible.plugins.filter import AnsibleJinja2Filter
-try:
-    # ansible >= 12 (ansible-core >= 2.19)
-    from ansible._internal._templating._jinja_plugins import JinjaPluginIntercept
-    from ansible.parsing.vault import VaultSecretsContext
-    from jinja2 import defaults as jinja2_defaults
-    ANSIBLE_12_PLUS = True
-except ImportError:
-    # ansible < 12 (ansible-core < 2.19)
-    from ansible.template import JinjaPluginIntercept
-    VaultSecretsContext = None
-    jinja2_defaults = None
-    ANSIBLE_12_PLUS = False
-from ansible.plugins.loader import test_loader, Jinja2Loader
-
-from .utils import get_items_in_folder
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict, defaultdict
+from collections.abc import Iterator, Mapping
+from dataclasses import dataclass, field
+from itertools import filterfalse
+from typing import TYPE_CHECKING, Union
+
+# ansible and jsonschema take most of the startup time so are only
+# imported by the functions that need them
+if TYPE_CHECKING:
+    from ansible.parsing.dataloader import DataLoader
+    from jinja2 import Environment
+
+from .bounded_cache import BoundedCache
+from .file_manifest import SUBSTRING, DirMatcher, FileManifest, FILTER_PLUGINS, build_file_manifest, get_file_categories
+from .prefetch import HeldFiles, Prefetcher
+from .var_filter import VarFilter
 
 LOGGER = logging.getLogger("little-timmy")
 
@@ -80,12 +79,15 @@ DEFAULT_MAGIC_VARS = [
 
 CONFIG_FILE_DEFAULTS = {
     "extra_jinja_context_keys": [],
+    "fast_yaml_loader": False,
     "galaxy_dirs": ["ansible_collections", "galaxy_roles"],
     "skip_vars": [],
     "skip_dirs": ["molecule", "venv", "tests"],
     "skip_vars_duplicates_substrings": ["pass", "vault"],
     "playbook_globs": ["/**/*playbook.y*ml"],
-    "template_globs": ["/**/templates/**/*"]
+    "template_globs": ["/**/templates/**/*"],
+    "template_max_bytes": 0,
+    "dir_matching": SUBSTRING
 }
 
 CONFIG_FILE_SCHEMA = {
@@ -100,7 +102,7 @@ CONFIG_FILE_SCHEMA = {
             }
         },
         "skip_vars": {
-            "description": "Variables to skip checking.",
+            "description": "Variables to skip checking. Names with *, ? or [ are globs and names starting with re: are regular expressions, matched against the whole variable name.",
             "default": [],
             "type": "array",
             "items": {
@@ -139,6 +141,22 @@ CONFIG_FILE_SCHEMA = {
                 "type": "string"
             }
         },
+        "template_max_bytes": {
+            "description": "Templates bigger than this many bytes are skipped, with a warning. 0 checks templates of any size.",
+            "default": 0,
+            "type": "integer",
+            "minimum": 0
+        },
+        "dir_matching": {
+            "description": "How skip_dirs and galaxy_dirs are matched. substring excludes any directory containing one anywhere, component only excludes whole path components.",
+            "default": "substring",
+            "enum": ["substring", "component"]
+        },
+        "fast_yaml_loader": {
+            "description": "Load yaml files without vaulted values with libyaml instead of the ansible DataLoader. Faster but experimental.",
+            "default": False,
+            "type": "boolean"
+        },
         "extra_jinja_context_keys": {
             "description": """
             Locations where there is already a jinja context for evaluation e.g. `when` and `assert.that`.
@@ -166,6 +184,17 @@ class Config():
     jinja_context_keys: tuple[str]
     magic_vars: list[str]
     dirs_not_to_delcare_vars_from: list[str]
+    fast_yaml_loader: bool
+    template_max_bytes: int
+    dir_matching: str
+    # compiled from dirs_not_to_delcare_vars_from
+    not_declared_from: DirMatcher = field(init=False, repr=False, compare=False)
+    # compiled from magic_vars, skip_vars and skip_vars_duplicates_substrings
+    var_filter: VarFilter = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.not_declared_from = DirMatcher(self.dirs_not_to_delcare_vars_from, self.dir_matching)
+        self.var_filter = VarFilter(self.magic_vars, self.skip_vars, self.skip_vars_duplicates_substrings)
 
 
 class DuplicatedVarInfo():
@@ -177,19 +206,116 @@ class DuplicatedVarInfo():
         self.original = ""
 
 
+class FileAnalysis():
+    """The variables a single file declares and references."""
+    declared: set[str]
+    referenced: set[str]
+
+    def __init__(self, declared: set[str], referenced: set[str]):
+        # the same names are in many files, keep one copy of each
+        self.declared = {sys.intern(x) for x in declared}
+        self.referenced = {sys.intern(x) for x in referenced}
+
+
+class VarLocations(Mapping):
+    """
+    The files each variable is in. Paths are stored once in a path table
+    and each variable has the id of its only file, or a sorted array of
+    ids, which is a lot smaller than a set of strings per variable on large
+    repos. Reading it gives the same dict of sets view as before, built
+    on access.
+    """
+    paths: list[str]
+    path_ids: dict[str, int]
+    var_path_ids: dict[str, int | array]
+
+    def __init__(self):
+        self.paths = []
+        self.path_ids = {}
+        self.var_path_ids = {}
+
+    def add(self, var_name: str, path: str):
+        path_id = self.path_ids.get(path)
+        if path_id is None:
+            path_id = len(self.paths)
+            self.paths.append(path)
+            self.path_ids[path] = path_id
+        ids = self.var_path_ids.get(var_name)
+        if ids is None:
+            self.var_path_ids[sys.intern(var_name)] = path_id
+        elif isinstance(ids, int):
+            if ids != path_id:
+                self.var_path_ids[var_name] = array("I", sorted([ids, path_id]))
+        else:
+            i = bisect_left(ids, path_id)
+            if i == len(ids) or ids[i] != path_id:
+                ids.insert(i, path_id)
+
+    def discard(self, var_name: str, path: str):
+        """Also removes the variable when it is in no files."""
+        ids = self.var_path_ids.get(var_name)
+        path_id = self.path_ids.get(path)
+        if ids is None or path_id is None:
+            return
+        if isinstance(ids, int):
+            if ids == path_id:
+                del self.var_path_ids[var_name]
+            return
+        i = bisect_left(ids, path_id)
+        if i < len(ids) and ids[i] == path_id:
+            del ids[i]
+            if len(ids) == 1:
+                self.var_path_ids[var_name] = ids[0]
+
+    def __getitem__(self, var_name: str) -> set[str]:
+        ids = self.var_path_ids[var_name]
+        if isinstance(ids, int):
+            return {self.paths[ids]}
+        return {self.paths[x] for x in ids}
+
+    def __contains__(self, var_name: object) -> bool:
+        return var_name in self.var_path_ids
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.var_path_ids)
+
+    def __len__(self) -> int:
+        return len(self.var_path_ids)
+
+    def names_not_in(self, other: "VarLocations") -> Iterator[str]:
+        """In order, with the membership checks done in C rather than one at a time through Mapping."""
+        return filterfalse(other.var_path_ids.__contains__, self.var_path_ids)
+
+
 @dataclass
 class Context():
-    all_declared_vars: dict[str, set[str]]
+    all_declared_vars: VarLocations
     all_duplicated_vars: dict[str, DuplicatedVarInfo]
-    all_referenced_vars: dict[str, set[str]]
+    all_referenced_vars: VarLocations
     all_unused_vars: dict[str, set[str]]
     config: Config
+    config_file: str
+    counters: Counter
+    file_analyses: dict[str, FileAnalysis]
+    file_timings: dict[str, float]
+    inventories: BoundedCache
     loader: DataLoader
     jinja_env: Environment
+    jinja_cache: OrderedDict
+    manifest: FileManifest
     root_dir: str
+    timings: Counter
+    vars_files: dict[tuple[str, str], list[str]]
+    # set while files are being parsed
+    prefetcher: Union[Prefetcher, HeldFiles] = None
+    # only the cache index, changed files, watch and serve need what each
+    # file declares and references once the run is done
+    keep_file_analyses: bool = True
 
 
-def setup_run(root_dir: str, absolute_path: str = "") -> Context:
+def setup_run(root_dir: str, absolute_path: str = "", manifest: FileManifest = None) -> Context:
+    start = time.perf_counter()
+    timings = Counter()
 
     if not os.path.isdir(root_dir):
         raise ValueError(f"{root_dir} does not exist")
@@ -197,8 +323,76 @@ def setup_run(root_dir: str, absolute_path: str = "") -> Context:
         root_dir = root_dir[:-1]
 
     config = find_and_load_config(root_dir, absolute_path)
-    # Setup dataloader and vault
+    ensure_plugin_loader()
+    loader = create_loader()
+    # Find all the files in one pass
+    if manifest is None:
+        discovery_start = time.perf_counter()
+        manifest = build_file_manifest(root_dir, get_file_categories(
+            config.galaxy_dirs, config.skip_dirs, config.playbook_globs, config.template_globs, config.dir_matching))
+        timings["discovery"] += time.perf_counter() - discovery_start
+    jinja_env = get_jinja_env(manifest.get(FILTER_PLUGINS))
+
+    # Setup context
+    all_declared_vars = VarLocations()
+    all_referenced_vars = VarLocations()
+    all_duplicated_vars: dict[str, DuplicatedVarInfo] = defaultdict(
+        DuplicatedVarInfo)
+    all_unused_vars: dict[str, set[str]] = defaultdict(set)
+    timings["setup_run"] += time.perf_counter() - start
+    return Context(
+        all_declared_vars,
+        all_duplicated_vars,
+        all_referenced_vars,
+        all_unused_vars,
+        config,
+        absolute_path,
+        Counter(),
+        {},
+        {},
+        BoundedCache(),
+        loader,
+        jinja_env,
+        OrderedDict(),
+        manifest,
+        root_dir,
+        timings,
+        {},
+    )
+
+
+def ensure_plugin_loader():
+    from ansible.plugins.loader import init_plugin_loader
+    from ansible.utils.collection_loader import AnsibleCollectionConfig
+
+    # init_plugin_loader must only be run once per process
+    if not AnsibleCollectionConfig.collection_finder:
+        init_plugin_loader()
+
+
+# Looking up, or prompting for, the vault secrets and creating the jinja
+# environment are only done once per process, so runs over many
+# directories in one process start warm.
+vault_secrets = None
+jinja_envs: dict[tuple[str, ...], Environment] = {}
+
+
+def create_loader() -> DataLoader:
+    """Setup dataloader and vault"""
+    from ansible import cli, constants as C
+    from ansible.parsing.dataloader import DataLoader
+    try:
+        # ansible >= 12 (ansible-core >= 2.19)
+        from ansible.parsing.vault import VaultSecretsContext
+    except ImportError:
+        # ansible < 12 (ansible-core < 2.19)
+        VaultSecretsContext = None
+
     loader = DataLoader()
+    global vault_secrets
+    if vault_secrets is not None:
+        loader.set_vault_secrets(vault_secrets)
+        return loader
     vault_ids = C.DEFAULT_VAULT_IDENTITY_LIST
     
     # In ansible >= 12, VaultSecretsContext can only be initialized once
@@ -211,9 +405,33 @@ def setup_run(root_dir: str, absolute_path: str = "") -> Context:
         vault_secrets = cli.CLI.setup_vault_secrets(loader, vault_ids=vault_ids)
     
     loader.set_vault_secrets(vault_secrets)
-    # Setup jinja env
-    plugin_folders = get_items_in_folder(
-        root_dir, f"{root_dir}/**/filter_plugins", config.galaxy_dirs, True, config.skip_dirs, False)
+    return loader
+
+
+def get_jinja_env(plugin_folders: list[str]) -> Environment:
+    """Shared by every run with the same filter plugin folders."""
+    key = tuple(os.path.abspath(x) for x in plugin_folders)
+    if key not in jinja_envs:
+        jinja_envs[key] = create_jinja_env(list(key))
+    return jinja_envs[key]
+
+
+def create_jinja_env(plugin_folders: list[str]) -> Environment:
+    from ansible import constants as C
+    from ansible.plugins.filter import AnsibleJinja2Filter
+    from ansible.plugins.loader import test_loader, Jinja2Loader
+    from jinja2 import Environment
+    try:
+        # ansible >= 12 (ansible-core >= 2.19)
+        from ansible._internal._templating._jinja_plugins import JinjaPluginIntercept
+        from jinja2 import defaults as jinja2_defaults
+        ANSIBLE_12_PLUS = True
+    except ImportError:
+        # ansible < 12 (ansible-core < 2.19)
+        from ansible.template import JinjaPluginIntercept
+        jinja2_defaults = None
+        ANSIBLE_12_PLUS = False
+
     jinja_env = Environment()
     
     # Create filter plugin loader
@@ -242,34 +460,25 @@ def setup_run(root_dir: str, absolute_path: str = "") -> Context:
         # Use jinja_env's own filters/tests as delegatee
         jinja_env.filters = JinjaPluginIntercept(jinja_env.filters, filter_loader)
         jinja_env.tests = JinjaPluginIntercept(jinja_env.tests, test_loader)
-
-    # Setup context
-    all_declared_vars: dict[str, set[str]] = defaultdict(set)
-    all_referenced_vars: dict[str, set[str]] = defaultdict(set)
-    all_duplicated_vars: dict[str, DuplicatedVarInfo] = defaultdict(
-        DuplicatedVarInfo)
-    all_unused_vars: dict[str, set[str]] = defaultdict(set)
-    return Context(
-        all_declared_vars,
-        all_duplicated_vars,
-        all_referenced_vars,
-        all_unused_vars,
-        config,
-        loader,
-        jinja_env,
-        root_dir,
-    )
+    return jinja_env
 
 
 def load_config(path: str) -> Config:
     if path:
         with open(path, "r") as f:
-            config = yaml.safe_load(f)
+            try:
+                config = yaml.safe_load(f)
+            except yaml.YAMLError as err:
+                raise ValueError(f"config file {path} is not valid yaml") from err
             if not config:
                 config = {}
+        from jsonschema import ValidationError, validate
+        try:
+            validate(config, CONFIG_FILE_SCHEMA)
+        except ValidationError as err:
+            raise ValueError(f"config file {path} is not valid: {err.message}") from err
     else:
         config = {}
-    validate(config, CONFIG_FILE_SCHEMA)
 
     for k, v in CONFIG_FILE_DEFAULTS.items():
         if k not in config:
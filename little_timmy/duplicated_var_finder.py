@@ -1,16 +1,25 @@
-from collections import defaultdict
+from collections import Counter, defaultdict
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
 import logging
+import math
 import os
+from typing import Callable
 
-from ansible.parsing.yaml.objects import AnsibleVaultEncryptedUnicode
 from ansible.inventory.manager import InventoryManager
 from ansible.inventory.helpers import sort_groups
 
-from .config_loader import Context, DuplicatedVarInfo
-from .utils import get_inventories, load_data_from_file, skip_var
+from .config_loader import Context, DuplicatedVarInfo, setup_run
+from .file_manifest import INVENTORIES, FileManifest
+from .profiling import timed
+from .utils import VaultedValue, find_vars_files, get_ciphertext, load_data_from_file, load_inventory, loader_cache
 
 LOGGER = logging.getLogger("little-timmy")
 
+# set in each worker process by init_worker
+worker_context: Context = None
+
 
 class VariableValueDetails():
     value: str
@@ -23,23 +32,25 @@ class VariableValueDetails():
         self.path = path
 
 
-def check_var_for_duplication(var_name: str, var_value: str, host_name: str, path: str, level: int, vars_for_host: dict[str, list[VariableValueDetails]], context: Context):
-    if skip_var(var_name, context.config.magic_vars, context.config.skip_vars) or any([x for x in context.config.skip_vars_duplicates_substrings if x in var_name]):
-        return
+def check_var_for_duplication(var_name: str, var_value: str, path: str, level: int, vars_for_host: dict[str, list[VariableValueDetails]], context: Context):
+    """Returns (var_name, var_value, path, original path) if the variable is duplicated."""
+    if context.config.var_filter.skip_duplicate(var_name):
+        return None
 
     # In python 3.9 sometimes these are bytes?
     if isinstance(path, bytes):
         path = path.decode('utf-8')
 
-    # These may appear in plain in logs if we use the standard value
-    if isinstance(var_value, AnsibleVaultEncryptedUnicode):
+    # These may appear in plain in logs if we use the standard value, and
+    # comparing the ciphertext means they never have to be decrypted
+    if isinstance(var_value, VaultedValue):
         try:
             # wrap in try catch as we are accessing a hidden field
-            var_value = var_value._ciphertext
+            var_value = get_ciphertext(var_value)
         except:
             LOGGER.debug(
                 f"failed to parse to get cipher text for {var_name} at {path}")
-            return
+            return None
 
     last_value = vars_for_host[var_name][-1] if vars_for_host[var_name] else None
     if last_value:
@@ -48,87 +59,306 @@ def check_var_for_duplication(var_name: str, var_value: str, host_name: str, pat
             vars_for_host[var_name].append(
                 VariableValueDetails(var_value, level, path))
         else:
-            key = f"{host_name}##{var_name}##{var_value}"
-            context.all_duplicated_vars[key].locations.add(path)
-            context.all_duplicated_vars[key].original = last_value.path
+            return var_name, var_value, path, last_value.path
     else:
         vars_for_host[var_name].append(
             VariableValueDetails(var_value, level, path))
+    return None
+
+
+def get_duplicate(host_name: str, finding: tuple) -> tuple[str, str, str]:
+    """(key, path, original) of a finding, which is all that is kept of it."""
+    var_name, var_value, path, original = finding
+    return f"{host_name}##{var_name}##{var_value}", path, original
+
 
+def add_duplicated_var(duplicate: tuple[str, str, str], context: Context):
+    key, path, original = duplicate
+    context.all_duplicated_vars[key].locations.add(path)
+    context.all_duplicated_vars[key].original = original
 
-def check_entity_for_duplicates(base_path: str, entity_type: str, entity: str, host_name: str, level: int, vars_for_host: dict[str, list[VariableValueDetails]], context: Context):
 
-    files = context.loader.find_vars_files(
-        os.path.join(base_path, entity_type), entity)
+def check_vars_for_duplicates(variables: dict, path: str, level: int, vars_for_host: dict[str, list[VariableValueDetails]], context: Context):
+    findings = []
+    for var_name, var_value in variables.items():
+        finding = check_var_for_duplication(
+            var_name, var_value, path, level, vars_for_host, context)
+        if finding:
+            findings.append(finding)
+    return findings
+
+
+def check_entity_for_duplicates(base_path: str, entity_type: str, entity: str, level: int, vars_for_host: dict[str, list[VariableValueDetails]], context: Context):
+    findings = []
+    files = find_vars_files(
+        os.path.join(base_path, entity_type), entity, context)
     for f in files:
-        contents = load_data_from_file(f, context.loader)
+        contents = load_data_from_file(f, context)
         if not isinstance(contents, dict):
             continue
-        for var_name, var_value in contents.items():
-            check_var_for_duplication(
-                var_name, var_value, host_name, f, level, vars_for_host, context)
+        findings += check_vars_for_duplicates(
+            contents, f, level, vars_for_host, context)
+    return findings
 
 
-def find_duplicated_vars(context: Context):
-    LOGGER.debug(f"find duplicated vars")
-    for inventory_path in get_inventories(context.root_dir, context.config.galaxy_dirs, context.config.skip_dirs):
-        LOGGER.debug(f"inv file {inventory_path}")
-        if "dynamic" in os.path.basename(inventory_path):
-            LOGGER.debug(f"skipping dynamic inventory file {inventory_path}")
+def check_groups_for_duplicates(groups: list, inventory: InventoryManager, inventory_path: str, context: Context):
+    """
+    Everything up to host vars only depends on the groups a host is in, so
+    this is done once for each distinct set of groups.
+    """
+    inventory_base_path = os.path.split(inventory_path)[0]
+    vars_for_groups: dict[str, list[VariableValueDetails]] = defaultdict(list)
+    findings = []
+    # 300 - inventory file or script group vars
+    for group in sort_groups(inventory.groups.values()):
+        findings += check_vars_for_duplicates(
+            group.vars, inventory_path, 300 + group.depth, vars_for_groups, context)
+    # 400 - inventory group_vars/all
+    findings += check_entity_for_duplicates(
+        inventory_base_path, "group_vars", "all", 400, vars_for_groups, context)
+    # 500 - playbook group_vars/all
+    findings += check_entity_for_duplicates(
+        context.root_dir, "group_vars", "all", 500, vars_for_groups, context)
+    # 600 - inventory group_vars/*
+    for group in groups:
+        findings += check_entity_for_duplicates(
+            inventory_base_path, "group_vars", group.name, 600 + group.depth, vars_for_groups, context)
+    # 700 - playbook group_vars/*
+    for group in groups:
+        findings += check_entity_for_duplicates(
+            context.root_dir, "group_vars", group.name, 700 + group.depth, vars_for_groups, context)
+    return vars_for_groups, findings
+
+
+def has_host_level_vars(host, inventory_path: str, context: Context):
+    inventory_base_path = os.path.split(inventory_path)[0]
+    return (
+        any(not context.config.var_filter.skip(x) for x in host.vars.keys())
+        or find_vars_files(os.path.join(inventory_base_path, "host_vars"), host.name, context)
+        or find_vars_files(os.path.join(context.root_dir, "host_vars"), host.name, context))
+
+
+def check_host_for_duplicates(host, vars_for_groups: dict[str, list[VariableValueDetails]], group_findings: list, inventory_path: str, context: Context) -> list[tuple[str, str, str]]:
+    """The duplicates of the host, in the order they are added."""
+    inventory_base_path = os.path.split(inventory_path)[0]
+    vars_for_host: dict[str, list[VariableValueDetails]] = defaultdict(
+        list, {k: list(v) for k, v in vars_for_groups.items()})
+    duplicates = [get_duplicate(host.name, x) for x in group_findings]
+    # 800 - inventory file or script host vars
+    for finding in check_vars_for_duplicates(host.vars, host.name, 800, vars_for_host, context):
+        duplicates.append(get_duplicate(inventory_path, finding))
+    # 900 - inventory host_vars/*
+    for finding in check_entity_for_duplicates(inventory_base_path, "host_vars", host.name, 900, vars_for_host, context):
+        duplicates.append(get_duplicate(host.name, finding))
+    # 1000 - playbook host_vars/*
+    for finding in check_entity_for_duplicates(context.root_dir, "host_vars", host.name, 1000, vars_for_host, context):
+        duplicates.append(get_duplicate(host.name, finding))
+    return duplicates
+
+
+def get_host_duplicates(inventory_path: str, context: Context, partition: int = 0,
+                        partitions: int = 1) -> Iterator[tuple[int, list[tuple[str, str, str]]]]:
+    """
+    (position of the host in the inventory, its duplicates) for the hosts
+    in the partition. Hosts are partitioned by their set of groups, round
+    robin in the order the sets are first seen, as everything that is
+    shared between hosts only depends on that. Adding the duplicates of
+    every partition in host order gives the same findings as one partition.
+    """
+    LOGGER.debug(f"inv file {inventory_path}")
+    if "dynamic" in os.path.basename(inventory_path):
+        LOGGER.debug(f"skipping dynamic inventory file {inventory_path}")
+        return
+
+    inventory = load_inventory(inventory_path, context)
+
+    # group names in precedence order -> (vars_for_groups, findings)
+    group_chains: dict[tuple[str], tuple] = {}
+    # group names in precedence order -> partition
+    signature_partitions: dict[tuple[str], int] = {}
+    for position, host in enumerate(inventory.get_hosts()):
+        # remove all as we deal with it separately
+        groups = sort_groups(host.groups)[1:]
+        signature = tuple(x.name for x in groups)
+        if signature not in signature_partitions:
+            signature_partitions[signature] = len(
+                signature_partitions) % partitions
+        if signature_partitions[signature] != partition:
+            continue
+        LOGGER.debug(f"host {host.name}")
+        if signature not in group_chains:
+            context.counters["duplicate_group_chains"] += 1
+            group_chains[signature] = check_groups_for_duplicates(
+                groups, inventory, inventory_path, context)
+        if not has_host_level_vars(host, inventory_path, context):
+            # only the findings of its groups, without copying their vars.
+            # These are still needed as findings are merged by host across
+            # inventories before the noise is removed.
+            context.counters["duplicate_hosts_from_groups"] += 1
+            yield position, [get_duplicate(host.name, x) for x in group_chains[signature][1]]
             continue
+        yield position, check_host_for_duplicates(
+            host, *group_chains[signature], inventory_path, context)
+    LOGGER.debug(
+        f"{len(group_chains)} distinct group sets for {len(inventory.get_hosts())} hosts")
+
+
+def check_inventory_for_duplicates(inventory_path: str, context: Context):
+    for _, duplicates in get_host_duplicates(inventory_path, context):
+        for duplicate in duplicates:
+            add_duplicated_var(duplicate, context)
 
-        inventory = InventoryManager(
-            loader=context.loader, sources=inventory_path, cache=True)
-        inventory_base_path = os.path.split(inventory_path)[0]
-
-        for host in inventory.get_hosts():
-            LOGGER.debug(f"host {host.name}")
-            vars_for_host: dict[str,
-                                list[VariableValueDetails]] = defaultdict(list)
-            # remove all as we deal with it separately
-            groups = sort_groups(host.groups)[1:]
-
-            # 300 - inventory file or script group vars
-            for group in sort_groups(inventory.groups.values()):
-                for var_name, var_value in group.vars.items():
-                    check_var_for_duplication(var_name, var_value,
-                                              host.name, inventory_path, 300 + group.depth, vars_for_host, context)
-            # 400 - inventory group_vars/all
-            check_entity_for_duplicates(
-                inventory_base_path, "group_vars", "all", host.name, 400, vars_for_host, context)
-            # 500 - playbook group_vars/all
-            check_entity_for_duplicates(
-                context.root_dir, "group_vars", "all", host.name, 500, vars_for_host, context)
-            # 600 - inventory group_vars/*
-            for group in groups:
-                check_entity_for_duplicates(
-                    inventory_base_path, "group_vars", group.name, host.name, 600 + group.depth, vars_for_host, context)
-            # 700 - playbook group_vars/*
-            for group in groups:
-                check_entity_for_duplicates(
-                    context.root_dir, "group_vars", group.name, host.name, 700 + group.depth, vars_for_host, context)
-            # 800 - inventory file or script host vars
-            for var_name, var_value in host.vars.items():
-                check_var_for_duplication(var_name, var_value,
-                                          inventory_path, host.name, 800, vars_for_host, context)
-            # 900 - inventory host_vars/*
-            check_entity_for_duplicates(
-                inventory_base_path, "host_vars", host.name, host.name, 900, vars_for_host, context)
-            # 1000 - playbook host_vars/*
-            check_entity_for_duplicates(
-                context.root_dir, "host_vars", host.name, host.name, 1000, vars_for_host, context)
-
-    # reduce noise in output by not showing the same finding for multiple hosts
+
+def get_inventory_hosts(inventory_path: str, context: Context) -> list[str]:
+    if "dynamic" in os.path.basename(inventory_path):
+        return []
+    return [x.name for x in load_inventory(inventory_path, context).get_hosts()]
+
+
+def get_inventory_duplicates(inventory_path: str, context: Context) -> dict[str, DuplicatedVarInfo]:
+    """The findings of one inventory on their own, to be merged in inventory order."""
+    inventory_context = replace(
+        context, all_duplicated_vars=defaultdict(DuplicatedVarInfo))
+    check_inventory_for_duplicates(inventory_path, inventory_context)
+    return inventory_context.all_duplicated_vars
+
+
+def get_noise_key(key: str, info: DuplicatedVarInfo) -> str:
+    """The same finding for different hosts has the same noise key."""
+    return (
+        "".join(key.split("##")[1:])
+        + "##"
+        + info.original
+        + "##"
+        + "#".join(sorted(info.locations)))
+
+
+def merge_duplicated_vars(inventory_hosts: list[list[str]], inventory_duplicates: Iterable[dict[str, DuplicatedVarInfo]],
+                          context: Context, on_duplicated: Callable[[dict[str, DuplicatedVarInfo]], None] = None):
+    """
+    Combine the findings of each inventory, in inventory order, into
+    context.all_duplicated_vars. Findings for a host in more than one
+    inventory are combined, and the same finding for different hosts is
+    only kept once to reduce the noise in the output.
+
+    on_duplicated is called after each inventory with the findings that
+    are final, so they can be output before the other inventories are done.
+    Findings for a host are only final after the last inventory it is in.
+    The noise is removed in the order the findings were first found, the
+    same as when it is only done at the end, so a finding is also held
+    back until every finding before it is final.
+    """
+    last_inventory: dict[str, int] = {}
+    for i, hosts in enumerate(inventory_hosts):
+        for host_name in hosts:
+            last_inventory[host_name] = i
+
+    all_duplicated_vars: dict[str, DuplicatedVarInfo] = {}
     seen: set[str] = set()
     unique_duplicated_vars: dict[str, DuplicatedVarInfo] = {}
-    for k, v in context.all_duplicated_vars.items():
-        hash_key = (
-            "".join(k.split("##")[1:])
-            + "##"
-            + v.original
-            + "##"
-            + "#".join(sorted(v.locations)))
-        if hash_key not in seen:
-            seen.add(hash_key)
-            unique_duplicated_vars[k] = v
+    # keys in the order they were first found, the ones before next are done
+    keys: list[str] = []
+    next_key = 0
+    for i, duplicates in enumerate(inventory_duplicates):
+        for k, v in duplicates.items():
+            if k in all_duplicated_vars:
+                all_duplicated_vars[k].locations.update(v.locations)
+                all_duplicated_vars[k].original = v.original
+            else:
+                all_duplicated_vars[k] = v
+                keys.append(k)
+        final: dict[str, DuplicatedVarInfo] = {}
+        while next_key < len(keys) and last_inventory.get(keys[next_key].split("##")[0], i) <= i:
+            k = keys[next_key]
+            next_key += 1
+            v = all_duplicated_vars[k]
+            noise_key = get_noise_key(k, v)
+            if noise_key not in seen:
+                seen.add(noise_key)
+                final[k] = v
+        unique_duplicated_vars.update(final)
+        if on_duplicated is not None and final:
+            on_duplicated(final)
     context.all_duplicated_vars = unique_duplicated_vars
+
+
+def init_worker(root_dir: str, config_file: str, manifest: FileManifest, loader_cache_bytes: int):
+    global worker_context
+    worker_context = setup_run(root_dir, config_file, manifest)
+    loader_cache.configure(loader_cache_bytes, spill=loader_cache_bytes is not None)
+
+
+def get_partition_duplicates_in_worker(inventory_path: str, partition: int, partitions: int):
+    """
+    The hosts of the inventory, from the first partition only, and the
+    duplicates of each host in the partition. Also returns what this added
+    to the counters and timings, to merge into the main process.
+    """
+    worker_context.counters = Counter()
+    worker_context.timings = Counter()
+    hosts = get_inventory_hosts(inventory_path, worker_context) if partition == 0 else None
+    host_duplicates = list(get_host_duplicates(inventory_path, worker_context, partition, partitions))
+    return hosts, host_duplicates, worker_context.counters, worker_context.timings
+
+
+def get_duplicates_in_parallel(inventory_paths: list[str], context: Context,
+                               jobs: int) -> tuple[list[list[str]], list[dict[str, DuplicatedVarInfo]]]:
+    """
+    The hosts and findings of each inventory, the same as
+    get_inventory_hosts and get_inventory_duplicates would give. Each
+    inventory is split into enough partitions to give every process work,
+    and the duplicates of its partitions are added in host order so the
+    findings do not depend on which process finished first.
+    """
+    partitions = math.ceil(jobs / len(inventory_paths))
+    tasks = [(path, partition) for path in inventory_paths for partition in range(partitions)]
+    LOGGER.debug(
+        f"finding duplicates in {len(inventory_paths)} inventories with {jobs} processes, {partitions} partitions each")
+    inventory_hosts: dict[str, list[str]] = {}
+    host_duplicates: dict[str, list[tuple[int, list[tuple[str, str, str]]]]] = defaultdict(list)
+    with ProcessPoolExecutor(max_workers=min(jobs, len(tasks)), initializer=init_worker,
+                             initargs=(context.root_dir, context.config_file, context.manifest,
+                                       # the workers share the budget of the main process
+                                       loader_cache.max_bytes // jobs if loader_cache.max_bytes is not None else None)) as executor:
+        results = executor.map(get_partition_duplicates_in_worker, [x[0] for x in tasks], [x[1] for x in tasks],
+                               [partitions] * len(tasks))
+        for (path, partition), (hosts, duplicates, counters, timings) in zip(tasks, results):
+            if partition == 0:
+                inventory_hosts[path] = hosts
+            host_duplicates[path] += duplicates
+            context.counters.update(counters)
+            context.timings.update(timings)
+
+    inventory_duplicates = []
+    for path in inventory_paths:
+        inventory_context = replace(
+            context, all_duplicated_vars=defaultdict(DuplicatedVarInfo))
+        for _, duplicates in sorted(host_duplicates[path], key=lambda x: x[0]):
+            for duplicate in duplicates:
+                add_duplicated_var(duplicate, inventory_context)
+        inventory_duplicates.append(inventory_context.all_duplicated_vars)
+    return [inventory_hosts[x] for x in inventory_paths], inventory_duplicates
+
+
+def find_duplicated_vars(context: Context, on_duplicated: Callable[[dict[str, DuplicatedVarInfo]], None] = None,
+                         jobs: int = 1):
+    """
+    See merge_duplicated_vars for on_duplicated. With more than one job
+    the inventories are checked in other processes and the findings are
+    only final once they are all done.
+    """
+    LOGGER.debug(f"find duplicated vars")
+    with timed("duplicated_vars", context):
+        inventory_paths = context.manifest.get(INVENTORIES)
+        static_paths = [x for x in inventory_paths if "dynamic" not in os.path.basename(x)]
+        if jobs > 1 and static_paths:
+            merge_duplicated_vars(
+                *get_duplicates_in_parallel(static_paths, context, jobs), context, on_duplicated)
+        else:
+            merge_duplicated_vars(
+                [get_inventory_hosts(x, context) for x in inventory_paths],
+                (get_inventory_duplicates(x, context) for x in inventory_paths),
+                context, on_duplicated)
+    LOGGER.debug(
+        f"vars files lookups {context.counters['vars_files_lookups']} cache hits {context.counters['vars_files_cache_hits']}, "
+        f"inventory loads {context.counters['inventory_loads']} cache hits {context.counters['inventory_cache_hits']}")
@@ -0,0 +1,36 @@
+import yaml
+from ansible.utils.unsafe_proxy import wrap_var
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    # pyyaml built without libyaml
+    from yaml import SafeLoader
+
+# Anything that needs decrypting is left to the DataLoader
+VAULT_MARKERS = (b"$ANSIBLE_VAULT", b"!vault")
+
+
+class FastLoader(SafeLoader):
+    """
+    The safe loader plus the one ansible tag that can be constructed
+    without the DataLoader. Strings are plain str rather than ansible's
+    position tracking subclasses, which little-timmy does not use.
+    """
+
+
+def construct_unsafe(loader: FastLoader, node: yaml.Node):
+    # the same type the DataLoader gives for this ansible version
+    return wrap_var(loader.construct_scalar(node))
+
+
+FastLoader.add_constructor("!unsafe", construct_unsafe)
+
+
+def needs_data_loader(data: bytes) -> bool:
+    return any(x in data for x in VAULT_MARKERS)
+
+
+def fast_load(data: bytes):
+    """Raises yaml.YAMLError for anything it cannot load, including unknown tags."""
+    return yaml.load(data, Loader=FastLoader)
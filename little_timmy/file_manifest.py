@@ -0,0 +1,290 @@
+import logging
+import os
+import re
+
+LOGGER = logging.getLogger("little-timmy")
+
+YAML_FILE_EXTENSION_GLOB = "*y*ml"
+
+GROUP_VARS = "group_vars"
+HOST_VARS = "host_vars"
+VARS = "vars"
+DEFAULTS = "defaults"
+INVENTORIES = "inventories"
+PLAYBOOKS = "playbooks"
+TASKS = "tasks"
+HANDLERS = "handlers"
+TEMPLATES = "templates"
+MOLECULE = "molecule"
+FILTER_PLUGINS = "filter_plugins"
+
+# how excluded dirs are matched against a relative directory
+SUBSTRING = "substring"
+COMPONENT = "component"
+DIR_MATCHING = [SUBSTRING, COMPONENT]
+
+
+def translate_glob(search_glob: str) -> re.Pattern:
+    """
+    Convert a recursive glob, relative to the root dir, into a regex over
+    "/" separated relative paths. Mirrors glob.iglob(recursive=True) so
+    `**` and wildcards do not match hidden names unless the pattern does.
+    """
+    segments = [x for x in search_glob.strip("/").split("/") if x]
+    regex = ""
+    for i, segment in enumerate(segments):
+        last = i == len(segments) - 1
+        if segment == "**":
+            if last:
+                regex += r"(?:(?!\.)[^/]*(?:/(?!\.)[^/]*)*)?"
+            else:
+                regex += r"(?:(?!\.)[^/]*/)*"
+            continue
+        regex += translate_glob_segment(segment)
+        if not last:
+            regex += "/"
+    return re.compile(regex + r"\Z")
+
+
+def translate_glob_segment(segment: str) -> str:
+    regex = "" if segment.startswith(".") else r"(?!\.)"
+    i = 0
+    while i < len(segment):
+        char = segment[i]
+        i += 1
+        if char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "[":
+            end = segment.find("]", i + 1 if segment[i:i + 1] in ("!", "]") else i)
+            if end == -1:
+                regex += r"\["
+                continue
+            chars = segment[i:end].replace("\\", "\\\\")
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            regex += f"[{chars}]"
+            i = end + 1
+        else:
+            regex += re.escape(char)
+    return regex
+
+
+def literal_prefix(search_glob: str) -> list[str]:
+    prefix = []
+    for segment in search_glob.strip("/").split("/"):
+        if not segment or any(x in segment for x in "*?["):
+            break
+        prefix.append(segment)
+    return prefix
+
+
+class DirMatcher():
+    """
+    Whether a "/" separated directory, relative to the root dir, is excluded
+    by any of dirs. With substring matching a dir excludes any directory
+    containing it anywhere, so `tests` also excludes `contests`. With
+    component matching it has to be whole path components. Compiled once
+    into a single regex.
+    """
+    dirs: list[str]
+
+    def __init__(self, dirs: list[str], dir_matching: str = SUBSTRING):
+        self.dirs = dirs
+        if dir_matching not in DIR_MATCHING:
+            raise ValueError(f"unknown dir matching {dir_matching}")
+        self.pattern = None
+        if dirs:
+            alternatives = "|".join(re.escape(x) for x in dirs)
+            if dir_matching == COMPONENT:
+                alternatives = f"(?:^|/)(?:{alternatives})(?:/|$)"
+            self.pattern = re.compile(alternatives)
+        # whether each file is in an excluded directory, by absolute path
+        self.files: dict[str, bool] = {}
+
+    def matches(self, relative_dir: str) -> bool:
+        return self.pattern is not None and self.pattern.search(relative_dir) is not None
+
+    def matches_file(self, path: str, root_dir: str) -> bool:
+        """For the directory of a file, only worked out once per file."""
+        excluded = self.files.get(path)
+        if excluded is None:
+            relative_dir = os.path.dirname(os.path.relpath(path, root_dir)).replace(os.sep, "/")
+            excluded = self.files[path] = self.matches(relative_dir)
+        return excluded
+
+
+class FileCategory():
+    name: str
+    globs: list[str]
+    dirs_to_exclude: list[str]
+    files: bool
+
+    def __init__(self, name: str, globs: list[str], dirs_to_exclude: list[str], files: bool = True,
+                 dir_matching: str = SUBSTRING):
+        self.name = name
+        self.globs = globs
+        self.dirs_to_exclude = dirs_to_exclude
+        self.files = files
+        self.excluded = DirMatcher(dirs_to_exclude, dir_matching)
+        self.patterns = [translate_glob(x) for x in globs]
+        self.prefixes = [literal_prefix(x) for x in globs]
+        self.needs_hidden_dirs = any(
+            segment.startswith(".") for x in globs for segment in x.strip("/").split("/")[:-1])
+
+    def is_excluded(self, relative_dir: str) -> bool:
+        return self.excluded.matches(relative_dir)
+
+    def could_match_below(self, relative_parts: list[str]) -> bool:
+        for prefix in self.prefixes:
+            depth = min(len(prefix), len(relative_parts))
+            if prefix[:depth] == relative_parts[:depth]:
+                return True
+        return False
+
+
+def get_file_categories(galaxy_dirs: list[str], skip_dirs: list[str], playbook_globs: list[str], template_globs: list[str],
+                        dir_matching: str = SUBSTRING) -> list[FileCategory]:
+    """
+    The order here is the order files are processed in by the finders.
+    Galaxy dirs are only read from for variable consumption so are not
+    excluded from vars, defaults, tasks, handlers or templates.
+    """
+    without_galaxy = skip_dirs
+    with_galaxy = skip_dirs + galaxy_dirs
+
+    def category(name: str, globs: list[str], dirs_to_exclude: list[str], files: bool = True) -> FileCategory:
+        return FileCategory(name, globs, dirs_to_exclude, files, dir_matching)
+
+    return [
+        category(GROUP_VARS, [f"/**/group_vars/**/{YAML_FILE_EXTENSION_GLOB}"], with_galaxy),
+        category(HOST_VARS, [f"/**/host_vars/**/{YAML_FILE_EXTENSION_GLOB}"], with_galaxy),
+        category(VARS, [f"/**/vars/**/{YAML_FILE_EXTENSION_GLOB}"], without_galaxy),
+        category(DEFAULTS, [f"/**/defaults/**/{YAML_FILE_EXTENSION_GLOB}"], without_galaxy),
+        category(INVENTORIES, ["/inventory/**/*", "/inventories/**/*"],
+                 with_galaxy + ["group_vars", "host_vars", "files", "templates"]),
+        category(PLAYBOOKS, playbook_globs, with_galaxy),
+        category(TASKS, [f"/**/tasks/**/{YAML_FILE_EXTENSION_GLOB}"], without_galaxy),
+        category(HANDLERS, [f"/**/handlers/**/{YAML_FILE_EXTENSION_GLOB}"], without_galaxy),
+        category(TEMPLATES, template_globs, without_galaxy),
+        # local molecule folder is for variable consumption only
+        category(MOLECULE, [f"/molecule/**/{YAML_FILE_EXTENSION_GLOB}"], galaxy_dirs),
+        category(FILTER_PLUGINS, ["/**/filter_plugins"], without_galaxy, files=False),
+    ]
+
+
+class FileManifest():
+    """
+    Absolute paths of everything found in the root dir, bucketed by
+    category. A path can be in more than one category.
+    """
+    root_dir: str
+    categories: dict[str, list[str]]
+
+    def __init__(self, root_dir: str, categories: dict[str, list[str]]):
+        self.root_dir = root_dir
+        self.categories = categories
+
+    def get(self, category: str) -> list[str]:
+        return self.categories.get(category, [])
+
+    def files_by_path(self, category_names: list[str] = None) -> dict[str, list[str]]:
+        """Paths in category order with all of the categories each path is in."""
+        paths: dict[str, list[str]] = {}
+        for name, category_paths in self.categories.items():
+            if category_names is not None and name not in category_names:
+                continue
+            for path in category_paths:
+                paths.setdefault(path, []).append(name)
+        return paths
+
+    def update_path(self, path: str, category_names: list[str]):
+        """Move a path to the given categories, keeping the walk order."""
+        parts = path.split("/")
+        for name, category_paths in self.categories.items():
+            if path in category_paths:
+                category_paths.remove(path)
+            if name in category_names:
+                index = next((i for i, x in enumerate(category_paths)
+                             if x.split("/") > parts), len(category_paths))
+                category_paths.insert(index, path)
+
+
+def walks_into(relative_parts: list[str], categories: list[FileCategory]) -> bool:
+    """Whether build_file_manifest would walk into a directory, given by its relative path components."""
+    relative_dir = "/".join(relative_parts)
+    hidden = any(x.startswith(".") for x in relative_parts)
+    return any(
+        not x.is_excluded(relative_dir) and x.could_match_below(relative_parts) and (not hidden or x.needs_hidden_dirs)
+        for x in categories)
+
+
+def classify_path(root_dir: str, path: str, categories: list[FileCategory]) -> list[str]:
+    """The categories a single file would be found in by build_file_manifest."""
+    if not os.path.isfile(path):
+        return []
+    relative_path = os.path.relpath(path, root_dir).replace(os.sep, "/")
+    if relative_path.startswith("../"):
+        return []
+    relative_dir = os.path.dirname(relative_path)
+    return [
+        x.name for x in categories
+        if x.files and not x.is_excluded(relative_dir) and any(p.match(relative_path) for p in x.patterns)]
+
+
+def build_file_manifest(root_dir: str, categories: list[FileCategory]) -> FileManifest:
+    """
+    Walk root_dir once, pruning any directory that no category can match in,
+    and match every entry against all of the active category globs.
+    """
+    # per category, per glob, to keep the glob order for configured globs
+    found: dict[str, list[dict[str, None]]] = {
+        x.name: [{} for _ in x.globs] for x in categories}
+
+    def walk(abs_dir: str, relative_parts: list[str], active: list[FileCategory], ancestors: tuple[str]):
+        # symlinks are followed like glob does, but never back up the tree
+        real_dir = os.path.realpath(abs_dir)
+        if real_dir in ancestors:
+            return
+        ancestors = ancestors + (real_dir,)
+        try:
+            with os.scandir(abs_dir) as it:
+                entries = sorted(it, key=lambda x: x.name)
+        except OSError:
+            return
+
+        relative_dir = "/".join(relative_parts)
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+                is_file = not is_dir and entry.is_file()
+            except OSError:
+                continue
+            relative_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+            for category in active:
+                if not (is_file if category.files else is_dir):
+                    continue
+                for i, pattern in enumerate(category.patterns):
+                    if pattern.match(relative_path):
+                        found[category.name][i][os.path.abspath(entry.path)] = None
+            if not is_dir:
+                continue
+            child_parts = relative_parts + [entry.name]
+            child_active = [
+                x for x in active
+                if not x.is_excluded(relative_path) and x.could_match_below(child_parts)
+                and (not entry.name.startswith(".") or x.needs_hidden_dirs)]
+            if child_active:
+                walk(entry.path, child_parts, child_active, ancestors)
+
+    walk(root_dir, [], [x for x in categories if not x.is_excluded("")], ())
+
+    manifest: dict[str, list[str]] = {}
+    for name, per_glob in found.items():
+        paths: dict[str, None] = {}
+        for glob_paths in per_glob:
+            paths.update(glob_paths)
+        manifest[name] = list(paths.keys())
+        LOGGER.debug(f"found {len(manifest[name])} {name}")
+    return FileManifest(root_dir, manifest)
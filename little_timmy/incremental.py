@@ -0,0 +1,105 @@
+import logging
+import os
+import subprocess
+
+from .analysis_cache import AnalysisCache, file_stat
+from .config_loader import Config, Context, FileAnalysis
+from .file_manifest import FileManifest, classify_path, get_file_categories
+from .unused_var_finder import CATEGORY_PARSERS, add_file_analysis, analyse_files, remove_file_analysis, set_unused_vars
+from .utils import forget_files
+
+LOGGER = logging.getLogger("little-timmy")
+
+
+def run_git(root_dir: str, args: list[str]) -> list[str]:
+    try:
+        result = subprocess.run(["git"] + args, cwd=root_dir,
+                                check=True, capture_output=True, text=True)
+    except (OSError, subprocess.CalledProcessError) as err:
+        raise ValueError(f"git {' '.join(args)} failed in {root_dir}") from err
+    return [x for x in result.stdout.splitlines() if x]
+
+
+def get_changed_paths(root_dir: str, ref: str = None, paths: list[str] = None) -> set[str]:
+    """
+    Absolute paths of files changed since ref, including uncommitted and
+    untracked files, plus any paths given explicitly.
+    """
+    changed = {os.path.abspath(x) for x in paths or []}
+    if ref:
+        # no renames so the old path is listed as deleted
+        relative_paths = run_git(
+            root_dir, ["diff", "--name-only", "--no-renames", "--relative", ref, "--"])
+        relative_paths += run_git(
+            root_dir, ["ls-files", "--others", "--exclude-standard"])
+        changed.update(os.path.abspath(os.path.join(root_dir, x))
+                       for x in relative_paths)
+    LOGGER.debug(f"{len(changed)} changed files")
+    return changed
+
+
+def get_stale_paths(file_stats: dict[str, list[int]]) -> set[str]:
+    """
+    The files in the index that have changed or gone since it was saved,
+    whether or not they were said to have changed.
+    """
+    stale = {path for path, stat in file_stats.items() if file_stat(path) != stat}
+    LOGGER.debug(f"{len(stale)} files changed since the index was saved")
+    return stale
+
+
+def update_manifest(manifest: FileManifest, changed_paths: set[str], config: Config):
+    categories = get_file_categories(
+        config.galaxy_dirs, config.skip_dirs, config.playbook_globs, config.template_globs, config.dir_matching)
+    for path in changed_paths:
+        manifest.update_path(path, classify_path(
+            manifest.root_dir, path, categories))
+
+
+def get_touched_vars(paths: set[str], file_analyses: dict[str, FileAnalysis]) -> set[str]:
+    touched_vars: set[str] = set()
+    for path in paths:
+        if path in file_analyses:
+            touched_vars.update(file_analyses[path].declared)
+            touched_vars.update(file_analyses[path].referenced)
+    return touched_vars
+
+
+def reanalyse_files(context: Context, changed_paths: set[str], jobs: int = 1, cache: AnalysisCache = None) -> set[str]:
+    """
+    Swap out the contributions of the changed files in the context for a
+    fresh analysis of them. The manifest must already be up to date.
+    Returns the variables declared or referenced by the changed files,
+    before or after the changes.
+    """
+    forget_files(changed_paths, context)
+    touched_vars = get_touched_vars(changed_paths, context.file_analyses)
+    for path in changed_paths:
+        remove_file_analysis(path, context)
+
+    files = {
+        path: categories for path, categories in context.manifest.files_by_path(list(CATEGORY_PARSERS.keys())).items()
+        if path in changed_paths}
+    LOGGER.debug(f"re-analysing {len(files)} changed files")
+    for path, analysis in analyse_files(files, context, jobs, cache):
+        add_file_analysis(path, analysis, context)
+    touched_vars.update(get_touched_vars(changed_paths, context.file_analyses))
+
+    set_unused_vars(context)
+    return touched_vars
+
+
+def find_unused_vars_since(context: Context, file_analyses: dict[str, FileAnalysis], changed_paths: set[str], jobs: int = 1, cache: AnalysisCache = None) -> set[str]:
+    """Start from the analyses of a previous complete run and only re-analyse the changed files."""
+    for path, analysis in file_analyses.items():
+        add_file_analysis(path, analysis, context)
+    return reanalyse_files(context, changed_paths, jobs, cache)
+
+
+def keep_changed_findings(context: Context, touched_vars: set[str], changed_paths: set[str]):
+    """Only report findings for variables or files touched by the changes."""
+    context.all_unused_vars = {
+        k: v for k, v in context.all_unused_vars.items() if k in touched_vars}
+    context.all_duplicated_vars = {
+        k: v for k, v in context.all_duplicated_vars.items()
+        if k.split("##")[1] in touched_vars or v.original in changed_paths or v.locations & changed_paths}
@@ -0,0 +1,117 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+LOGGER = logging.getLogger("little-timmy")
+
+DEFAULT_PREFETCH_THREADS = 4
+# read ahead of parsing until this much is waiting to be parsed
+PREFETCH_MAX_BYTES = 64 * 1024 * 1024
+
+
+def read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class Prefetcher():
+    """
+    Reads files in a thread pool ahead of them being parsed, so waiting on
+    slow storage overlaps with parsing. Reading releases the GIL. Files are
+    read in the order given and must be taken in that order. Files that are
+    skipped over are dropped, and anything not prefetched is read when it
+    is asked for.
+
+    A thread only starts reading once less than max_bytes is waiting to be
+    taken, or when the file has already been asked for, so at most
+    max_bytes plus one file per thread is held.
+    """
+
+    def __init__(self, paths: list[str], threads: int = DEFAULT_PREFETCH_THREADS, max_bytes: int = PREFETCH_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.waiting_bytes = 0
+        self.condition = threading.Condition()
+        self.closed = False
+        self.positions = {path: i for i, path in enumerate(paths)}
+        self.next_position = 0
+        self.dropped: set[int] = set()
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="little-timmy-prefetch")
+        # the executor queue is first in first out so reads start in order
+        self.futures: list[Future] = [
+            self.executor.submit(self.prefetch, path, i) for i, path in enumerate(paths)]
+        LOGGER.debug(f"prefetching {len(paths)} files with {threads} threads")
+
+    def prefetch(self, path: str, position: int) -> bytes:
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.waiting_bytes < self.max_bytes or position < self.next_position or self.closed)
+            if self.closed or position in self.dropped:
+                return None
+        data = read_bytes(path)
+        with self.condition:
+            self.waiting_bytes += len(data)
+        return data
+
+    def release(self, future: Future):
+        if future.cancelled() or future.exception() is not None or future.result() is None:
+            return
+        with self.condition:
+            self.waiting_bytes -= len(future.result())
+            self.condition.notify_all()
+
+    def drop(self, position: int):
+        future = self.futures[position]
+        self.futures[position] = None
+        with self.condition:
+            self.dropped.add(position)
+        if not future.cancel():
+            future.add_done_callback(self.release)
+
+    def read(self, path: str) -> bytes:
+        position = self.positions.get(path)
+        if position is None or position < self.next_position:
+            return read_bytes(path)
+        for skipped in range(self.next_position, position):
+            self.drop(skipped)
+        with self.condition:
+            self.next_position = position + 1
+            self.condition.notify_all()
+        future = self.futures[position]
+        self.futures[position] = None
+        data = future.result()
+        self.release(future)
+        return data
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for position in range(self.next_position, len(self.futures)):
+            self.futures[position].cancel()
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class HeldFiles():
+    """
+    Files that were already read, handed out once each, in front of an
+    optional Prefetcher for everything else.
+    """
+
+    def __init__(self, files: dict[str, bytes], prefetcher: Prefetcher = None):
+        self.files = files
+        self.prefetcher = prefetcher
+
+    def read(self, path: str) -> bytes:
+        data = self.files.pop(path, None)
+        if data is not None:
+            return data
+        if self.prefetcher is not None:
+            return self.prefetcher.read(path)
+        return read_bytes(path)
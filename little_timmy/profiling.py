@@ -0,0 +1,45 @@
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+from .config_loader import Context
+
+DEFAULT_PROFILE_TOP = 10
+
+
+@contextmanager
+def timed(phase: str, context: Context):
+    """Add the wall time of the block to the phase. Cheap enough to always be on."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        context.timings[phase] += time.perf_counter() - start
+
+
+def get_profile(context: Context, top: int = DEFAULT_PROFILE_TOP) -> dict:
+    """
+    Phases can be nested, for example yaml_load is part of unused_vars, so
+    they do not add up to the total.
+    """
+    slowest = sorted(context.file_timings.items(),
+                     key=lambda x: x[1], reverse=True)[:top]
+    return {
+        "phases": {k: round(v, 6) for k, v in context.timings.items()},
+        "counters": dict(sorted(context.counters.items())),
+        "files": {k: len(v) for k, v in context.manifest.categories.items()},
+        "slowest_files": [{"path": path, "seconds": round(seconds, 6)} for path, seconds in slowest],
+    }
+
+
+def print_profile(profile: dict, root_dir: str, stderr=sys.stderr):
+    rows = [("phase", "seconds")] + [(k, f"{v:.3f}") for k, v in profile["phases"].items()]
+    rows += [("", ""), ("counter", "value")] + [(k, str(v)) for k, v in profile["counters"].items()]
+    rows += [("", ""), ("files", "count")] + [(k, str(v)) for k, v in profile["files"].items()]
+    rows += [("", ""), ("slowest files", "seconds")] + [
+        (os.path.relpath(x["path"], root_dir), f"""{x["seconds"]:.3f}""") for x in profile["slowest_files"]]
+    width = max(len(x[0]) for x in rows)
+    print("\n**profile**\n", file=stderr)
+    for name, value in rows:
+        print(f"{name:<{width}}  {value:>10}" if name else "", file=stderr)
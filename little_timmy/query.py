@@ -0,0 +1,52 @@
+import argparse
+import json
+import logging
+import os
+import time
+
+from .analysis_cache import VarIndex
+
+LOGGER = logging.getLogger("little-timmy")
+
+
+def run_query(args: argparse.Namespace, directory: str, stdout) -> int:
+    """
+    Look variables and files up in the index of the last run, returning 1
+    if any of them are not in it. Nothing is analysed so the answers are
+    as of that run.
+    """
+    index = VarIndex(directory)
+    try:
+        LOGGER.debug(
+            f"index saved {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(index.saved_at))}")
+        results = []
+        for name in args.names:
+            locations = index.locations(name)
+            results.append({"name": name, "type": "VAR", "used": bool(locations["referenced"]), **locations})
+        for path in args.file or []:
+            path = os.path.abspath(path)
+            file_vars = index.file_vars(path)
+            results.append({"name": path, "type": "FILE", "found": file_vars is not None,
+                            **(file_vars or {"declared": [], "referenced": []})})
+    finally:
+        index.close()
+
+    if args.json_output:
+        print(json.dumps(results, indent=4), file=stdout)
+    else:
+        for result in results:
+            if result["type"] == "VAR":
+                print(f"""{result["name"]} {"used" if result["used"] else "not used"}""", file=stdout)
+                print(f"""declared at {[os.path.relpath(x, directory) for x in result["declared"]]}""", file=stdout)
+                print(f"""referenced at {[os.path.relpath(x, directory) for x in result["referenced"]]}\n""",
+                      file=stdout)
+            else:
+                print(os.path.relpath(result["name"], directory), file=stdout)
+                print(f"""declares {result["declared"]}""", file=stdout)
+                print(f"""references {result["referenced"]}\n""", file=stdout)
+
+    missing = [x["name"] for x in results
+               if (x["type"] == "FILE" and not x["found"]) or (x["type"] == "VAR" and not x["declared"] and not x["referenced"])]
+    for name in missing:
+        LOGGER.warning(f"{name} is not in the index")
+    return 1 if missing else 0
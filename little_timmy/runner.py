@@ -0,0 +1,149 @@
+import argparse
+import logging
+import json
+import os
+import sys
+import time
+
+from .analysis_cache import clear_cache, open_analysis_cache
+from .config_loader import Context, find_and_load_config, setup_run
+from .duplicated_var_finder import find_duplicated_vars
+from .incremental import find_unused_vars_since, get_changed_paths, get_stale_paths, get_touched_vars, keep_changed_findings, update_manifest
+from .profiling import get_profile, print_profile, timed
+from .streaming import NDJSON, FindingWriter, create_writer
+from .unused_var_finder import find_unused_vars
+from .utils import bound_memory
+
+LOGGER = logging.getLogger("little-timmy")
+
+
+def analyse(args: argparse.Namespace, directory: str, writer: FindingWriter = None,
+            keep_file_analyses: bool = False) -> Context:
+    """
+    Find everything asked for in args, using and updating the cache.
+    Findings are written to writer as soon as they are final, unless only
+    the findings for changed files are kept, which is only known at the end.
+    What each file declares and references is kept in the context when
+    keep_file_analyses is set, for serve, or something else in args needs it.
+    """
+    start = time.perf_counter()
+    changed_paths = None
+    if args.changed_since or args.changed_file:
+        changed_paths = get_changed_paths(
+            directory, args.changed_since, args.changed_file)
+
+    if args.clear_cache:
+        clear_cache(directory)
+    cache = None
+    index = None
+    if args.cache and args.unused_vars:
+        config = find_and_load_config(directory, args.config_file)
+        cache = open_analysis_cache(directory, config)
+        if changed_paths is not None and cache is not None:
+            index = cache.load_index()
+        if index is not None:
+            changed_paths.update(get_stale_paths(index[2]))
+            update_manifest(index[0], changed_paths, config)
+        else:
+            LOGGER.debug("no index to start from, analysing everything")
+
+    context = setup_run(directory, args.config_file,
+                        index[0] if index is not None else None)
+    bound_memory(context, args.max_memory)
+    context.keep_file_analyses = (keep_file_analyses or args.watch
+                                  or cache is not None or changed_paths is not None)
+    if changed_paths is not None:
+        writer = None
+    jobs = get_jobs(args)
+    if args.unused_vars:
+        if index is not None:
+            touched_vars = find_unused_vars_since(
+                context, index[1], changed_paths, jobs, cache)
+        else:
+            find_unused_vars(context, jobs, cache, args.prefetch_threads)
+            touched_vars = get_touched_vars(
+                changed_paths or set(), context.file_analyses)
+        if cache is not None:
+            cache.save_index(context.manifest, context.file_analyses)
+            cache.close()
+        if writer is not None:
+            writer.write_unused_vars(context.all_unused_vars)
+    if args.duplicated_vars:
+        find_duplicated_vars(
+            context, writer.write_duplicated_vars if writer is not None else None, jobs)
+    if changed_paths is not None:
+        keep_changed_findings(context, touched_vars, changed_paths)
+    context.timings["analyse"] += time.perf_counter() - start
+    return context
+
+
+def get_jobs(args: argparse.Namespace) -> int:
+    return args.jobs if args.jobs > 0 else os.cpu_count()
+
+
+def output_results(context: Context, args: argparse.Namespace, directory: str, stdout=sys.stdout, stderr=sys.stderr,
+                   writer: FindingWriter = None) -> int:
+    """
+    Write the findings in the format asked for in args and return the exit
+    code. Findings already written to writer are not written again.
+    """
+    with timed("output", context):
+        if args.output_format:
+            if writer is None:
+                writer = create_writer(
+                    args.output_format, stdout, directory, args.exit_success)
+            writer.write_all(context)
+            writer.close({"name": "profile", "type": "PROFILE", **get_profile(context, args.profile_top)}
+                         if args.profile else None)
+        else:
+            print_findings(context, args, directory, stdout)
+        if args.github_action:
+            print_github_action(context, args, stderr)
+    if args.profile and not args.json_output and args.output_format != NDJSON:
+        print_profile(get_profile(context, args.profile_top), directory, stderr)
+
+    exit_code = 1
+    if args.exit_success:
+        exit_code = 0
+    if not context.all_unused_vars and not context.all_duplicated_vars:
+        exit_code = 0
+        LOGGER.debug("no unused vars")
+    return exit_code
+
+
+def print_findings(context: Context, args: argparse.Namespace, directory: str, stdout):
+    if args.json_output:
+        findings = (
+            [{"name": k, "type": "UNUSED", "locations": list(v)}
+             for k, v in context.all_unused_vars.items()]
+            +
+            [{"name": k, "type": "DUPLICATED", "locations": list(v.locations), "original": v.original}
+             for k, v in context.all_duplicated_vars.items()])
+        if args.profile:
+            findings.append(
+                {"name": "profile", "type": "PROFILE", **get_profile(context, args.profile_top)})
+        print(json.dumps(findings, indent=4), file=stdout)
+    else:
+        LOGGER.info("\n**unused vars**\n")
+        for var_name, var_locations in context.all_unused_vars.items():
+            print(f"""{var_name} at {[os.path.relpath(
+                x, directory) for x in var_locations]}\n""", file=stdout)
+        LOGGER.info("\n**duplicated vars**\n")
+        for var_name, var_details in context.all_duplicated_vars.items():
+            print(f"""{var_name}""", file=stdout)
+            print(f"""at {[os.path.relpath(
+                x, directory) for x in var_details.locations]}""", file=stdout)
+            print(
+                f"""original {os.path.relpath(var_details.original, directory)}\n""", file=stdout)
+
+
+def print_github_action(context: Context, args: argparse.Namespace, stderr):
+    level = "warning" if args.exit_success else "error"
+    for var_name, var_locations in context.all_unused_vars.items():
+        for loc in var_locations:
+            msg = f"::{level} file={loc}::{var_name} is unused"
+            print(msg, file=stderr)
+    for var_name, var_details in context.all_duplicated_vars.items():
+        for loc in var_details.locations:
+            msg = f"::{level} file={loc}::{var_name} is duplicated"
+            print(msg, file=stderr)
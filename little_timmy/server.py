@@ -0,0 +1,198 @@
+import argparse
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+from dataclasses import replace
+
+from .client import INVALID_PARAMS, INVALID_REQUEST, METHOD_NOT_FOUND, PARSE_ERROR, SERVER_ERROR, WRONG_SERVER, ServerError
+from .config_loader import Context
+from .incremental import get_changed_paths, get_touched_vars, keep_changed_findings
+from .runner import get_jobs, output_results
+from .watch import expand_changed_paths, get_findings, get_watched_categories, get_watcher, update_findings
+
+LOGGER = logging.getLogger("little-timmy")
+
+
+def get_param(params: dict, name: str, param_type: type):
+    if not isinstance(params.get(name), param_type):
+        raise ServerError(INVALID_PARAMS, f"{name} must be a {param_type.__name__}")
+    return params[name]
+
+
+def remove_stale_socket(path: str):
+    if not os.path.exists(path):
+        return
+    if not stat.S_ISSOCK(os.stat(path).st_mode):
+        raise ValueError(f"{path} exists and is not a socket")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            LOGGER.debug(f"removing stale socket {path}")
+            os.remove(path)
+            return
+    raise ValueError(f"a server is already listening on {path}")
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """One JSON-RPC request per line, any number per connection."""
+
+    def handle(self):
+        for line in self.rfile:
+            response = self.server.handle_message(line)
+            if response is not None:
+                self.wfile.write(json.dumps(response).encode() + b"\n")
+                self.wfile.flush()
+
+
+class LittleTimmyServer(socketserver.UnixStreamServer):
+    """
+    Holds the context of a complete run and answers requests from it.
+    Requests are handled one at a time and any files changed since the
+    last request are re-analysed first. The watcher runs for as long as
+    the server, so with inotify nothing is walked to find them.
+    """
+
+    def __init__(self, socket_path: str, context: Context, args: argparse.Namespace, parser: argparse.ArgumentParser):
+        self.context = context
+        self.args = args
+        self.parser = parser
+        self.running = True
+        self.watcher = get_watcher(context.root_dir, get_watched_categories(context))
+        self.methods = {
+            "findings": self.findings,
+            "is_used": self.is_used,
+            "locations": self.locations,
+            "reanalyse": self.reanalyse,
+            "run": self.run,
+            "shutdown": self.shutdown_server,
+        }
+        remove_stale_socket(socket_path)
+        super().__init__(socket_path, RequestHandler)
+        os.chmod(socket_path, 0o600)
+
+    def handle_message(self, line: bytes):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            return {"jsonrpc": "2.0", "id": None, "error": {"code": PARSE_ERROR, "message": "parse error"}}
+        if not isinstance(message, dict):
+            return {"jsonrpc": "2.0", "id": None, "error": {"code": INVALID_REQUEST, "message": "invalid request"}}
+        request_id = message.get("id")
+        try:
+            method = self.methods.get(message.get("method"))
+            if method is None:
+                raise ServerError(METHOD_NOT_FOUND,
+                                  f"unknown method {message.get('method')}")
+            params = message.get("params", {})
+            if not isinstance(params, dict):
+                raise ServerError(INVALID_PARAMS, "params must be an object")
+            result = method(params)
+        except ServerError as err:
+            response = {"error": {"code": err.code, "message": str(err)}}
+        except Exception as err:
+            # anything else is answered too, so the connection stays usable
+            LOGGER.exception(f"failed to handle {message.get('method')}")
+            response = {"error": {"code": SERVER_ERROR, "message": str(err) or type(err).__name__}}
+        else:
+            response = {"result": result}
+        # notifications do not get a response
+        if "id" not in message:
+            return None
+        return {"jsonrpc": "2.0", "id": request_id, **response}
+
+    def refresh(self, paths: set[str] = None):
+        changed_paths = expand_changed_paths(
+            self.watcher.changes() | (paths or set()), self.context)
+        if not changed_paths:
+            return [], []
+        LOGGER.debug(f"re-analysing {len(changed_paths)} changed files")
+        return update_findings(self.context, changed_paths, self.args.unused_vars,
+                               self.args.duplicated_vars, get_jobs(self.args))
+
+    def findings(self, params: dict):
+        self.refresh()
+        return list(get_findings(self.context).values())
+
+    def locations(self, params: dict):
+        name = get_param(params, "name", str)
+        self.refresh()
+        return {
+            "declared": sorted(self.context.all_declared_vars.get(name, [])),
+            "referenced": sorted(self.context.all_referenced_vars.get(name, [])),
+        }
+
+    def is_used(self, params: dict):
+        result = self.locations(params)
+        return {"used": bool(result["referenced"]), **result}
+
+    def reanalyse(self, params: dict):
+        cwd = params.get("cwd", os.getcwd())
+        paths = {os.path.abspath(os.path.join(cwd, x))
+                 for x in get_param(params, "paths", list)}
+        added, removed = self.refresh(paths)
+        return {"added": added, "removed": removed}
+
+    def run(self, params: dict):
+        """A normal run, with the same arguments and output as running locally."""
+        argv = get_param(params, "argv", list)
+        cwd = get_param(params, "cwd", str)
+        try:
+            args = self.parser.parse_args(argv)
+        except SystemExit:
+            raise ServerError(INVALID_PARAMS, f"invalid arguments {argv}")
+        directory = os.path.abspath(os.path.join(cwd, args.directory))
+        config_file = os.path.abspath(os.path.join(
+            cwd, args.config_file)) if args.config_file else None
+        server_config_file = os.path.abspath(
+            self.args.config_file) if self.args.config_file else None
+        # a check the server was started without has no results to answer from
+        missing_check = ((args.unused_vars and not self.args.unused_vars)
+                         or (args.duplicated_vars and not self.args.duplicated_vars))
+        if (os.path.realpath(directory) != os.path.realpath(self.context.root_dir)
+                or config_file != server_config_file or args.watch or args.clear_cache or missing_check):
+            raise ServerError(
+                WRONG_SERVER, f"server is for {self.context.root_dir} with config {server_config_file}")
+
+        self.refresh()
+        context = replace(self.context)
+        if not args.unused_vars:
+            context.all_unused_vars = {}
+        if not args.duplicated_vars:
+            context.all_duplicated_vars = {}
+        if args.changed_since or args.changed_file:
+            changed_paths = get_changed_paths(
+                directory, args.changed_since, [os.path.join(cwd, x) for x in args.changed_file or []])
+            keep_changed_findings(context, get_touched_vars(
+                changed_paths, context.file_analyses), changed_paths)
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        if args.output_file:
+            with open(os.path.join(cwd, args.output_file), "w") as f:
+                exit_code = output_results(context, args, directory, f, stderr)
+        else:
+            exit_code = output_results(context, args, directory, stdout, stderr)
+        return {"stdout": stdout.getvalue(), "stderr": stderr.getvalue(), "exit_code": exit_code}
+
+    def shutdown_server(self, params: dict):
+        self.running = False
+        return True
+
+
+def serve(context: Context, args: argparse.Namespace, parser: argparse.ArgumentParser):
+    server = LittleTimmyServer(args.socket, context, args, parser)
+    LOGGER.info(f"listening on {args.socket}")
+    try:
+        while server.running:
+            server.handle_request()
+    except KeyboardInterrupt:
+        LOGGER.debug("stopped serving")
+    finally:
+        server.server_close()
+        server.watcher.close()
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
@@ -0,0 +1,179 @@
+import argparse
+import json
+import logging
+import os
+from collections import Counter, OrderedDict, defaultdict
+
+from . import VERSION
+from .analysis_cache import config_fingerprint, open_analysis_cache
+from .bounded_cache import BoundedCache
+from .config_loader import Config, Context, DuplicatedVarInfo, FileAnalysis, VarLocations, find_and_load_config, setup_run
+from .duplicated_var_finder import get_inventory_duplicates, get_inventory_hosts, merge_duplicated_vars
+from .file_manifest import INVENTORIES, FileManifest
+from .profiling import timed
+from .runner import get_jobs
+from .unused_var_finder import CATEGORY_PARSERS, add_file_analysis, analyse_files, set_unused_vars
+from .utils import bound_memory
+
+LOGGER = logging.getLogger("little-timmy")
+
+PARTIAL_FORMAT = 1
+
+
+def in_shard(position: int, index: int, count: int) -> bool:
+    # round robin over the sorted manifest so every shard gets the same number of files
+    return position % count == index - 1
+
+
+def analyse_shard(args: argparse.Namespace, directory: str) -> dict:
+    """
+    Analyse this shard's share of the files and inventories. The result is
+    everything merge needs to give the same findings as a single run.
+    """
+    index, count = args.shard
+    context = setup_run(directory, args.config_file)
+    bound_memory(context, args.max_memory)
+    cache = open_analysis_cache(
+        directory, context.config) if args.cache and args.unused_vars else None
+
+    all_files = context.manifest.files_by_path(list(CATEGORY_PARSERS.keys()))
+    files = []
+    if args.unused_vars:
+        positions = {path: i for i, path in enumerate(all_files)}
+        shard_files = {path: categories for path, categories in all_files.items()
+                       if in_shard(positions[path], index, count)}
+        with timed("unused_vars", context):
+            for path, analysis in analyse_files(shard_files, context, get_jobs(args), cache, args.prefetch_threads):
+                files.append({"position": positions[path], "path": path,
+                              "declared": sorted(analysis.declared), "referenced": sorted(analysis.referenced)})
+        if cache is not None:
+            cache.close()
+
+    inventories = []
+    if args.duplicated_vars:
+        with timed("duplicated_vars", context):
+            for i, path in enumerate(context.manifest.get(INVENTORIES)):
+                if not in_shard(i, index, count):
+                    continue
+                inventories.append({
+                    "position": i,
+                    "path": path,
+                    "hosts": get_inventory_hosts(path, context),
+                    "duplicated_vars": [{"name": k, "locations": sorted(v.locations), "original": v.original}
+                                        for k, v in get_inventory_duplicates(path, context).items()],
+                })
+
+    return {
+        "format": PARTIAL_FORMAT,
+        "little_timmy": VERSION,
+        "fingerprint": config_fingerprint(None, context.config),
+        "shard": [index, count],
+        # files are absolute, inventory paths keep the directory as it was given
+        "root_dir": os.path.abspath(context.root_dir),
+        "directory": context.root_dir,
+        "unused_vars": args.unused_vars,
+        "duplicated_vars": args.duplicated_vars,
+        "total_files": len(all_files),
+        "total_inventories": len(context.manifest.get(INVENTORIES)),
+        "files": files,
+        "inventories": inventories,
+        "counters": dict(context.counters),
+        "timings": dict(context.timings),
+        "file_timings": context.file_timings,
+    }
+
+
+def rebase(value: str, partial: dict, directory: str) -> str:
+    """Partials can come from nodes with the repo checked out somewhere else."""
+    for old_root, new_root in [(partial["root_dir"], os.path.abspath(directory)), (partial["directory"], directory)]:
+        if value == old_root or value.startswith(old_root + "/"):
+            return new_root + value[len(old_root):]
+    return value
+
+
+def load_partials(paths: list[str]) -> list[dict]:
+    partials = []
+    for path in paths:
+        with open(path) as f:
+            try:
+                partials.append(json.load(f))
+            except ValueError as err:
+                raise ValueError(f"{path} is not a partial result") from err
+    if not partials:
+        raise ValueError("no partial results to merge")
+
+    first = partials[0]
+    if first.get("format") != PARTIAL_FORMAT:
+        raise ValueError(f"{paths[0]} is not a partial result from this version")
+    count = first["shard"][1]
+    for path, partial in zip(paths, partials):
+        for key in ["format", "little_timmy", "fingerprint", "unused_vars", "duplicated_vars",
+                    "total_files", "total_inventories"]:
+            if partial.get(key) != first.get(key):
+                raise ValueError(f"{path} has a different {key} to {paths[0]}")
+        if partial["shard"][1] != count:
+            raise ValueError(f"{path} is one of {partial['shard'][1]} shards, not {count}")
+    indexes = sorted(x["shard"][0] for x in partials)
+    if indexes != list(range(1, count + 1)):
+        raise ValueError(
+            f"need each of the {count} shards exactly once, got {indexes}")
+    return partials
+
+
+def merge_partials(partials: list[dict], directory: str, config: Config) -> Context:
+    """Combine the partial results of every shard, in the order a single run would have used."""
+    context = Context(
+        VarLocations(),
+        {},
+        VarLocations(),
+        defaultdict(set),
+        config,
+        "",
+        Counter(),
+        {},
+        {},
+        BoundedCache(),
+        None,
+        None,
+        OrderedDict(),
+        FileManifest(directory, {}),
+        directory,
+        Counter(),
+        {},
+    )
+    for partial in partials:
+        context.counters.update(partial["counters"])
+        context.timings.update(partial["timings"])
+        for path, seconds in partial["file_timings"].items():
+            context.file_timings[rebase(path, partial, directory)] = seconds
+
+    files = sorted(((partial, x) for partial in partials for x in partial["files"]),
+                   key=lambda x: x[1]["position"])
+    for partial, file in files:
+        add_file_analysis(rebase(file["path"], partial, directory),
+                          FileAnalysis(set(file["declared"]), set(file["referenced"])), context)
+    if partials[0]["unused_vars"]:
+        set_unused_vars(context)
+
+    inventories = sorted(((partial, x) for partial in partials for x in partial["inventories"]),
+                         key=lambda x: x[1]["position"])
+    inventory_duplicates = []
+    for partial, inventory in inventories:
+        duplicates: dict[str, DuplicatedVarInfo] = {}
+        for finding in inventory["duplicated_vars"]:
+            info = DuplicatedVarInfo()
+            info.locations = {rebase(x, partial, directory)
+                              for x in finding["locations"]}
+            info.original = rebase(
+                finding["original"], partial, directory)
+            duplicates[rebase(finding["name"], partial, directory)] = info
+        inventory_duplicates.append(duplicates)
+    merge_duplicated_vars([x["hosts"] for _, x in inventories],
+                          inventory_duplicates, context)
+    LOGGER.debug(
+        f"merged {len(files)} files and {len(inventories)} inventories from {len(partials)} shards")
+    return context
+
+
+def merge(paths: list[str], directory: str, config_file: str) -> Context:
+    return merge_partials(load_partials(paths), directory, find_and_load_config(directory, config_file))
@@ -0,0 +1,156 @@
+import json
+import os
+from abc import ABC, abstractmethod
+
+from . import VERSION
+from .config_loader import Context, DuplicatedVarInfo
+
+NDJSON = "ndjson"
+SARIF = "sarif"
+OUTPUT_FORMATS = [NDJSON, SARIF]
+
+SARIF_SCHEMA = "https://json.schemastore.org/sarif-2.1.0.json"
+UNUSED_RULE = "unused-var"
+DUPLICATED_RULE = "duplicated-var"
+SARIF_RULES = [
+    {
+        "id": UNUSED_RULE,
+        "name": "UnusedVariable",
+        "shortDescription": {"text": "Variable is declared but never referenced"},
+    },
+    {
+        "id": DUPLICATED_RULE,
+        "name": "DuplicatedVariable",
+        "shortDescription": {"text": "Variable is set to the value it already has"},
+    },
+]
+
+
+class FindingWriter(ABC):
+    """
+    Writes findings as soon as they are final instead of once at the end.
+    Each finding is only written once, so write_all can be called at the
+    end to write anything that was not streamed.
+    """
+
+    def __init__(self, stream, root_dir: str, exit_success: bool):
+        self.stream = stream
+        self.root_dir = root_dir
+        self.level = "warning" if exit_success else "error"
+        self.written: set[tuple[str, str]] = set()
+
+    def write_unused_vars(self, unused_vars: dict[str, set[str]]):
+        for name, locations in unused_vars.items():
+            if ("UNUSED", name) not in self.written:
+                self.written.add(("UNUSED", name))
+                self.write_unused_var(name, locations)
+        self.stream.flush()
+
+    def write_duplicated_vars(self, duplicated_vars: dict[str, DuplicatedVarInfo]):
+        for name, info in duplicated_vars.items():
+            if ("DUPLICATED", name) not in self.written:
+                self.written.add(("DUPLICATED", name))
+                self.write_duplicated_var(name, info)
+        self.stream.flush()
+
+    def write_all(self, context: Context):
+        self.write_unused_vars(context.all_unused_vars)
+        self.write_duplicated_vars(context.all_duplicated_vars)
+
+    @abstractmethod
+    def write_unused_var(self, name: str, locations: set[str]):
+        pass
+
+    @abstractmethod
+    def write_duplicated_var(self, name: str, info: DuplicatedVarInfo):
+        pass
+
+    def close(self, extra: dict = None):
+        """extra is the profile, for the formats that can hold it."""
+        self.stream.flush()
+
+
+class NdjsonWriter(FindingWriter):
+    """One json object per line, the same as the items of --json-output."""
+
+    def write_line(self, item: dict):
+        self.stream.write(json.dumps(item) + "\n")
+
+    def write_unused_var(self, name: str, locations: set[str]):
+        self.write_line({"name": name, "type": "UNUSED",
+                        "locations": list(locations)})
+
+    def write_duplicated_var(self, name: str, info: DuplicatedVarInfo):
+        self.write_line({"name": name, "type": "DUPLICATED", "locations": list(
+            info.locations), "original": info.original})
+
+    def close(self, extra: dict = None):
+        if extra is not None:
+            self.write_line(extra)
+        super().close()
+
+
+class SarifWriter(FindingWriter):
+    """
+    A SARIF 2.1.0 log with one run, which can be uploaded to code scanning
+    as is. The results array is written one result at a time.
+    """
+
+    def __init__(self, stream, root_dir: str, exit_success: bool):
+        super().__init__(stream, root_dir, exit_success)
+        self.results = 0
+        header = json.dumps({
+            "$schema": SARIF_SCHEMA,
+            "version": "2.1.0",
+            "runs": [{
+                "tool": {"driver": {
+                    "name": "little-timmy",
+                    "version": VERSION,
+                    "informationUri": "https://github.com/hoo29/little-timmy",
+                    "rules": SARIF_RULES,
+                }},
+                "results": [],
+            }],
+        })
+        # everything up to the empty results array, which is closed in close
+        self.stream.write(header[:header.rindex("[]")] + "[")
+
+    def get_location(self, path: str) -> dict:
+        return {"physicalLocation": {
+            "artifactLocation": {"uri": os.path.relpath(path, self.root_dir).replace(os.sep, "/")},
+            # there are no line numbers, code scanning needs a region
+            "region": {"startLine": 1},
+        }}
+
+    def write_result(self, rule_id: str, message: str, locations: list[str]):
+        result = {
+            "ruleId": rule_id,
+            "level": self.level,
+            "message": {"text": message},
+            "locations": [self.get_location(x) for x in sorted(locations)],
+        }
+        self.stream.write(("," if self.results else "") + "\n    " + json.dumps(result))
+        self.results += 1
+
+    def write_unused_var(self, name: str, locations: set[str]):
+        self.write_result(UNUSED_RULE, f"{name} is unused", locations)
+
+    def write_duplicated_var(self, name: str, info: DuplicatedVarInfo):
+        # name is host##var##value and the value may have been vaulted, so
+        # only the variable name goes into the log
+        var_name = name.split("##")[1]
+        original = os.path.relpath(info.original, self.root_dir).replace(os.sep, "/")
+        self.write_result(DUPLICATED_RULE,
+                          f"{var_name} is set to the same value as in {original}", info.locations)
+
+    def close(self, extra: dict = None):
+        self.stream.write("\n]}]}\n")
+        super().close()
+
+
+def create_writer(output_format: str, stream, root_dir: str, exit_success: bool) -> FindingWriter:
+    if output_format == NDJSON:
+        return NdjsonWriter(stream, root_dir, exit_success)
+    if output_format == SARIF:
+        return SarifWriter(stream, root_dir, exit_success)
+    raise ValueError(f"unknown output format {output_format}")
@@ -6,9 +6,11 @@ from ansible.parsing.vault import AnsibleVaultError, AnsibleVaultFormatError, An
 from jinja2 import exceptions, meta, nodes, Template
 
 from .config_loader import Context
-from .utils import skip_var
+from .profiling import timed
+from .utils import VaultedValue, decrypt_vaulted_value
 
 LOGGER = logging.getLogger("little-timmy")
+JINJA_CACHE_MAX_SIZE = 100000
 
 
 def walk_template_ast_arg(cur_node: any, context: Context):
@@ -73,19 +75,38 @@ def walk_template_ast(value: Template, context: Context):
     return more_vars
 
 
-def parse_jinja(value: any, source: str, context: Context, jinja_context: bool = False):
-
-    if isinstance(value, AnsibleUnsafe):
-        return
+def find_referenced_vars(value: any, source: str, context: Context, jinja_context: bool = False) -> frozenset[str]:
+    """
+    The same few expressions are everywhere so results are memoised per
+    run by the string and whether it is already in a jinja context.
+    """
+    try:
+        if isinstance(value, VaultedValue):
+            value = decrypt_vaulted_value(value, source, context)
+        value = str(value).strip()
+    except (AnsibleVaultError or AnsibleVaultFormatError or AnsibleVaultPasswordError) as err:
+        raise ValueError(f"Ansible vault error for file {source}") from err
 
     if jinja_context:
-        value = str(value)
         if "{{" not in value:
             # seems legit
             value = "{{ " + value + " }}"
+    elif "{{" not in value and "{%" not in value and "{#" not in value:
+        # nothing for jinja to find
+        context.counters["jinja_skipped"] += 1
+        return frozenset()
+
+    key = (value, jinja_context)
+    referenced_vars = context.jinja_cache.get(key)
+    if referenced_vars is not None:
+        context.counters["jinja_cache_hits"] += 1
+        context.jinja_cache.move_to_end(key)
+        return referenced_vars
+    context.counters["jinja_cache_misses"] += 1
 
     try:
-        parsed = context.jinja_env.parse(value)
+        with timed("jinja_parse", context):
+            parsed = context.jinja_env.parse(value)
     except (AnsibleVaultError or AnsibleVaultFormatError or AnsibleVaultPasswordError) as err:
         raise ValueError(f"Ansible vault error for file {source}") from err
     except exceptions.TemplateError as err:
@@ -94,22 +115,32 @@ def parse_jinja(value: any, source: str, context: Context, jinja_context: bool =
         # (treat it as having no variable references, similar to AnsibleUnsafe).
         # This handles !unsafe values and other unparseable content gracefully.
         LOGGER.debug(f"Skipping unparseable value in {source}: {value[:50]}... (error: {err})")
+        referenced_vars = frozenset()
+    else:
+        with timed("jinja_walk", context):
+            referenced_vars = frozenset(meta.find_undeclared_variables(parsed).union(
+                walk_template_ast(parsed, context)))
+
+    context.jinja_cache[key] = referenced_vars
+    if len(context.jinja_cache) > JINJA_CACHE_MAX_SIZE:
+        context.jinja_cache.popitem(last=False)
+    return referenced_vars
+
+
+def parse_jinja(value: any, source: str, context: Context, jinja_context: bool = False):
+
+    if isinstance(value, AnsibleUnsafe):
         return
-    referenced_vars = meta.find_undeclared_variables(parsed)
-    referenced_vars = referenced_vars.union(
-        walk_template_ast(parsed, context))
-    for referenced_var in referenced_vars:
-        context.all_referenced_vars[referenced_var].add(source)
+
+    for referenced_var in find_referenced_vars(value, source, context, jinja_context):
+        context.all_referenced_vars.add(referenced_var, source)
 
 
 def add_declared_var(var_name: str, source: str, context: Context):
-    if skip_var(var_name, context.config.magic_vars, context.config.skip_vars):
+    if context.config.var_filter.skip(var_name):
         return False
-    relative_path = os.path.dirname(os.path.relpath(source, context.root_dir))
-    external = any(
-        excluded_dir in relative_path for excluded_dir in context.config.dirs_not_to_delcare_vars_from)
-    if not external:
-        context.all_declared_vars[var_name].add(source)
+    if not context.config.not_declared_from.matches_file(source, context.root_dir):
+        context.all_declared_vars.add(var_name, source)
     return True
 
 
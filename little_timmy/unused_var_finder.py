@@ -1,118 +1,241 @@
 import logging
 import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+from dataclasses import replace
 
-from ansible.inventory.manager import InventoryManager
-
-from .config_loader import Context
+from .analysis_cache import AnalysisCache, file_digest
+from .config_loader import Context, FileAnalysis, VarLocations, setup_run
+from .file_manifest import DEFAULTS, GROUP_VARS, HANDLERS, HOST_VARS, INVENTORIES, MOLECULE, PLAYBOOKS, TASKS, TEMPLATES, VARS, FileManifest
+from .prefetch import DEFAULT_PREFETCH_THREADS, PREFETCH_MAX_BYTES, HeldFiles, Prefetcher
+from .profiling import timed
 from .taml import parse_jinja, parse_yaml_list, parse_yaml_variable
-from .utils import get_items_in_folder, load_data_from_file, get_inventories
+from .utils import load_data_from_file, load_inventory, loader_cache, read_file, read_template_file, template_too_large
 
-YAML_FILE_EXTENSION_GLOB = "*y*ml"
 LOGGER = logging.getLogger("little-timmy")
 
+# set in each worker process by init_worker
+worker_context: Context = None
 
-def find_unused_vars(context: Context) -> dict[str, set[str]]:
-    LOGGER.debug(f"find unused vars")
-    # Process all the things
-    # group_vars
-    for path in get_items_in_folder(context.root_dir, f"{context.root_dir}/**/group_vars/**/{YAML_FILE_EXTENSION_GLOB}",
-                                    context.config.galaxy_dirs, dirs_to_exclude=context.config.skip_dirs):
-        LOGGER.debug(f"group_var {path}")
-
-        contents = load_data_from_file(path, context.loader)
-        if not isinstance(contents, dict):
-            continue
-        for var_name, var_value in contents.items():
-            parse_yaml_variable(var_name, var_value, path, context)
 
-    # host_vars
-    for path in get_items_in_folder(context.root_dir, f"{context.root_dir}/**/host_vars/**/{YAML_FILE_EXTENSION_GLOB}",
-                                    context.config.galaxy_dirs, dirs_to_exclude=context.config.skip_dirs):
-        LOGGER.debug(f"host_var {path}")
-        contents = load_data_from_file(path, context.loader)
-        if not isinstance(contents, dict):
-            continue
-        for var_name, var_value in contents.items():
-            parse_yaml_variable(var_name, var_value, path, context)
+def parse_vars_file(path: str, context: Context):
+    with timed("yaml_load", context):
+        contents = load_data_from_file(path, context)
+    if not isinstance(contents, dict):
+        return
+    for var_name, var_value in contents.items():
+        parse_yaml_variable(var_name, var_value, path, context)
 
-    # vars
-    for path in get_items_in_folder(context.root_dir, f"{context.root_dir}/**/vars/**/{YAML_FILE_EXTENSION_GLOB}",
-                                    context.config.galaxy_dirs, include_ext=True, dirs_to_exclude=context.config.skip_dirs):
-        LOGGER.debug(f"var file {path}")
-        contents = load_data_from_file(path, context.loader)
-        if not isinstance(contents, dict):
-            continue
-        for var_name, var_value in contents.items():
-            parse_yaml_variable(var_name, var_value, path, context)
 
-    # defaults
-    for path in get_items_in_folder(context.root_dir, f"{context.root_dir}/**/defaults/**/{YAML_FILE_EXTENSION_GLOB}",
-                                    context.config.galaxy_dirs, include_ext=True, dirs_to_exclude=context.config.skip_dirs):
-        # exclude
-        LOGGER.debug(f"default {path}")
-        contents = load_data_from_file(path, context.loader)
-        if not isinstance(contents, dict):
-            continue
-        for var_name, var_value in contents.items():
+def parse_inventory_file(path: str, context: Context):
+    if "dynamic" in os.path.basename(path):
+        LOGGER.debug(f"skipping dynamic inventory file {path}")
+        return
+    inventory = load_inventory(path, context)
+    # groups
+    for _, group_value in inventory.groups.items():
+        # vars in group
+        for var_name, var_value in group_value.vars.items():
             parse_yaml_variable(var_name, var_value, path, context)
+        # hosts in group
+        for host in group_value.hosts:
+            # vars in host
+            for var_name, var_value in host.vars.items():
+                parse_yaml_variable(
+                    var_name, var_value, path, context)
+
+
+def parse_list_file(path: str, context: Context):
+    with timed("yaml_load", context):
+        contents = load_data_from_file(path, context)
+    parse_yaml_list(contents, path, context)
+
+
+def parse_template_file(path: str, context: Context):
+    text = read_template_file(path, context)
+    if text is not None:
+        parse_jinja(text, path, context)
 
-    # inventory
-    for path in get_inventories(context.root_dir, context.config.galaxy_dirs, context.config.skip_dirs):
-        LOGGER.debug(f"inv file {path}")
-        if "dynamic" in os.path.basename(path):
-            LOGGER.debug(f"skipping dynamic inventory file {path}")
-            continue
-        inventory = InventoryManager(loader=context.loader, sources=path)
-        # groups
-        for _, group_value in inventory.groups.items():
-            # vars in group
-            for var_name, var_value in group_value.vars.items():
-                parse_yaml_variable(var_name, var_value, path, context)
-            # hosts in group
-            for host in group_value.hosts:
-                # vars in host
-                for var_name, var_value in host.vars.items():
-                    parse_yaml_variable(
-                        var_name, var_value, path, context)
-
-    # playbooks
-    for playbook_glob in context.config.playbook_globs:
-        for path in get_items_in_folder(context.root_dir, f"{context.root_dir}{playbook_glob}",
-                                        context.config.galaxy_dirs, dirs_to_exclude=context.config.skip_dirs):
-            LOGGER.debug(f"playbook {path}")
-            contents = load_data_from_file(path, context.loader)
-            parse_yaml_list(contents, path, context)
-    
-    # tasks files
-    for path in get_items_in_folder(context.root_dir, f"{context.root_dir}/**/tasks/**/{YAML_FILE_EXTENSION_GLOB}",
-                                    context.config.galaxy_dirs, True, dirs_to_exclude=context.config.skip_dirs):
-        LOGGER.debug(f"task file {path}")
-        contents = load_data_from_file(path, context.loader)
-        parse_yaml_list(contents, path, context)
-
-    # handlers files
-    for path in get_items_in_folder(context.root_dir, f"{context.root_dir}/**/handlers/**/{YAML_FILE_EXTENSION_GLOB}",
-                                    context.config.galaxy_dirs, True, dirs_to_exclude=context.config.skip_dirs):
-        LOGGER.debug(f"handler file {path}")
-        contents = load_data_from_file(path, context.loader)
-        parse_yaml_list(contents, path, context)
-
-    # templates
-    for temlate_glob in context.config.template_globs:
-        for path in get_items_in_folder(context.root_dir, f"{context.root_dir}{temlate_glob}",
-                                        context.config.galaxy_dirs, True, dirs_to_exclude=context.config.skip_dirs):
-            LOGGER.debug(f"template file {path}")
-            with open(path, "r") as f:
-                parse_jinja(f.read(), path, context)
 
+# Process all the things, in this order
+CATEGORY_PARSERS = {
+    GROUP_VARS: parse_vars_file,
+    HOST_VARS: parse_vars_file,
+    VARS: parse_vars_file,
+    DEFAULTS: parse_vars_file,
+    INVENTORIES: parse_inventory_file,
+    PLAYBOOKS: parse_list_file,
+    TASKS: parse_list_file,
+    HANDLERS: parse_list_file,
+    TEMPLATES: parse_template_file,
     # check local molecule folder for variable consumption only
-    for path in get_items_in_folder(context.root_dir, f"{context.root_dir}/molecule/**/{YAML_FILE_EXTENSION_GLOB}",
-                                    context.config.galaxy_dirs):
-        LOGGER.debug(f"molecule file {path}")
-        contents = load_data_from_file(path, context.loader)
-        parse_yaml_list(contents, path, context)
-
-    for var_name in context.all_declared_vars.keys():
-        if var_name not in context.all_referenced_vars.keys():
-            context.all_unused_vars[var_name].update(
-                context.all_declared_vars[var_name])
+    MOLECULE: parse_list_file,
+}
+
+
+def analyse_file(path: str, categories: list[str], context: Context) -> FileAnalysis:
+    """
+    Run the parsers for every category the file is in against a copy of
+    the context with empty maps, so the results only contain this file.
+    """
+    context.counters["files_analysed"] += 1
+    context.counters["bytes_read"] += os.path.getsize(path)
+    file_context = replace(
+        context, all_declared_vars=VarLocations(), all_referenced_vars=VarLocations())
+    for category in categories:
+        LOGGER.debug(f"{category} {path}")
+        CATEGORY_PARSERS[category](path, file_context)
+    return FileAnalysis(set(file_context.all_declared_vars), set(file_context.all_referenced_vars))
+
+
+def add_file_analysis(path: str, analysis: FileAnalysis, context: Context):
+    if context.keep_file_analyses:
+        context.file_analyses[path] = analysis
+    for var_name in analysis.declared:
+        context.all_declared_vars.add(var_name, path)
+    for var_name in analysis.referenced:
+        context.all_referenced_vars.add(var_name, path)
+
+
+def remove_file_analysis(path: str, context: Context) -> FileAnalysis:
+    analysis = context.file_analyses.pop(path, None)
+    if analysis is None:
+        return None
+    for var_name in analysis.declared:
+        context.all_declared_vars.discard(var_name, path)
+    for var_name in analysis.referenced:
+        context.all_referenced_vars.discard(var_name, path)
+    return analysis
+
+
+def init_worker(root_dir: str, config_file: str, manifest: FileManifest, loader_cache_bytes: int):
+    global worker_context
+    worker_context = setup_run(root_dir, config_file, manifest)
+    loader_cache.configure(loader_cache_bytes, spill=loader_cache_bytes is not None)
+
+
+def analyse_file_in_worker(path: str, categories: list[str]):
+    """Also returns what this file added to the counters and timings, to merge into the main process."""
+    # new objects as results are only pickled once the whole chunk is done
+    worker_context.counters = Counter()
+    worker_context.timings = Counter()
+    start = time.perf_counter()
+    analysis = analyse_file(path, categories, worker_context)
+    return analysis, time.perf_counter() - start, worker_context.counters, worker_context.timings
+
+
+@contextmanager
+def prefetching(paths: list[str], context: Context, threads: int, held: dict[str, bytes] = None):
+    """
+    Reads paths ahead of them being parsed, for the files read through
+    context. Files in held were already read and are not read again.
+    """
+    with ExitStack() as stack:
+        paths = [x for x in paths if x not in (held or {})]
+        prefetcher = None
+        if threads > 0 and len(paths) > 1:
+            prefetcher = stack.enter_context(Prefetcher(paths, threads))
+        context.prefetcher = HeldFiles(held, prefetcher) if held else prefetcher
+        try:
+            yield
+        finally:
+            context.prefetcher = None
+
+
+def parse_files(files: dict[str, list[str]], context: Context, jobs: int, prefetch_threads: int = DEFAULT_PREFETCH_THREADS,
+                held: dict[str, bytes] = None):
+    if jobs <= 1 or len(files) <= 1:
+        # inventories are read by ansible
+        paths = [x for x, categories in files.items()
+                 if set(categories) - {INVENTORIES}]
+        with prefetching(paths, context, prefetch_threads, held):
+            for path, categories in files.items():
+                start = time.perf_counter()
+                analysis = analyse_file(path, categories, context)
+                context.file_timings[path] = time.perf_counter() - start
+                yield path, analysis
+        return
+
+    LOGGER.debug(f"analysing {len(files)} files with {jobs} processes")
+    paths = list(files.keys())
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                             initargs=(context.root_dir, context.config_file, context.manifest,
+                                       # the workers share the budget of the main process
+                                       loader_cache.max_bytes // jobs if loader_cache.max_bytes is not None else None)) as executor:
+        results = executor.map(analyse_file_in_worker, paths, [files[x] for x in paths],
+                               chunksize=max(1, len(paths) // (jobs * 4)))
+        for path, (analysis, seconds, counters, timings) in zip(paths, results):
+            context.file_timings[path] = seconds
+            context.counters.update(counters)
+            context.timings.update(timings)
+            yield path, analysis
+
+
+def skip_large_templates(files: dict[str, list[str]], context: Context) -> dict[str, list[str]]:
+    """
+    Templates over template_max_bytes have nothing in them, they are left
+    out before anything reads them to prefetch, digest or parse them.
+    """
+    if not context.config.template_max_bytes:
+        return files
+    return {path: categories for path, categories in files.items()
+            if categories != [TEMPLATES] or not template_too_large(path, os.path.getsize(path), context)}
+
+
+def analyse_files(files: dict[str, list[str]], context: Context, jobs: int, cache: AnalysisCache = None,
+                  prefetch_threads: int = DEFAULT_PREFETCH_THREADS):
+    analysed = skip_large_templates(files, context)
+    for path in files:
+        if path not in analysed:
+            yield path, FileAnalysis(set(), set())
+    files = analysed
+    if cache is None:
+        yield from parse_files(files, context, jobs, prefetch_threads)
+        return
+
+    digests: dict[str, str] = {}
+    uncached: dict[str, list[str]] = {}
+    # the misses read for their digest are parsed from the same bytes, up
+    # to the prefetch budget, the workers of --jobs read their own files
+    held: dict[str, bytes] = {}
+    held_bytes = 0
+    with prefetching(list(files.keys()), context, prefetch_threads):
+        for path, categories in files.items():
+            data = read_file(path, context)
+            digests[path] = file_digest(path, categories, data)
+            cached = cache.get(path, digests[path])
+            if cached is None:
+                context.counters["analysis_cache_misses"] += 1
+                uncached[path] = categories
+                if jobs <= 1 and set(categories) - {INVENTORIES} and held_bytes + len(data) <= PREFETCH_MAX_BYTES:
+                    held[path] = data
+                    held_bytes += len(data)
+            else:
+                context.counters["analysis_cache_hits"] += 1
+                yield path, cached
+
+    for path, analysis in parse_files(uncached, context, jobs, prefetch_threads, held):
+        cache.put(path, digests[path], analysis)
+        yield path, analysis
+
+
+def set_unused_vars(context: Context):
+    context.all_unused_vars.clear()
+    for var_name in context.all_declared_vars.names_not_in(context.all_referenced_vars):
+        context.all_unused_vars[var_name] = context.all_declared_vars[var_name]
+
+
+def find_unused_vars(context: Context, jobs: int = 1, cache: AnalysisCache = None,
+                     prefetch_threads: int = DEFAULT_PREFETCH_THREADS) -> dict[str, set[str]]:
+    LOGGER.debug(f"find unused vars")
+    files = context.manifest.files_by_path(list(CATEGORY_PARSERS.keys()))
+    with timed("unused_vars", context):
+        for path, analysis in analyse_files(files, context, jobs, cache, prefetch_threads):
+            add_file_analysis(path, analysis, context)
+    LOGGER.debug(
+        f"jinja cache hits {context.counters['jinja_cache_hits']} misses {context.counters['jinja_cache_misses']} "
+        f"skipped {context.counters['jinja_skipped']}")
+
+    set_unused_vars(context)
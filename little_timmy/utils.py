@@ -1,50 +1,220 @@
+import hashlib
+import io
+import logging
+import mmap
 import os
+from typing import Callable, Optional, Union
 
 from ansible.errors import AnsibleParserError
-from ansible.parsing.dataloader import DataLoader
-from ansible.parsing.vault import AnsibleVaultError, AnsibleVaultFormatError, AnsibleVaultPasswordError
-from glob import iglob
+from ansible.inventory.manager import InventoryManager
+from ansible.parsing.vault import AnsibleVaultError, AnsibleVaultFormatError, AnsibleVaultPasswordError, is_encrypted
+try:
+    # ansible >= 12 (ansible-core >= 2.19)
+    from ansible.parsing.vault import EncryptedString as VaultedValue
+except ImportError:
+    # ansible < 12 (ansible-core < 2.19)
+    from ansible.parsing.yaml.objects import AnsibleVaultEncryptedUnicode as VaultedValue
 
-# The DataLoader cache is not working so use our own basic one
-loader_cache = {}
+import yaml
 
+from .bounded_cache import PARSED_SIZE_FACTOR, BoundedCache
+from .config_loader import Context
+from .fast_yaml import fast_load, needs_data_loader
+from .prefetch import read_bytes
+from .profiling import timed
 
-def get_items_in_folder(root_dir: str, search_glob: str, galaxy_dirs: list[str], include_ext=False, dirs_to_exclude: list[str] = [], files=True):
-    if not include_ext:
-        dirs_to_exclude = dirs_to_exclude + galaxy_dirs
+LOGGER = logging.getLogger("little-timmy")
 
-    def should_exclude(path: str):
-        relative_path = os.path.dirname(os.path.relpath(path, root_dir))
-        return any(excluded_dir in relative_path for excluded_dir in dirs_to_exclude)
+# a NUL byte in this much of a template means it is binary
+TEMPLATE_SNIFF_BYTES = 8192
+JINJA_DELIMITERS = (b"{{", b"{%", b"{#")
+# the start of every vault payload, whole file or inline
+VAULT_HEADER = b"$ANSIBLE_VAULT"
 
-    return (
-        os.path.abspath(f) for f in iglob(search_glob, recursive=True)
-        if ((files and os.path.isfile(f)) or (not files and os.path.isdir(f)))
-        and not should_exclude(f)
-    )
+# The DataLoader cache is not working so use our own basic one. It is
+# bounded and spills to disk with --max-memory.
+loader_cache = BoundedCache()
+# Decrypting is deliberately slow so each vault payload is only decrypted
+# once per process. Keyed by the sha256 of the ciphertext and never written
+# to disk.
+vault_plaintexts: dict[str, str] = {}
 
 
-def load_data_from_file(path: str, loader: DataLoader):
+def decrypt(ciphertext: Union[str, bytes], source: str, context: Context, decrypter: Callable[[], str]) -> str:
+    if isinstance(ciphertext, str):
+        ciphertext = ciphertext.encode()
+    key = hashlib.sha256(ciphertext).hexdigest()
+    if key in vault_plaintexts:
+        context.counters["vault_cache_hits"] += 1
+        return vault_plaintexts[key]
+    context.counters["vault_decrypts"] += 1
     try:
-        if path not in loader_cache:
-            loader_cache[path] = loader.load_from_file(path) or {}
-        return loader_cache[path]
+        with timed("vault_decrypt", context):
+            plaintext = decrypter()
+    except (AnsibleVaultError or AnsibleVaultFormatError or AnsibleVaultPasswordError) as err:
+        raise ValueError(f"Ansible vault error for file {source}") from err
+    vault_plaintexts[key] = plaintext
+    return plaintext
+
+
+def get_ciphertext(value: VaultedValue) -> Union[str, bytes]:
+    # a hidden field, but the same in every supported ansible version
+    return value._ciphertext
+
+
+def decrypt_vaulted_value(value: VaultedValue, source: str, context: Context) -> str:
+    """An inline !vault value."""
+    return decrypt(get_ciphertext(value), source, context, lambda: str(value))
+
+
+def decrypt_file(data: bytes, path: str, context: Context) -> str:
+    """A file that is encrypted as a whole."""
+    return decrypt(data, path, context, lambda: context.loader._vault.decrypt(data).decode())
+
+
+def bound_memory(context: Context, max_memory: int = None):
+    """
+    Keep the parsed files and inventories within max_memory MiB, going by
+    their size on disk, or without a limit when it is None. Half of it is
+    for parsed files, which spill to disk, and a quarter for inventories,
+    which are parsed again when needed. The rest is left for the results.
+    """
+    max_bytes = max_memory * 1024 * 1024 if max_memory is not None else None
+    loader_cache.configure(max_bytes // 2 if max_bytes is not None else None, spill=max_bytes is not None)
+    context.inventories.configure(max_bytes // 4 if max_bytes is not None else None)
+
+
+def load_data_from_file(path: str, context: Context):
+    try:
+        contents = loader_cache.get(path)
+        if contents is None:
+            contents, vaulted = read_data_file(path, context)
+            contents = contents or {}
+            size = os.path.getsize(path) * PARSED_SIZE_FACTOR if loader_cache.max_bytes is not None else 0
+            # decrypted values must never be written to disk, so these are parsed again
+            context.counters["loader_cache_evictions"] += loader_cache.put(path, contents, size, spill=not vaulted)
+        return contents
     except (AnsibleVaultError or AnsibleVaultFormatError or AnsibleVaultPasswordError) as err:
         raise ValueError(f"Ansible vault error for file {path}") from err
     except AnsibleParserError as err:
         raise ValueError(f"Ansible parse error for file {path}") from err
 
 
-def get_inventories(path: str, galaxy_dirs: list[str], skip_dirs: list[str]):
-    for inv_folder in ["inventory", "inventories"]:
-        for path in get_items_in_folder(path, f"{path}/{inv_folder}/**/*",
-                                        galaxy_dirs, dirs_to_exclude=skip_dirs + ["group_vars", "host_vars", "files", "templates"]):
-            yield path
+def read_file(path: str, context: Context) -> bytes:
+    if context.prefetcher is not None:
+        return context.prefetcher.read(path)
+    return read_bytes(path)
+
+
+def read_template_file(path: str, context: Context) -> Optional[str]:
+    """
+    The text of a template, or None when jinja can not find anything in it:
+    it is bigger than template_max_bytes, binary or has no jinja delimiters.
+    Unless it was prefetched the file is checked with a byte scan over a
+    memory map, so only templates with jinja in them are read and decoded.
+    """
+    size = os.path.getsize(path)
+    if template_too_large(path, size, context):
+        return None
+    if context.prefetcher is not None:
+        return sniff_template(context.prefetcher.read(path), path, context)
+    if size == 0:
+        # can not be memory mapped
+        return sniff_template(b"", path, context)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return sniff_template(data, path, context)
+
+
+def template_too_large(path: str, size: int, context: Context) -> bool:
+    if context.config.template_max_bytes and size > context.config.template_max_bytes:
+        # anything it references would be reported as unused
+        LOGGER.warning(f"skipping template {path}, {size} bytes is over template_max_bytes")
+        context.counters["templates_too_large"] += 1
+        return True
+    return False
+
+
+def sniff_template(data: Union[bytes, mmap.mmap], path: str, context: Context) -> Optional[str]:
+    if b"\0" in data[:TEMPLATE_SNIFF_BYTES]:
+        LOGGER.debug(f"skipping binary template {path}")
+        context.counters["templates_binary"] += 1
+        return None
+    if all(data.find(x) == -1 for x in JINJA_DELIMITERS):
+        context.counters["templates_without_jinja"] += 1
+        return None
+    try:
+        # the same as reading the file in text mode
+        return io.TextIOWrapper(io.BytesIO(data[:])).read()
+    except UnicodeDecodeError:
+        LOGGER.debug(f"skipping binary template {path}")
+        context.counters["templates_binary"] += 1
+        return None
+
+
+def read_data_file(path: str, context: Context) -> tuple[any, bool]:
+    """The contents of the file and whether it is encrypted or has inline vaulted values."""
+    data = read_file(path, context)
+    vaulted = VAULT_HEADER in data
+    encrypted = is_encrypted(data)
+    if encrypted:
+        data = decrypt_file(data, path, context).encode()
+    if context.config.fast_yaml_loader:
+        contents = load_fast(data, context)
+        if contents is not None:
+            return contents, vaulted
+    # what DataLoader.load_from_file does after reading the file
+    return context.loader.load(data.decode("utf-8", "surrogateescape"), file_name=context.loader.path_dwim(path),
+                               show_content=not encrypted), vaulted
+
+
+def load_fast(data: bytes, context: Context):
+    """Returns None when the file has to be loaded by the DataLoader instead."""
+    if needs_data_loader(data):
+        context.counters["yaml_data_loader_fallbacks"] += 1
+        return None
+    try:
+        contents = fast_load(data)
+    except yaml.YAMLError:
+        # let the DataLoader give the error, or handle the tag
+        context.counters["yaml_data_loader_fallbacks"] += 1
+        return None
+    context.counters["yaml_fast_loads"] += 1
+    # the DataLoader treats empty files the same way
+    return contents if contents is not None else {}
+
+
+def forget_files(paths: set[str], context: Context):
+    """Drop anything cached for files that have changed during the process."""
+    for path in paths:
+        loader_cache.pop(path, None)
+        context.loader._FILE_CACHE.pop(path, None)
+        context.inventories.pop(path, None)
+    # new or deleted files change what is found
+    context.vars_files.clear()
+
+
+def load_inventory(path: str, context: Context) -> InventoryManager:
+    """Each inventory source is only parsed once per run, unless it is evicted with --max-memory."""
+    inventory = context.inventories.get(path)
+    if inventory is not None:
+        context.counters["inventory_cache_hits"] += 1
+        return inventory
+    context.counters["inventory_loads"] += 1
+    with timed("inventory_load", context):
+        inventory = InventoryManager(
+            loader=context.loader, sources=path, cache=True)
+    size = os.path.getsize(path) * PARSED_SIZE_FACTOR if context.inventories.max_bytes is not None else 0
+    context.counters["inventory_cache_evictions"] += context.inventories.put(path, inventory, size)
+    return inventory
 
 
-def skip_var(var_name: str, magic_vars: list[str], skip_vars: list[str]):
-    return (
-        var_name.startswith("ansible_") or
-        var_name in magic_vars or
-        var_name in skip_vars
-    )
+def find_vars_files(path: str, name: str, context: Context) -> list[str]:
+    """DataLoader.find_vars_files stats a lot of paths so only do it once per run."""
+    key = (path, name)
+    if key in context.vars_files:
+        context.counters["vars_files_cache_hits"] += 1
+    else:
+        context.counters["vars_files_lookups"] += 1
+        with timed("vars_files_lookup", context):
+            context.vars_files[key] = context.loader.find_vars_files(path, name)
+    return context.vars_files[key]
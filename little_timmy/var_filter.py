@@ -0,0 +1,68 @@
+import fnmatch
+import re
+
+# skip_vars entries starting with this are regular expressions
+REGEX_PREFIX = "re:"
+GLOB_CHARS = "*?["
+
+
+def compile_patterns(skip_vars: list[str]) -> list[re.Pattern]:
+    """
+    Glob and regex skip_vars as regexes matched against whole names. They
+    are combined into one unless a regex can not be, such as one starting
+    with global flags like (?i) or one with groups whose numbers would
+    change, then each is kept on its own.
+    """
+    patterns = []
+    for x in skip_vars:
+        if x.startswith(REGEX_PREFIX):
+            try:
+                re.compile(x[len(REGEX_PREFIX):])
+            except re.error as err:
+                raise ValueError(f"invalid regex in skip_vars {x}: {err}") from err
+            patterns.append(x[len(REGEX_PREFIX):])
+        elif any(c in x for c in GLOB_CHARS):
+            patterns.append(fnmatch.translate(x))
+    compiled = [re.compile(x) for x in patterns]
+    if len(compiled) <= 1 or any(x.groups for x in compiled):
+        return compiled
+    try:
+        return [re.compile("|".join(f"(?:{x})" for x in patterns))]
+    except re.error:
+        return compiled
+
+
+class VarFilter():
+    """
+    Which variables are not checked. Names are looked up in a frozenset,
+    globs and regexes in skip_vars are compiled into one regex where they
+    can be and the duplicate substrings into another, so each check costs
+    about the same no matter how many there are. The answer for each name is remembered as
+    the same few names are checked over and over.
+    """
+
+    def __init__(self, magic_vars: list[str], skip_vars: list[str], duplicate_substrings: list[str]):
+        self.names = frozenset(magic_vars) | frozenset(
+            x for x in skip_vars if not x.startswith(REGEX_PREFIX) and not any(c in x for c in GLOB_CHARS))
+        self.patterns = compile_patterns(skip_vars)
+        self.duplicate_pattern = re.compile(
+            "|".join(re.escape(x) for x in duplicate_substrings)) if duplicate_substrings else None
+        self.skipped: dict[str, bool] = {}
+        self.duplicates_skipped: dict[str, bool] = {}
+
+    def skip(self, var_name: str) -> bool:
+        skipped = self.skipped.get(var_name)
+        if skipped is None:
+            skipped = self.skipped[var_name] = (
+                var_name.startswith("ansible_")
+                or var_name in self.names
+                or any(x.fullmatch(var_name) is not None for x in self.patterns))
+        return skipped
+
+    def skip_duplicate(self, var_name: str) -> bool:
+        """skip plus the names containing any of skip_vars_duplicates_substrings."""
+        skipped = self.duplicates_skipped.get(var_name)
+        if skipped is None:
+            skipped = self.duplicates_skipped[var_name] = self.skip(var_name) or (
+                self.duplicate_pattern is not None and self.duplicate_pattern.search(var_name) is not None)
+        return skipped
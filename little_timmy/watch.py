@@ -0,0 +1,281 @@
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import struct
+import sys
+import time
+from collections import defaultdict
+
+from .config_loader import Context, DuplicatedVarInfo
+from .duplicated_var_finder import find_duplicated_vars
+from .file_manifest import FileCategory, get_file_categories, walks_into
+from .incremental import reanalyse_files, update_manifest
+from .utils import forget_files
+
+LOGGER = logging.getLogger("little-timmy")
+
+# editors write a file in several steps, wait for them to settle
+DEBOUNCE_SECONDS = 0.1
+POLL_INTERVAL_SECONDS = 0.5
+
+# from sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def get_watched_categories(context: Context) -> list[FileCategory]:
+    config = context.config
+    return get_file_categories(
+        config.galaxy_dirs, config.skip_dirs, config.playbook_globs, config.template_globs, config.dir_matching)
+
+
+def walk_watched_dirs(root_dir: str, categories: list[FileCategory], path: str = None):
+    """
+    The directories under path, root_dir by default, that the file manifest
+    is built from, so skip_dirs, such as venv, and hidden directories, such
+    as .git and the cache, are not watched. Hidden files are left out.
+    """
+    path = path or root_dir
+    relative_path = os.path.relpath(path, root_dir).replace(os.sep, "/")
+    if relative_path.startswith("../"):
+        return
+    root_parts = [] if relative_path == "." else relative_path.split("/")
+    if root_parts and not walks_into(root_parts, categories):
+        return
+    for dir_path, dir_names, file_names in os.walk(path):
+        relative_dir = os.path.relpath(dir_path, root_dir).replace(os.sep, "/")
+        parts = [] if relative_dir == "." else relative_dir.split("/")
+        dir_names[:] = sorted(x for x in dir_names if walks_into(parts + [x], categories))
+        yield dir_path, [os.path.join(dir_path, x) for x in file_names if not x.startswith(".")]
+
+
+class InotifyWatcher():
+    """Linux only, one watch per directory as inotify is not recursive."""
+
+    def __init__(self, root_dir: str, categories: list[FileCategory]):
+        self.root_dir = root_dir
+        self.categories = categories
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches: dict[int, str] = {}
+        self.add_tree(root_dir)
+        LOGGER.debug(f"watching {len(self.watches)} dirs with inotify")
+
+    def add_tree(self, path: str) -> set[str]:
+        """Watch path and everything below it, returning the files already there."""
+        files: set[str] = set()
+        for dir_path, file_paths in walk_watched_dirs(self.root_dir, self.categories, path):
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(dir_path), INOTIFY_MASK)
+            if wd < 0:
+                LOGGER.debug(f"unable to watch {dir_path}")
+                continue
+            self.watches[wd] = dir_path
+            files.update(file_paths)
+        return files
+
+    def read_events(self) -> set[str]:
+        changed: set[str] = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, treat everything as changed
+                changed.add(self.root_dir)
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches or name.startswith("."):
+                continue
+            path = os.path.join(self.watches[wd], name)
+            changed.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # files can be written before the new dir is watched
+                changed.update(self.add_tree(path))
+        return changed
+
+    def changes(self) -> set[str]:
+        """The files changed since the last call, without waiting."""
+        changed: set[str] = set()
+        while select.select([self.fd], [], [], 0)[0]:
+            changed.update(self.read_events())
+        return changed
+
+    def wait(self) -> set[str]:
+        select.select([self.fd], [], [])
+        changed = self.read_events()
+        while select.select([self.fd], [], [], DEBOUNCE_SECONDS)[0]:
+            changed.update(self.read_events())
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher():
+    """Compares the mtime and size of every file each interval."""
+
+    def __init__(self, root_dir: str, categories: list[FileCategory], interval: float = POLL_INTERVAL_SECONDS):
+        self.root_dir = root_dir
+        self.categories = categories
+        self.interval = interval
+        self.snapshot = self.take_snapshot()
+        LOGGER.debug(f"polling {len(self.snapshot)} files")
+
+    def take_snapshot(self) -> dict[str, tuple[int, int]]:
+        snapshot = {}
+        for _, file_paths in walk_watched_dirs(self.root_dir, self.categories):
+            for path in file_paths:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def poll(self) -> set[str]:
+        """The files changed since the last poll."""
+        snapshot = self.take_snapshot()
+        changed = {
+            x for x in snapshot.keys() | self.snapshot.keys()
+            if snapshot.get(x) != self.snapshot.get(x)}
+        self.snapshot = snapshot
+        return changed
+
+    def changes(self) -> set[str]:
+        return self.poll()
+
+    def wait(self) -> set[str]:
+        while True:
+            time.sleep(self.interval)
+            changed = self.poll()
+            if changed:
+                return changed
+
+    def close(self):
+        pass
+
+
+def get_watcher(root_dir: str, categories: list[FileCategory]):
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root_dir, categories)
+        except (OSError, AttributeError, TypeError) as err:
+            LOGGER.debug(f"inotify not available, polling instead: {err}")
+    return PollingWatcher(root_dir, categories)
+
+
+def expand_changed_paths(changed_paths: set[str], context: Context) -> set[str]:
+    """Changed directories stand for every file in them, before and after."""
+    expanded: set[str] = set()
+    known_paths = context.manifest.files_by_path().keys()
+    categories = get_watched_categories(context)
+    for path in changed_paths:
+        path = os.path.abspath(path)
+        if not os.path.isdir(path):
+            expanded.add(path)
+        prefix = path + os.sep
+        expanded.update(x for x in known_paths if x.startswith(prefix))
+        if os.path.isdir(path):
+            for _, file_paths in walk_watched_dirs(context.root_dir, categories, path):
+                expanded.update(file_paths)
+    return expanded
+
+
+def get_findings(context: Context) -> dict[str, dict]:
+    """Findings keyed by a stable string so two runs can be compared."""
+    findings = [
+        {"name": k, "type": "UNUSED", "locations": sorted(v)}
+        for k, v in context.all_unused_vars.items()] + [
+        {"name": k, "type": "DUPLICATED", "locations": sorted(v.locations), "original": v.original}
+        for k, v in context.all_duplicated_vars.items()]
+    return {json.dumps(x, sort_keys=True): x for x in findings}
+
+
+def print_findings_diff(added: list[dict], removed: list[dict], root_dir: str, json_output: bool):
+    if json_output:
+        print(json.dumps({"added": added, "removed": removed}), file=sys.stdout, flush=True)
+        return
+    for sign, findings in (("-", removed), ("+", added)):
+        for finding in findings:
+            var_name = finding["name"].split("##")[1] if finding["type"] == "DUPLICATED" else finding["name"]
+            message = f"""{sign} {finding["type"].lower()} {var_name} at {[os.path.relpath(
+                x, root_dir) for x in finding["locations"]]}"""
+            if finding["type"] == "DUPLICATED":
+                message += f""" original {os.path.relpath(finding["original"], root_dir)}"""
+            print(message, file=sys.stdout, flush=True)
+
+
+def update_findings(context: Context, changed_paths: set[str], unused_vars: bool = True, duplicated_vars: bool = True, jobs: int = 1):
+    """
+    Re-analyse the changed files and work out the findings again, keeping
+    everything else from the previous run. Returns (added, removed).
+    """
+    before = get_findings(context)
+    update_manifest(context.manifest, changed_paths, context.config)
+    # whichever is checked, nothing parsed from the old files can be used
+    forget_files(changed_paths, context)
+    if unused_vars:
+        reanalyse_files(context, changed_paths, jobs)
+    if duplicated_vars:
+        context.all_duplicated_vars = defaultdict(DuplicatedVarInfo)
+        find_duplicated_vars(context)
+    after = get_findings(context)
+    added = [v for k, v in after.items() if k not in before]
+    removed = [v for k, v in before.items() if k not in after]
+    return added, removed
+
+
+def watch(context: Context, unused_vars: bool = True, duplicated_vars: bool = True, json_output: bool = False, jobs: int = 1):
+    """
+    Keep everything in memory and report how the findings change on every
+    edit, starting with the findings of the first run as added.
+    """
+    print_findings_diff(list(get_findings(context).values()), [], context.root_dir, json_output)
+    watcher = get_watcher(context.root_dir, get_watched_categories(context))
+    LOGGER.info("\n**watching for changes**\n")
+    try:
+        while True:
+            changed_paths = expand_changed_paths(watcher.wait(), context)
+            if not changed_paths:
+                continue
+            if context.config_file in changed_paths:
+                LOGGER.warning(
+                    f"{context.config_file} changed, restart to use the new config")
+            start = time.perf_counter()
+            added, removed = update_findings(
+                context, changed_paths, unused_vars, duplicated_vars, jobs)
+            LOGGER.debug(
+                f"{len(changed_paths)} changed files re-analysed in {time.perf_counter() - start:.3f}s")
+            if added or removed:
+                print_findings_diff(added, removed,
+                                    context.root_dir, json_output)
+    except KeyboardInterrupt:
+        LOGGER.debug("stopped watching")
+    finally:
+        watcher.close()
@@ -1,11 +1,38 @@
 from collections import defaultdict
 import json
 import os
+import glob
+import io
+import shutil
+import socket
+import subprocess
+import sys
+import threading
 import pytest
 
-from little_timmy.config_loader import DuplicatedVarInfo, setup_run
+from little_timmy.__main__ import get_parser
+from little_timmy.analysis_cache import AnalysisCache, VarIndex, config_fingerprint
+from little_timmy.batch import read_manifest, run_batch
+from little_timmy.benchmark import STARTUP_BUDGET_SECONDS, generate_repo, measure_startup, run_benchmark
+from little_timmy import client as client_module
+from little_timmy.client import SERVER_ERROR, WRONG_SERVER, ServerError, forward_run, request
+from little_timmy.config_loader import DuplicatedVarInfo, VarLocations, jinja_envs, setup_run
 from little_timmy.duplicated_var_finder import find_duplicated_vars
+from little_timmy.file_manifest import INVENTORIES, FileCategory, build_file_manifest, translate_glob
+from little_timmy.incremental import find_unused_vars_since, update_manifest
+from little_timmy import prefetch as prefetch_module
+from little_timmy.prefetch import Prefetcher
+from little_timmy.query import run_query
+from little_timmy.runner import analyse, output_results
+from little_timmy.server import LittleTimmyServer
+from little_timmy.shard import analyse_shard, merge
+from little_timmy.streaming import FindingWriter, create_writer
+from little_timmy.taml import find_referenced_vars, parse_jinja
 from little_timmy.unused_var_finder import find_unused_vars
+from little_timmy import utils as utils_module
+from little_timmy.utils import loader_cache, vault_plaintexts
+from little_timmy import watch as watch_module
+from little_timmy.watch import get_findings, get_watched_categories, update_findings, walk_watched_dirs
 
 
 TEST_REPOS = os.path.join("tests", "repos")
@@ -58,3 +85,768 @@ def test_finds_duplicated_vars(repo):
     for k, v in actual.items():
         rel_locs = [os.path.relpath(x, context.root_dir) for x in v.locations]
         assert not expected[k].locations.symmetric_difference(set(rel_locs))
+
+
+@pytest.mark.parametrize("repo", get_test_folders(TEST_REPOS))
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_finds_same_unused_vars_in_parallel(repo):
+    serial_context = setup_run(os.path.join(TEST_REPOS, repo, "repo"))
+    find_unused_vars(serial_context)
+    parallel_context = setup_run(os.path.join(TEST_REPOS, repo, "repo"))
+    find_unused_vars(parallel_context, jobs=2)
+
+    assert parallel_context.all_unused_vars == serial_context.all_unused_vars
+    assert parallel_context.all_declared_vars == serial_context.all_declared_vars
+    assert parallel_context.all_referenced_vars == serial_context.all_referenced_vars
+
+
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_jinja_expressions_are_parsed_once():
+    context = setup_run(os.path.join(TEST_REPOS, "no_deps", "repo"))
+    assert find_referenced_vars("{{ a | default(b) }}", "x.yml", context) == {"a", "b"}
+    assert find_referenced_vars(" {{ a | default(b) }} ", "y.yml", context) == {"a", "b"}
+    assert (context.counters["jinja_cache_misses"], context.counters["jinja_cache_hits"]) == (1, 1)
+    # the same string in a jinja context, such as a when, is a different expression
+    assert find_referenced_vars("a", "x.yml", context, jinja_context=True) == {"a"}
+    assert find_referenced_vars("{% if c %}{# d #}{% endif %}", "x.yml", context) == {"c"}
+    assert context.counters["jinja_cache_misses"] == 3
+    assert len(context.jinja_cache) == 3
+
+    # strings without delimiters are never parsed or cached
+    parse_jinja("a plain string", "z.yml", context)
+    parse_jinja("a } { %", "z.yml", context)
+    assert context.counters["jinja_skipped"] == 2
+    assert context.counters["jinja_cache_misses"] == 3 and len(context.jinja_cache) == 3
+    assert "z.yml" not in {x for v in context.all_referenced_vars.values() for x in v}
+
+    # results are shared between sources, the references are not
+    parse_jinja("{{ a | default(b) }}", "w.yml", context)
+    assert context.counters["jinja_cache_hits"] == 2
+    assert context.all_referenced_vars["a"] == {"w.yml"}
+
+
+def test_var_locations_match_a_dict_of_sets():
+    var_locations = VarLocations()
+    expected: dict[str, set[str]] = defaultdict(set)
+    changes = [("a", "x.yml"), ("a", "y.yml"), ("b", "y.yml"), ("a", "x.yml"), ("c", "z.yml"), ("a", "w.yml")]
+    for var_name, path in changes:
+        var_locations.add(var_name, path)
+        expected[var_name].add(path)
+    assert var_locations == expected
+    for var_name, path in changes[:3] + [("c", "x.yml")]:
+        var_locations.discard(var_name, path)
+        expected[var_name].discard(path)
+    assert var_locations == {k: v for k, v in expected.items() if v}
+    assert "b" not in var_locations and var_locations.get("b", []) == []
+
+
+def test_prefetcher_reads_within_its_budget(tmp_path):
+    paths = []
+    for i in range(20):
+        paths.append(os.path.join(tmp_path, f"{i}.yml"))
+        with open(paths[-1], "w") as f:
+            f.write(f"var_{i}: {'x' * i}\n")
+    # a budget smaller than any file still reads each one when it is asked for
+    with Prefetcher(paths, threads=3, max_bytes=1) as prefetcher:
+        assert prefetcher.read(paths[0]) == b"var_0: \n"
+        # skipped files are dropped and reading one again reads it from disk
+        assert prefetcher.read(paths[5]) == b"var_5: xxxxx\n"
+        assert prefetcher.read(paths[2]) == b"var_2: xx\n"
+        assert prefetcher.read(paths[6]) == b"var_6: xxxxxx\n"
+        assert prefetcher.waiting_bytes <= 1 + 3 * len(b"var_19: " + b"x" * 19 + b"\n")
+
+
+@pytest.mark.parametrize("repo", get_test_folders(TEST_REPOS))
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_finds_same_vars_with_fast_yaml_loader(repo):
+    loader_cache.clear()
+    data_loader_context = setup_run(os.path.join(TEST_REPOS, repo, "repo"))
+    find_unused_vars(data_loader_context)
+    find_duplicated_vars(data_loader_context)
+    loader_cache.clear()
+    fast_context = setup_run(os.path.join(TEST_REPOS, repo, "repo"))
+    fast_context.config.fast_yaml_loader = True
+    find_unused_vars(fast_context)
+    find_duplicated_vars(fast_context)
+    loader_cache.clear()
+
+    assert fast_context.counters["yaml_fast_loads"] > 0
+    assert fast_context.all_unused_vars == data_loader_context.all_unused_vars
+    assert fast_context.all_declared_vars == data_loader_context.all_declared_vars
+    assert fast_context.all_referenced_vars == data_loader_context.all_referenced_vars
+    assert ({k: v.locations for k, v in fast_context.all_duplicated_vars.items()}
+            == {k: v.locations for k, v in data_loader_context.all_duplicated_vars.items()})
+
+
+@pytest.mark.parametrize("repo", get_test_folders(TEST_REPOS))
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_finds_same_unused_vars_from_cache(repo, tmp_path):
+    cache_path = os.path.join(tmp_path, "analysis.sqlite")
+    for expected_hits in [False, True]:
+        context = setup_run(os.path.join(TEST_REPOS, repo, "repo"))
+        cache = AnalysisCache(
+            cache_path, config_fingerprint(context.root_dir, context.config))
+        find_unused_vars(context, cache=cache)
+        cache.close()
+        assert (cache.hits > 0) == expected_hits
+        assert cache.misses == 0 or not expected_hits
+
+    uncached_context = setup_run(os.path.join(TEST_REPOS, repo, "repo"))
+    find_unused_vars(uncached_context)
+    assert context.all_unused_vars == uncached_context.all_unused_vars
+    assert context.all_referenced_vars == uncached_context.all_referenced_vars
+
+
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_runs_without_the_cache_when_it_can_not_be_written(tmp_path, caplog):
+    repo = os.path.join(tmp_path, "repo")
+    shutil.copytree(os.path.join(TEST_REPOS, "no_deps", "repo"), repo)
+    # stands in for a read only checkout, running as root ignores permissions
+    with open(os.path.join(repo, ".little-timmy-cache"), "w") as f:
+        f.write("not a directory\n")
+    analyse(get_parser().parse_args(["-j", "--changed-file", "x.yml", repo]), repo)
+    assert "running without it" in caplog.text
+    context = analyse(get_parser().parse_args(["-j", repo]), repo)
+    full_context = analyse(get_parser().parse_args(["-j", "--no-cache", repo]), repo)
+    assert context.all_unused_vars == full_context.all_unused_vars
+
+
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_finds_same_unused_vars_since_changes(tmp_path):
+    repo = os.path.join(tmp_path, "repo")
+    shutil.copytree(os.path.join(TEST_REPOS, "no_deps", "repo"), repo)
+    context = setup_run(repo)
+    find_unused_vars(context)
+    file_analyses = context.file_analyses
+
+    changed_paths = {os.path.abspath(os.path.join(repo, x)) for x in [
+        "roles/role1/tasks/main.yml", "group_vars/new.yml", "group_vars/all.yml"]}
+    with open(os.path.join(repo, "roles/role1/tasks/main.yml"), "a") as f:
+        f.write('- debug: msg="{{ role1_unused_var }}"\n')
+    with open(os.path.join(repo, "group_vars/new.yml"), "w") as f:
+        f.write("brand_new: 1\n")
+    os.remove(os.path.join(repo, "group_vars/all.yml"))
+
+    update_manifest(context.manifest, changed_paths, context.config)
+    incremental_context = setup_run(repo, manifest=context.manifest)
+    touched_vars = find_unused_vars_since(
+        incremental_context, file_analyses, changed_paths)
+    full_context = setup_run(repo)
+    find_unused_vars(full_context)
+
+    assert incremental_context.all_unused_vars == full_context.all_unused_vars
+    assert incremental_context.all_referenced_vars == full_context.all_referenced_vars
+    assert {"role1_unused_var", "brand_new", "unused_var"} <= touched_vars
+
+
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_files_changed_since_the_index_are_reanalysed(tmp_path):
+    repo = os.path.join(tmp_path, "repo")
+    shutil.copytree(os.path.join(TEST_REPOS, "no_deps", "repo"), repo)
+    context = analyse(get_parser().parse_args(["-j", repo]), repo)
+    assert "unused_var" in context.all_unused_vars
+
+    # changed without being given as changed
+    with open(os.path.join(repo, "roles/role1/tasks/main.yml"), "a") as f:
+        f.write('- debug: msg="{{ unused_var }}"\n')
+    all_yml = os.path.join(repo, "group_vars", "all.yml")
+    context = analyse(get_parser().parse_args(["-j", "--changed-file", all_yml, repo]), repo)
+    full_context = analyse(get_parser().parse_args(["-j", "--no-cache", repo]), repo)
+    assert "unused_var" not in context.all_unused_vars
+    assert context.all_referenced_vars == full_context.all_referenced_vars
+
+
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_watch_updates_findings(tmp_path):
+    repo = os.path.join(tmp_path, "repo")
+    shutil.copytree(os.path.join(TEST_REPOS, "shared_groups", "repo"), repo)
+    context = setup_run(repo)
+    find_unused_vars(context)
+    find_duplicated_vars(context)
+
+    changed_paths = {os.path.abspath(os.path.join(repo, x)) for x in [
+        "group_vars/db.yml", "host_vars/w4.yml", "playbook.yml"]}
+    with open(os.path.join(repo, "group_vars/db.yml"), "w") as f:
+        f.write("x: 2\nunused_db_var: 1\n")
+    os.remove(os.path.join(repo, "host_vars/w4.yml"))
+    with open(os.path.join(repo, "playbook.yml"), "a") as f:
+        f.write("# changed\n")
+
+    added, removed = update_findings(context, changed_paths)
+    full_context = setup_run(repo)
+    find_unused_vars(full_context)
+    find_duplicated_vars(full_context)
+
+    assert get_findings(context) == get_findings(full_context)
+    assert {x["name"] for x in added} >= {"unused_db_var"}
+    assert {x["name"] for x in removed} >= {"w4##webv##1"}
+
+
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_watch_updates_only_duplicated_vars(tmp_path):
+    repo = os.path.join(tmp_path, "repo")
+    shutil.copytree(os.path.join(TEST_REPOS, "shared_groups", "repo"), repo)
+    context = setup_run(repo)
+    find_duplicated_vars(context)
+
+    changed_paths = {os.path.join(repo, "group_vars/db.yml")}
+    with open(os.path.join(repo, "group_vars/db.yml"), "w") as f:
+        f.write("x: 2\n")
+    added, removed = update_findings(context, changed_paths, unused_vars=False)
+    full_context = setup_run(repo)
+    find_duplicated_vars(full_context)
+
+    assert get_findings(context) == get_findings(full_context)
+    assert {x["name"] for x in removed} >= {"d1##x##1"}
+
+
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_watch_skips_dirs_and_outputs_the_first_findings(tmp_path, monkeypatch, capsys):
+    repo = os.path.join(tmp_path, "repo")
+    shutil.copytree(os.path.join(TEST_REPOS, "no_deps", "repo"), repo)
+    os.makedirs(os.path.join(repo, "venv", "lib", "tasks"))
+    os.makedirs(os.path.join(repo, ".git", "objects"))
+    context = setup_run(repo)
+    find_unused_vars(context)
+
+    dirs = [x for x, _ in walk_watched_dirs(repo, get_watched_categories(context))]
+    assert os.path.join(repo, "roles", "role1", "tasks") in dirs
+    assert not any("venv" in x or ".git" in x for x in dirs)
+
+    class StoppedWatcher():
+        def wait(self):
+            raise KeyboardInterrupt()
+
+        def close(self):
+            pass
+    monkeypatch.setattr(watch_module, "get_watcher", lambda *args: StoppedWatcher())
+    watch_module.watch(context, duplicated_vars=False, json_output=True)
+    output = json.loads(capsys.readouterr().out)
+    assert sorted(x["name"] for x in output["added"]) == sorted(context.all_unused_vars.keys())
+    assert output["removed"] == []
+
+
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_server_answers_from_updated_context(tmp_path):
+    repo = os.path.join(tmp_path, "repo")
+    shutil.copytree(os.path.join(TEST_REPOS, "shared_groups", "repo"), repo)
+    socket_path = os.path.join(tmp_path, "lt.sock")
+    args = get_parser("serve").parse_args(
+        ["--socket", socket_path, "--no-cache", repo])
+    server = LittleTimmyServer(
+        socket_path, analyse(args, repo, keep_file_analyses=True), args, get_parser())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        assert request(socket_path, "is_used", {"name": "new_db_var"}) == {
+            "used": False, "declared": [], "referenced": []}
+        with open(os.path.join(repo, "group_vars/db.yml"), "a") as f:
+            f.write("new_db_var: 1\n")
+        result = request(socket_path, "run", {
+                         "argv": ["-j", "repo"], "cwd": str(tmp_path)})
+        assert request(socket_path, "is_used", {"name": "new_db_var"}) == {
+            "used": False, "declared": [os.path.join(repo, "group_vars/db.yml")], "referenced": []}
+        # an unexpected error is answered and the server keeps going
+        with pytest.raises(ServerError) as err:
+            request(socket_path, "run", {
+                    "argv": ["-j", "--output-file", "missing/out.json", "repo"], "cwd": str(tmp_path)})
+        assert err.value.code == SERVER_ERROR
+        assert request(socket_path, "locations", {"name": "new_db_var"})["declared"]
+    finally:
+        server.shutdown()
+        server.server_close()
+        server.watcher.close()
+        thread.join()
+
+    local_args = get_parser().parse_args(["-j", "--no-cache", repo])
+    expected = get_findings(analyse(local_args, repo))
+    assert "new_db_var" in {x["name"] for x in json.loads(result["stdout"])}
+    assert sorted(json.dumps({**x, "locations": sorted(x["locations"])}, sort_keys=True)
+                  for x in json.loads(result["stdout"])) == sorted(expected.keys())
+
+
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_server_only_answers_checks_it_ran(tmp_path):
+    repo = os.path.join(TEST_REPOS, "duplicate", "repo")
+    socket_path = os.path.join(tmp_path, "lt.sock")
+    args = get_parser("serve").parse_args(
+        ["--socket", socket_path, "--no-cache", "--no-duplicated-vars", repo])
+    server = LittleTimmyServer(
+        socket_path, analyse(args, repo, keep_file_analyses=True), args, get_parser())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        with pytest.raises(ServerError) as err:
+            request(socket_path, "run", {"argv": ["-j", repo], "cwd": os.getcwd()})
+        assert err.value.code == WRONG_SERVER
+        result = request(socket_path, "run", {
+                         "argv": ["-j", "--no-duplicated-vars", repo], "cwd": os.getcwd()})
+    finally:
+        server.shutdown()
+        server.server_close()
+        server.watcher.close()
+        thread.join()
+    assert json.loads(result["stdout"])
+    assert all(x["type"] == "UNUSED" for x in json.loads(result["stdout"]))
+
+
+def test_forward_run_gives_up_on_a_hung_server(tmp_path, monkeypatch):
+    socket_path = os.path.join(tmp_path, "lt.sock")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as hung_server:
+        hung_server.bind(socket_path)
+        hung_server.listen()
+        monkeypatch.setattr(client_module, "REQUEST_TIMEOUT_SECONDS", 0.1)
+        assert forward_run(socket_path, ["-j"], str(tmp_path)) is None
+
+
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_benchmark_finds_planted_unused_vars(tmp_path):
+    with open(os.path.join("tests", "ansible_vault_password")) as f:
+        vault_password = f.read().strip()
+    expected = generate_repo(str(tmp_path), roles=3, tasks_per_role=12, hosts=10, groups=3,
+                             vaulted=1, galaxy_roles=1, vault_password=vault_password)
+    results = run_benchmark(str(tmp_path))
+    assert list(results["phases"].keys()) == [
+        "config", "discovery", "setup_run", "yaml_load", "unused_vars", "duplicated_vars", "output"]
+    assert results["findings"]["unused"] == len(expected["unused_vars"])
+    assert results["findings"]["duplicated"] > 0
+
+    context = setup_run(str(tmp_path))
+    find_unused_vars(context)
+    assert sorted(context.all_unused_vars.keys()) == expected["unused_vars"]
+
+
+@pytest.mark.parametrize("search_glob, matches, does_not_match", [
+    ("/**/group_vars/**/*y*ml", ["group_vars/all.yml", "inventories/prod/group_vars/web/main.yaml"],
+     [".venv/group_vars/all.yml", "group_vars/.hidden/all.yml", "group_vars/.all.yml", "group_vars/all.json"]),
+    ("/*.yml", ["site.yml"], ["roles/site.yml", ".site.yml"]),
+    ("/roles/*/tasks/*.yml", ["roles/web/tasks/main.yml"], ["roles/web/extra/tasks/main.yml", "roles/tasks/main.yml"]),
+    ("/inventories/**/*", ["inventories/hosts", "inventories/prod/hosts.yml"],
+     ["inventories/.old/hosts", "inventories/prod/.hosts", "other/inventories/hosts"]),
+    ("/.github/*.yml", [".github/ci.yml"], [".github/workflows/ci.yml"]),
+    ("/[a-c]?.yml", ["a1.yml", "cz.yml"], ["d1.yml", "a/1.yml", "abc.yml"]),
+])
+def test_translate_glob(search_glob, matches, does_not_match):
+    pattern = translate_glob(search_glob)
+    for path in matches:
+        assert pattern.match(path), path
+    for path in does_not_match:
+        assert not pattern.match(path), path
+
+
+@pytest.mark.parametrize("search_glob", ["/**/group_vars/**/*y*ml", "/*.yml", "/inventories/**/*", "/**/.github/*", "/roles/*/t?sks/[!x]*"])
+def test_translate_glob_matches_like_glob(tmp_path, search_glob):
+    for path in ["site.yml", ".site.yml", "group_vars/all.yml", "group_vars/web/main.yaml", ".venv/group_vars/all.yml",
+                 "inventories/hosts", "inventories/prod/hosts.yml", "inventories/.old/hosts", "roles/web/tasks/main.yml",
+                 "roles/web/tasks/xtra.yml", "roles/web/.github/ci.yml", ".github/ci.yml"]:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text("")
+    pattern = translate_glob(search_glob)
+    expected = sorted(os.path.relpath(x, tmp_path)
+                      for x in glob.glob(str(tmp_path) + search_glob, recursive=True) if os.path.isfile(x))
+    every_file = [os.path.relpath(os.path.join(x, name), tmp_path)
+                  for x, _, names in os.walk(tmp_path) for name in names]
+    assert expected and sorted(x for x in every_file if pattern.match(x)) == expected
+
+
+def test_build_file_manifest_prunes_hidden_dirs_and_symlink_loops(tmp_path):
+    for path in ["group_vars/all.yml", ".venv/group_vars/all.yml", "roles/web/.cache/group_vars/all.yml",
+                 "roles/web/group_vars/all.yml", ".github/ci.yml"]:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text("")
+    # back up the tree, would walk forever if it was followed
+    (tmp_path / "roles" / "web" / "loop").symlink_to(tmp_path / "roles")
+    # to a directory outside of it, followed like glob does
+    (tmp_path / "elsewhere" / "group_vars").mkdir(parents=True)
+    (tmp_path / "elsewhere" / "group_vars" / "linked.yml").write_text("")
+    (tmp_path / "roles" / "linked").symlink_to(tmp_path / "elsewhere")
+
+    manifest = build_file_manifest(str(tmp_path), [
+        FileCategory("group_vars", ["/**/group_vars/**/*y*ml"], []),
+        FileCategory("github", ["/.github/*.yml"], [])])
+    assert sorted(os.path.relpath(x, tmp_path) for x in manifest.get("group_vars")) == [
+        "elsewhere/group_vars/linked.yml", "group_vars/all.yml", "roles/linked/group_vars/linked.yml",
+        "roles/web/group_vars/all.yml"]
+    assert manifest.get("github") == [str(tmp_path / ".github" / "ci.yml")]
+
+
+@pytest.mark.parametrize("repo", ["shared_groups", "multi_inventory"])
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_inventories_and_vars_files_are_loaded_once(repo):
+    context = setup_run(os.path.join(TEST_REPOS, repo, "repo"))
+    find_unused_vars(context)
+    find_duplicated_vars(context)
+    inventories = context.manifest.files_by_path([INVENTORIES])
+    assert context.counters["inventory_loads"] == len(inventories) == len(context.inventories)
+    assert context.counters["inventory_cache_hits"] >= len(inventories)
+    # every host in a group looks up the same group_vars
+    assert context.counters["vars_files_lookups"] == len(context.vars_files)
+    assert context.counters["vars_files_cache_hits"] > 0
+
+
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_vault_payloads_are_decrypted_once(tmp_path):
+    with open(os.path.join("tests", "ansible_vault_password")) as f:
+        vault_password = f.read().strip()
+    expected = generate_repo(str(tmp_path), roles=1, tasks_per_role=5, hosts=6, groups=3, vaulted=2,
+                             galaxy_roles=0, vault_password=vault_password, vaulted_files=2)
+    loader_cache.clear()
+    vault_plaintexts.clear()
+
+    # inline values are compared by their ciphertext, only whole files are decrypted
+    context = setup_run(str(tmp_path))
+    find_duplicated_vars(context)
+    assert context.counters["vault_decrypts"] == 2
+    assert any("group0.yml" in x for v in context.all_duplicated_vars.values() for x in v.locations)
+
+    loader_cache.clear()
+    context = setup_run(str(tmp_path))
+    find_unused_vars(context)
+    assert context.counters["vault_decrypts"] == 2
+    assert context.counters["vault_cache_hits"] == 2
+    assert sorted(context.all_unused_vars.keys()) == expected["unused_vars"]
+
+    loader_cache.clear()
+    context = setup_run(str(tmp_path))
+    find_unused_vars(context)
+    assert context.counters["vault_decrypts"] == 0
+    assert context.counters["vault_cache_hits"] == 4
+    loader_cache.clear()
+    vault_plaintexts.clear()
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_profile_is_added_to_json_output(jobs):
+    repo = os.path.join(TEST_REPOS, "no_deps", "repo")
+    args = get_parser().parse_args(
+        ["-j", "-p", "--profile-top", "3", "--no-cache", "--jobs", jobs, repo])
+    context = analyse(args, repo)
+    stdout = io.StringIO()
+    output_results(context, args, repo, stdout, io.StringIO())
+
+    output = json.loads(stdout.getvalue())
+    assert [x["type"] for x in output].count("PROFILE") == 1
+    profile = output[-1]
+    assert {"setup_run", "unused_vars", "yaml_load", "duplicated_vars", "analyse"} <= profile["phases"].keys()
+    assert profile["counters"]["files_analysed"] == len(context.file_timings)
+    # nothing needs them after a run without the cache
+    assert context.file_analyses == {}
+    assert len(profile["slowest_files"]) == 3
+
+
+@pytest.mark.parametrize("repo", get_test_duplicate_folders(TEST_REPOS))
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_streamed_output_has_the_same_findings(repo):
+    repo = os.path.join(TEST_REPOS, repo, "repo")
+    args = get_parser().parse_args(["-j", "--no-cache", repo])
+    context = analyse(args, repo)
+    stdout = io.StringIO()
+    output_results(context, args, repo, stdout, io.StringIO())
+    expected = json.loads(stdout.getvalue())
+
+    for output_format in ["ndjson", "sarif"]:
+        args = get_parser().parse_args(
+            ["--output-format", output_format, "--no-cache", repo])
+        stdout = io.StringIO()
+        writer = create_writer(output_format, stdout, repo, False)
+        context = analyse(args, repo, writer)
+        # everything was written before the end of the run
+        streamed = stdout.getvalue()
+        output_results(context, args, repo, stdout,
+                       io.StringIO(), writer=writer)
+        if output_format == "ndjson":
+            assert stdout.getvalue() == streamed
+            actual = [json.loads(x) for x in stdout.getvalue().splitlines()]
+            # in the same order too, noise is removed the same way
+            assert actual == expected
+        else:
+            sarif = json.loads(stdout.getvalue())
+            assert sarif["version"] == "2.1.0"
+            results = sarif["runs"][0]["results"]
+            assert [x["ruleId"] for x in results].count("unused-var") == len(
+                [x for x in expected if x["type"] == "UNUSED"])
+            assert [x["ruleId"] for x in results].count("duplicated-var") == len(
+                [x for x in expected if x["type"] == "DUPLICATED"])
+            assert all(not x["physicalLocation"]["artifactLocation"]["uri"].startswith("/")
+                       for result in results for x in result["locations"])
+            # values are never written, they may have been decrypted from a vault
+            assert sorted(x["message"]["text"].split(" ")[0] for x in results if x["ruleId"] == "duplicated-var") == sorted(
+                x["name"].split("##")[1] for x in expected if x["type"] == "DUPLICATED")
+            assert all("##" not in x["message"]["text"] for x in results)
+
+
+def test_finding_writers_must_write_both_kinds_of_finding():
+    class UnusedOnlyWriter(FindingWriter):
+        def write_unused_var(self, name: str, locations: set[str]):
+            pass
+
+    with pytest.raises(TypeError):
+        UnusedOnlyWriter(io.StringIO(), ".", False)
+
+
+def test_startup_does_not_import_ansible():
+    # jsonschema is only imported to validate a config file, which no_deps has
+    script = (
+        "import sys\n"
+        "from little_timmy.__main__ import main\n"
+        "from little_timmy.config_loader import find_and_load_config\n"
+        "import little_timmy.query\n"
+        f"find_and_load_config({os.path.join(TEST_REPOS, 'no_deps', 'repo')!r})\n"
+        "print(sorted({x.split('.')[0] for x in sys.modules} & {'ansible', 'jinja2'}))\n")
+    result = subprocess.run([sys.executable, "-c", script],
+                            check=True, capture_output=True, text=True, stdin=subprocess.DEVNULL)
+    assert result.stdout.strip() == "[]"
+    # with room for slow and noisy CI machines, the imports are checked above
+    assert measure_startup(repeat=3)["version_seconds"] < STARTUP_BUDGET_SECONDS * 3
+
+
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_query_answers_from_the_index(tmp_path):
+    shutil.copytree(os.path.join(TEST_REPOS, "duplicate", "repo"), tmp_path / "repo")
+    repo = str(tmp_path / "repo")
+    with pytest.raises(ValueError, match="no index"):
+        VarIndex(repo)
+    context = analyse(get_parser().parse_args(["-j", repo]), repo)
+
+    index = VarIndex(repo)
+    for name in context.all_declared_vars.keys() | context.all_referenced_vars.keys():
+        assert index.locations(name) == {
+            "declared": sorted(context.all_declared_vars.get(name, [])),
+            "referenced": sorted(context.all_referenced_vars.get(name, [])),
+        }
+    for path, analysis in context.file_analyses.items():
+        assert index.file_vars(path) == {"declared": sorted(analysis.declared), "referenced": sorted(analysis.referenced)}
+    index.close()
+
+    used = next(iter(context.all_referenced_vars.keys()))
+    args = get_parser("query").parse_args(
+        ["-j", used, "not_a_var", "--file", os.path.join(repo, "group_vars", "all.yml")])
+    stdout = io.StringIO()
+    assert run_query(args, repo, stdout) == 1
+    output = json.loads(stdout.getvalue())
+    assert [(x["name"], x["type"]) for x in output] == [
+        (used, "VAR"), ("not_a_var", "VAR"), (os.path.join(repo, "group_vars", "all.yml"), "FILE")]
+    assert output[0]["used"] and not output[1]["used"] and output[2]["found"]
+
+
+@pytest.mark.parametrize("repo", get_test_folders(TEST_REPOS))
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_max_memory_gives_the_same_findings(repo):
+    repo = os.path.join(TEST_REPOS, repo, "repo")
+    outputs = []
+    for max_memory in [[], ["--max-memory", "0"]]:
+        loader_cache.clear()
+        args = get_parser().parse_args(["-j", "--no-cache", *max_memory, repo])
+        context = analyse(args, repo)
+        stdout = io.StringIO()
+        output_results(context, args, repo, stdout, io.StringIO())
+        outputs.append(sorted(json.dumps({**x, "locations": sorted(x["locations"])}, sort_keys=True)
+                              for x in json.loads(stdout.getvalue())))
+    assert outputs[0] == outputs[1]
+    # with no memory only the newest file is kept, the rest are spilled
+    assert len(loader_cache) <= 1
+    assert context.counters["loader_cache_evictions"] > 0 and loader_cache.spilled
+    loader_cache.clear()
+    loader_cache.configure()
+
+
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_vaulted_files_are_never_spilled(tmp_path):
+    with open(os.path.join("tests", "ansible_vault_password")) as f:
+        vault_password = f.read().strip()
+    expected = generate_repo(str(tmp_path), roles=1, tasks_per_role=5, hosts=6, groups=3, vaulted=2,
+                             galaxy_roles=0, vault_password=vault_password, vaulted_files=2)
+    loader_cache.clear()
+    loader_cache.configure(0, spill=True)
+
+    context = setup_run(str(tmp_path))
+    find_unused_vars(context)
+    find_duplicated_vars(context)
+    assert sorted(context.all_unused_vars.keys()) == expected["unused_vars"]
+    assert loader_cache.spilled
+    # all.yml has inline vaulted values, group0 and group1 are encrypted as a whole
+    for name in ["all.yml", "group0.yml", "group1.yml"]:
+        assert str(tmp_path / "group_vars" / name) not in loader_cache.spilled
+    for (value,) in loader_cache.spill_db.execute("SELECT value FROM spilled"):
+        assert b"secret0" not in value and b"secret1" not in value
+    loader_cache.clear()
+    loader_cache.configure()
+
+
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_skip_vars_globs_and_regexes(tmp_path):
+    (tmp_path / ".little-timmy").write_text(
+        "skip_vars: [gen_*, 're:other_[a-z]+', exact]\nskip_vars_duplicates_substrings: [token]\n")
+    (tmp_path / "roles" / "web" / "defaults").mkdir(parents=True)
+    (tmp_path / "roles" / "web" / "defaults" / "main.yml").write_text(
+        "gen_1: 1\ngen_2: 1\nother_x: 1\nother_1: 1\nexact: 1\nexactly: 1\napi_token: 1\n")
+
+    context = setup_run(str(tmp_path))
+    find_unused_vars(context)
+    assert sorted(context.all_unused_vars.keys()) == ["api_token", "exactly", "other_1"]
+    var_filter = context.config.var_filter
+    assert var_filter.skip("ansible_host") and var_filter.skip("inventory_hostname")
+    assert var_filter.skip_duplicate("api_token") and not var_filter.skip("api_token")
+
+    # these can not be combined with the others into one regex
+    (tmp_path / ".little-timmy").write_text("skip_vars: ['re:(?i)gen_.*', 're:(o)ther_\\1', exact, 'ex?ct_*']\n")
+    var_filter = setup_run(str(tmp_path)).config.var_filter
+    assert var_filter.skip("GEN_1") and var_filter.skip("other_o") and var_filter.skip("exact_1")
+    assert not var_filter.skip("other_x") and not var_filter.skip("ogen_1") and not var_filter.skip("exactly")
+
+    (tmp_path / ".little-timmy").write_text("skip_vars: ['re:bad_(']\n")
+    with pytest.raises(ValueError, match="re:bad_"):
+        setup_run(str(tmp_path))
+
+
+@pytest.mark.parametrize("dir_matching,expected", [
+    ("substring", ["used_elsewhere"]),
+    ("component", ["contest_var", "my_galaxy_var", "used_elsewhere"]),
+])
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_dir_matching(tmp_path, dir_matching, expected):
+    (tmp_path / ".little-timmy").write_text(f"dir_matching: {dir_matching}\n")
+    for role, var in [("web", "used_elsewhere"), ("contests", "contest_var"), ("my_galaxy_roles", "my_galaxy_var")]:
+        (tmp_path / "roles" / role / "defaults").mkdir(parents=True)
+        (tmp_path / "roles" / role / "defaults" / "main.yml").write_text(f"{var}: 1\n")
+    # whole components are excluded either way
+    (tmp_path / "tests" / "defaults").mkdir(parents=True)
+    (tmp_path / "tests" / "defaults" / "main.yml").write_text("skipped_var: 1\n")
+
+    context = setup_run(str(tmp_path))
+    find_unused_vars(context)
+    assert sorted(context.all_unused_vars.keys()) == expected
+
+
+@pytest.mark.parametrize("prefetch_threads", [0, 2])
+@pytest.mark.parametrize("cache", [False, True])
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_templates_that_can_not_have_jinja_are_skipped(tmp_path, prefetch_threads, cache, caplog):
+    (tmp_path / ".little-timmy").write_text("template_max_bytes: 100\n")
+    role = tmp_path / "roles" / "web"
+    (role / "defaults").mkdir(parents=True)
+    (role / "defaults" / "main.yml").write_text(
+        "text_var: 1\nbinary_var: 1\nlatin_var: 1\nbig_var: 1\n")
+    (role / "templates").mkdir()
+    (role / "templates" / "text.j2").write_text("{{ text_var }}\n")
+    (role / "templates" / "empty.j2").write_text("")
+    (role / "templates" / "plain.conf").write_text("no jinja here\n")
+    (role / "templates" / "logo.png").write_bytes(b"\x89PNG\x00{{ binary_var }}")
+    (role / "templates" / "latin.j2").write_bytes(b"\xff{{ latin_var }}")
+    (role / "templates" / "big.j2").write_text("{{ big_var }}" + "x" * 100)
+
+    context = setup_run(str(tmp_path))
+    analysis_cache = AnalysisCache(str(tmp_path / "cache.sqlite"), "") if cache else None
+    find_unused_vars(context, cache=analysis_cache, prefetch_threads=prefetch_threads)
+    assert sorted(context.all_unused_vars.keys()) == ["big_var", "binary_var", "latin_var"]
+    assert context.counters["templates_too_large"] == 1
+    assert f"skipping template {role / 'templates' / 'big.j2'}" in caplog.text
+    if cache:
+        # the big template is not read to be digested
+        assert context.counters["analysis_cache_misses"] == 6
+        analysis_cache.close()
+    assert context.counters["templates_binary"] == 2
+    assert context.counters["templates_without_jinja"] == 2
+
+    # there is no limit unless one is set
+    (tmp_path / ".little-timmy").unlink()
+    context = setup_run(str(tmp_path))
+    find_unused_vars(context, prefetch_threads=prefetch_threads)
+    assert sorted(context.all_unused_vars.keys()) == ["binary_var", "latin_var"]
+    assert context.counters["templates_too_large"] == 0
+
+
+@pytest.mark.parametrize("prefetch_threads", [0, 2])
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_cache_misses_are_parsed_from_the_bytes_read_for_their_digest(tmp_path, monkeypatch, prefetch_threads):
+    repo = os.path.join(tmp_path, "repo")
+    shutil.copytree(os.path.join(TEST_REPOS, "no_deps", "repo"), repo)
+    reads = defaultdict(int)
+
+    def read_bytes(path):
+        reads[path] += 1
+        with open(path, "rb") as f:
+            return f.read()
+    monkeypatch.setattr(prefetch_module, "read_bytes", read_bytes)
+    monkeypatch.setattr(utils_module, "read_bytes", read_bytes)
+    loader_cache.clear()
+
+    context = setup_run(repo)
+    analysis_cache = AnalysisCache(os.path.join(tmp_path, "cache.sqlite"), "")
+    find_unused_vars(context, cache=analysis_cache, prefetch_threads=prefetch_threads)
+    analysis_cache.close()
+    assert context.counters["analysis_cache_misses"] > 1
+    assert reads and max(reads.values()) == 1
+    with open(os.path.join(TEST_REPOS, "no_deps", "unused_vars")) as f:
+        assert sorted(context.all_unused_vars.keys()) == sorted(f.read().splitlines())
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_batch_reports_each_directory_like_a_single_run(jobs, tmp_path):
+    repos = [os.path.abspath(os.path.join(TEST_REPOS, x, "repo")) for x in ["duplicate", "no_deps"]]
+    manifest = tmp_path / "repos.txt"
+    manifest.write_text("# nightly\n" + os.path.relpath(repos[1], tmp_path) + "\n\nmissing\nbad\n")
+    (tmp_path / "bad").mkdir()
+    (tmp_path / "bad" / ".little-timmy").write_text("skip_vars: 1\n")
+    directories = [repos[0]] + read_manifest(str(manifest))
+    args = get_parser("batch").parse_args(["-j", "--no-cache", "--jobs", jobs])
+    envs = len(jinja_envs)
+    stdout = io.StringIO()
+    assert run_batch(args, directories, stdout, io.StringIO()) == 2
+
+    report = json.loads(stdout.getvalue())
+    assert list(report.keys()) == directories
+    assert report[str(tmp_path / "missing")] == {"exit_code": 2, "error": f"{tmp_path / 'missing'} does not exist"}
+    assert report[str(tmp_path / "bad")]["exit_code"] == 2
+    assert "is not valid" in report[str(tmp_path / "bad")]["error"]
+    for repo in repos:
+        single = io.StringIO()
+        output_results(analyse(get_parser().parse_args(["-j", "--no-cache", repo]), repo), args, repo, single)
+        def key(x): return json.dumps({**x, "locations": sorted(x["locations"])}, sort_keys=True)
+        assert report[repo]["exit_code"] == 1
+        assert sorted(map(key, report[repo]["findings"])) == sorted(map(key, json.loads(single.getvalue())))
+    # neither has filter plugins so they share one environment
+    assert len(jinja_envs) <= envs + 1
+
+
+@pytest.mark.parametrize("repo", get_test_duplicate_folders(TEST_REPOS))
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_merged_shards_match_a_single_run(repo, tmp_path):
+    # the shards run on a checkout in a different place to the merge
+    shutil.copytree(os.path.join(TEST_REPOS, repo), tmp_path / repo)
+    shard_repo = os.path.relpath(tmp_path / repo / "repo")
+    repo = os.path.join(TEST_REPOS, repo, "repo")
+    expected = analyse(get_parser().parse_args(["--no-cache", repo]), repo)
+
+    partials = []
+    for index in [2, 3, 1]:
+        args = get_parser().parse_args(
+            ["--no-cache", "--shard", f"{index}/3", shard_repo])
+        partial = tmp_path / f"partial-{index}.json"
+        partial.write_text(json.dumps(analyse_shard(args, shard_repo)))
+        partials.append(str(partial))
+    context = merge(partials, repo, None)
+
+    assert context.all_unused_vars == expected.all_unused_vars
+    assert dict(context.all_declared_vars) == dict(expected.all_declared_vars)
+    assert dict(context.all_referenced_vars) == dict(expected.all_referenced_vars)
+    assert {k: (v.locations, v.original) for k, v in context.all_duplicated_vars.items()} == \
+        {k: (v.locations, v.original) for k, v in expected.all_duplicated_vars.items()}
+
+    with pytest.raises(ValueError, match="exactly once"):
+        merge(partials[:2], repo, None)
+
+
+@pytest.mark.parametrize("repo", get_test_duplicate_folders(TEST_REPOS))
+@pytest.mark.filterwarnings("ignore:.*:DeprecationWarning")
+def test_finds_same_duplicated_vars_in_parallel(repo):
+    serial_context = setup_run(os.path.join(TEST_REPOS, repo, "repo"))
+    find_duplicated_vars(serial_context)
+    parallel_context = setup_run(os.path.join(TEST_REPOS, repo, "repo"))
+    find_duplicated_vars(parallel_context, jobs=3)
+
+    # in the same order too
+    assert ([(k, v.locations, v.original) for k, v in parallel_context.all_duplicated_vars.items()]
+            == [(k, v.locations, v.original) for k, v in serial_context.all_duplicated_vars.items()])